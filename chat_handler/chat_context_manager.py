@@ -1,111 +1,251 @@
+import asyncio
+
+from my_llm.token_counter import TokenCounter
+
+
 class ChatContextManager:
     """
     聊天上下文管理器：负责管理对话历史，自动精简冗长对话，优化token使用
+    - 精简在后台任务中进行（对话轮次之间的空闲时间），用户的下一轮对话不需要等待
+    - 增量摘要：只把上次精简之后新增的旧消息合并到一条滚动摘要中，不会重复总结已有的摘要
+    - 每次请求LLM之前在本地估算token数（包括工具列表和系统提示），超过阈值时提前精简，超过上限时直接裁剪最旧的对话
+    历史记录的结构：[角色提示词, 对话摘要（可选）, 最近的对话...]
+    为了尽量命中LLM服务商的提示词缓存（按请求的前缀匹配），历史记录的布局遵循以下规则：
+    - 角色提示词（包括工具和格式说明）和工具列表在整个会话中保持不变，是每次请求都能命中缓存的固定前缀
+    - 只有一个摘要位置，紧跟在角色提示词之后；两次精简之间对话只在末尾追加，已发送过的前缀不会改变
+    - 精简的结果不会在一轮对话中途替换（同一轮的多次请求共享前缀），而是在下一轮对话开始时（apply_summary）才替换
+    - 每次精简都会降到阈值以下很多（只保留最近几轮），所以精简很少发生，每次精简之后缓存从摘要之后重新累积
     """
     def __init__(self, llm_engine, max_context_tokens=64000,
-                 summarize_threshold=0.5, keep_chat_rounds=5, system_prompt_maxnum=10):
+                 summarize_threshold=0.5, keep_chat_rounds=5, trim_threshold=0.9):
         """
         初始化上下文管理器
 
         参数:
             llm_engine: 用于生成摘要的语言模型引擎
             max_context_tokens: 模型的最大上下文长度
-            summarize_threshold: 触发精简的阈值比例
+            summarize_threshold: 触发精简的阈值比例（远低于最大上下文长度，在达到上限之前提前精简）
             keep_chat_rounds: 保留的最近对话轮数
-            system_prompt_maxnum: 最大保存系统提示的数量，用于精简
+            trim_threshold: 直接裁剪最旧对话的阈值比例（精简来不及完成时，保证请求不超过上下文长度）
         """
         self.llm = llm_engine
         self.max_context_tokens = max_context_tokens
         self.summarize_threshold = summarize_threshold
         self.keep_chat_rounds = keep_chat_rounds
-        self.system_prompt_maxnum = system_prompt_maxnum
+        self.trim_threshold = trim_threshold
+
+        # 本地token估算（每条消息的结果会缓存）
+        self.token_counter = TokenCounter()
+        # 最近一次请求前估算的token数（用于校准）
+        self.last_estimate = 0
+
+        # 当前的滚动摘要（历史记录中的摘要消息对象和摘要文本）
+        self.summary_message = None
+        self.summary = ""
+        # 后台精简任务
+        self._task = None
+        # 已完成、等待在对话轮次之间替换的精简结果：(摘要开始位置, 被总结的消息, 摘要文本)
+        self._pending = None
 
     async def manage_context(self, history: list, current_tokens: int) -> list:
         """
-        管理对话上下文，当达到阈值时自动精简历史记录，精简后作为system_prompt保存
+        管理对话上下文：当达到阈值时，在后台启动精简任务（不等待精简完成）
+        精简完成后直接修改 history 列表（把旧消息替换为滚动摘要）
 
         参数:
             history: 完整的对话历史列表
-            current_tokens: 当前上下文的tokens数量
+            current_tokens: 当前上下文的tokens数量（API返回的），会与本地估算的结果取较大值
 
         返回:
-            经过管理的历史记录列表
+            对话历史列表（与传入的是同一个列表）
         """
-        # 如果当前tokens数量超过最大上下文长度的阈值，执行精简
-        if current_tokens > self.max_context_tokens * self.summarize_threshold:
-            print(f"⚠️ 上下文大小({current_tokens}tokens)超过阈值，开始精简历史记录...")
+        self.apply_summary(history)
 
-            # 分离系统提示、需要保留的最近消息和需要精简的旧消息
-            system_prompts = [msg for msg in history if msg.get("role") == "system"]
-            non_system_messages = [msg for msg in history if msg.get("role") != "system"]
+        current_tokens = max(current_tokens or 0, self.token_counter.count(history))
+        if current_tokens > self.max_context_tokens * self.summarize_threshold and not self._busy:
+            print(f"⚠️ 上下文大小({current_tokens}tokens)超过阈值，后台精简历史记录...")
+            self._task = asyncio.create_task(self._compact(history))
 
-            # 保留最近的几轮消息
-            keep_chat_messages = self._get_keep_chat_messages(non_system_messages, self.keep_chat_rounds)
-            recent_messages = non_system_messages[-keep_chat_messages:] if len(non_system_messages) > keep_chat_messages else non_system_messages
-            # 需要精简的旧消息
-            old_messages = non_system_messages[:-keep_chat_messages] if len(non_system_messages) > keep_chat_messages else []
+        return history
 
-            # 如果有需要精简的消息
-            if old_messages:
-                # 将旧消息发送给LLM进行精简
-                summary = await self._summarize_messages(old_messages)
+    def prepare_request(self, history: list, tools_json: str = "") -> int:
+        """
+        每次请求LLM之前调用：在本地估算这次请求的token数（消息 + 工具列表）
+        - 超过精简阈值时在后台开始精简（不用等到下一轮对话结束）
+        - 超过裁剪阈值时直接删除最旧的对话（不调用API），保证请求不会超过上下文长度
 
-                # 重构历史记录：系统提示 + 精简摘要 + 最近消息
-                new_history = system_prompts + [{"role": "system", "content": f"新增的对话摘要：\n{summary}"}] + recent_messages
+        参数:
+            history: 完整的对话历史列表（裁剪时直接修改）
+            tools_json: 工具列表的JSON
 
-                print(f"✅ 历史记录精简完成")
+        返回:
+            估算的token数
+        """
+        tokens = self.token_counter.count(history, tools_json)
 
-                print(f"message size: {len(new_history)}")
-                for msg in new_history:
-                    print(f"role: {msg['role']}, content: {msg['content']}")
+        trim_limit = self.max_context_tokens * self.trim_threshold
+        if tokens > trim_limit:
+            tokens = self._trim(history, tools_json, trim_limit)
 
-                # 如果精简的系统提示超过最大数量，继续精简
-                currrent_sysprompts_len = len(system_prompts)
-                if currrent_sysprompts_len >= self.system_prompt_maxnum:
-                    system_summary = await self._summarize_system_prompts(new_history[1:currrent_sysprompts_len + 1])
-                    new_history = [new_history[0], {"role": "system", "content": f"新增的对话摘要：\n{system_summary}"}] + recent_messages
+        if tokens > self.max_context_tokens * self.summarize_threshold and not self._busy:
+            print(f"⚠️ 上下文大小(约{tokens}tokens)超过阈值，后台精简历史记录...")
+            self._task = asyncio.create_task(self._compact(history))
 
-                    print(f"✅ 系统提示精简完成")
-                    print(f"message size: {len(new_history)}")
-                    for msg in new_history:
-                        print(f"role: {msg['role']}, content: {msg['content']}")
+        self.last_estimate = tokens
+        return tokens
 
-                return new_history
+    def calibrate(self, prompt_tokens: int):
+        """用API返回的 prompt_tokens 校准本地估算"""
+        self.token_counter.calibrate(self.last_estimate, prompt_tokens)
 
-        # 如果不需要精简，直接返回原历史记录
-        return history
+    def _trim(self, history: list, tools_json: str, limit: float) -> int:
+        """
+        删除摘要之后最旧的对话，直到估算的token数不超过上限
+        按整轮删除（删除到下一条用户消息之前），不会拆开工具调用和工具结果；当前这一轮不会被删除
+        """
+        tokens = self.token_counter.count(history, tools_json)
+        start = self._summary_end(history)
+        last_user = max((i for i in range(start, len(history)) if history[i].get("role") == "user"), default=start)
 
-    async def _summarize_messages(self, messages: list) -> str:
-        """使用LLM对历史消息进行摘要"""
+        scale = self.token_counter.scale
+        end = start
+        while tokens > limit and end < last_user:
+            tokens -= self.token_counter.count_message(history[end]) * scale
+            end += 1
+            while end < last_user and history[end].get("role") != "user":
+                tokens -= self.token_counter.count_message(history[end]) * scale
+                end += 1
 
-        # 构建摘要提示
-        messages.append({
-            "role": "user",
-            "content": (
-                "请你总结上述对话内容，你应该使用简洁准确的语言尽可能概括出所有重要的用户提问与助手回答，对每轮对话都严格按照如下格式进行整理：\n\n"
-                "用户提到：...；助手回答：...。\n"
-            )
-        })
+        if end > start:
+            del history[start:end]
+            print(f"⚠️ 上下文即将超过上限，裁剪了最旧的 {end - start} 条消息")
 
-        # 调用LLM生成摘要
-        response = await self.llm.chat(messages, [])  # 不需要提供工具
-        summary = response.choices[0].message.content
-
-        return summary
-
-    async def _summarize_system_prompts(self, messages: list) -> str:
-        """使用LLM对系统提示进行摘要"""
-        # 构建摘要提示
-        messages.append({
-            "role": "user",
-            "content": (
-                "请你总结上述所有系统摘要中用户对话内容，使用简洁准确的语言提取出最重要的部分，合并重复的部分，丢弃不重要的部分，并严格按照如下格式进行整理：\n\n"
-                "用户提到：...；助手回答：...。\n"
-            )
-        })
+        tokens = self.token_counter.count(history, tools_json)
+        if tokens > limit:
+            print(f"⚠️ 裁剪后上下文仍然较大(约{tokens}tokens)")
+        return tokens
+
+    def restore(self, history: list, summary: str):
+        """恢复会话时调用：重新关联历史记录中的摘要消息（角色提示词之后的系统消息）"""
+        self.summary = summary or ""
+        self.summary_message = None
+        start = 1 if history and history[0].get("role") == "system" else 0
+        if self.summary and len(history) > start and history[start].get("role") == "system":
+            self.summary_message = history[start]
+
+    @property
+    def is_compacting(self) -> bool:
+        """后台精简任务是否正在进行"""
+        return self._task is not None and not self._task.done()
+
+    @property
+    def _busy(self) -> bool:
+        """正在精简，或者有尚未替换的精简结果（不需要再次精简）"""
+        return self.is_compacting or self._pending is not None
+
+    def apply_summary(self, history: list) -> bool:
+        """
+        在对话轮次之间调用：用已完成的精简结果替换摘要和被总结的消息
+        这是会改变历史记录前缀的唯一位置（裁剪除外），一轮对话中的多次请求始终使用相同的前缀
+
+        返回:
+            是否替换了历史记录
+        """
+        if self._pending is None:
+            return False
+        start, old_messages, summary = self._pending
+        self._pending = None
+
+        # 被总结的消息已经不在原来的位置（如会话被重置、被裁剪），放弃这次结果
+        end = start + len(old_messages)
+        if self._summary_end(history) != start or len(history) < end or \
+                any(a is not b for a, b in zip(history[start:end], old_messages)):
+            print("⚠️ 历史记录已变化，放弃本次精简")
+            return False
+
+        # 用新的摘要替换旧的摘要和被总结的消息
+        summary_message = {"role": "system", "content": f"对话摘要：\n{summary}"}
+        summary_start = start - 1 if start > 0 and history[start - 1] is self.summary_message else start
+        history[summary_start:end] = [summary_message]
+        self.summary_message = summary_message
+        self.summary = summary
+
+        print(f"✅ 历史记录精简完成，精简了 {len(old_messages)} 条消息，当前消息数: {len(history)}")
+        return True
+
+    async def close(self):
+        """取消正在进行的精简任务（会话结束时调用）"""
+        if self.is_compacting:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._pending = None
+
+    def _summary_end(self, history: list) -> int:
+        """返回历史记录中 角色提示词和摘要 之后的位置"""
+        start = 1 if history and history[0].get("role") == "system" else 0
+        if self.summary_message is not None and len(history) > start and history[start] is self.summary_message:
+            start += 1
+        return start
+
+    async def _compact(self, history: list):
+        """
+        增量精简：把摘要之后、最近几轮之前的消息合并到滚动摘要中
+        生成摘要期间对话可以继续（只会在末尾追加消息），完成后等到对话轮次之间再替换被总结的那部分消息
+        """
+        try:
+            start = self._summary_end(history)
+            messages = history[start:]
+
+            # 保留最近的几轮消息（保留部分从用户消息开始，不会拆开工具调用和工具结果）
+            keep_chat_messages = self._get_keep_chat_messages(messages, self.keep_chat_rounds)
+            old_messages = messages[:len(messages) - keep_chat_messages]
+            if not old_messages:
+                return
+
+            # 将新增的旧消息合并到已有的摘要中
+            summary = await self._summarize_messages(self.summary, old_messages)
+            self._pending = (start, old_messages, summary)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ 精简历史记录失败: {e}")
+
+    @staticmethod
+    def _format_messages(messages: list) -> str:
+        """将消息转换为文本记录（工具调用和工具结果也转换为文本，不需要提供工具定义）"""
+        lines = []
+        for msg in messages:
+            role = msg.get("role")
+            if role == "user":
+                lines.append(f"用户：{msg.get('content') or ''}")
+            elif role == "assistant":
+                if msg.get("content"):
+                    lines.append(f"助手：{msg['content']}")
+                for tool_call in msg.get("tool_calls") or []:
+                    function = tool_call["function"] if isinstance(tool_call, dict) else tool_call.function
+                    name, arguments = (function["name"], function["arguments"]) if isinstance(function, dict) \
+                        else (function.name, function.arguments)
+                    lines.append(f"助手调用工具：{name}({arguments})")
+            elif role == "tool":
+                lines.append(f"工具结果：{msg.get('content') or ''}")
+            else:
+                lines.append(f"系统：{msg.get('content') or ''}")
+        return "\n".join(lines)
+
+    async def _summarize_messages(self, summary: str, messages: list) -> str:
+        """使用LLM将新增的对话合并到已有的摘要中"""
+        content = ""
+        if summary:
+            content += f"已有的对话摘要：\n{summary}\n\n"
+        content += (
+            f"新增的对话：\n{self._format_messages(messages)}\n\n"
+            "请你将新增的对话合并到已有的对话摘要中（如果有），使用简洁准确的语言尽可能概括出所有重要的用户提问与助手回答，"
+            "合并重复的部分，丢弃不重要的部分，对每轮对话都严格按照如下格式进行整理：\n\n"
+            "用户提到：...；助手回答：...。\n"
+        )
 
         # 调用LLM生成摘要
-        response = await self.llm.chat(messages, [])
+        response = await self.llm.chat([{"role": "user", "content": content}], [])  # 不需要提供工具
         return response.choices[0].message.content
 
     def _get_keep_chat_messages(self, messages: list, rounds: int) -> int:
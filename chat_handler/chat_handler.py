@@ -1,8 +1,10 @@
-import json
+import asyncio
 import yaml
-from pathlib import Path
 
 from chat_handler.chat_context_manager import ChatContextManager
+from my_mcp.tool_catalog import ToolCatalog
+from my_llm.openai_engine import prompt_cache_usage
+from my_mcp.tool_executor import ToolExecutor
 
 class ChatHandler:
     def __init__(self, openai_engine, mcp_client, whitelist_path=None, max_context_tokens=64000):
@@ -11,8 +13,12 @@ class ChatHandler:
 
         # 工具列表
         self.tools = None
+        # 工具目录（根据白名单过滤的工具列表）
+        self.tool_catalog = ToolCatalog(mcp_client, whitelist_path)
         # 工具白名单配置
-        self.tools_whitelist = self._load_tools_whitelist(whitelist_path)
+        self.tools_whitelist = self.tool_catalog.tools_whitelist
+        # 工具执行器（并发执行工具调用，超时配置来自白名单）
+        self.tool_executor = ToolExecutor(mcp_client, self.tools_whitelist)
 
         # 上下文
         self.history = []
@@ -56,6 +62,9 @@ class ChatHandler:
             user_input: 用户输入的文本
             use_stream: 是否使用流式输出
         """
+        # 对话轮次之间：替换后台已完成的精简结果（一轮对话中历史记录的前缀保持不变，便于命中提示词缓存）
+        self.context_manager.apply_summary(self.history)
+
         # 1. 将用户输入添加到历史记录
         self.history.append({"role": "user", "content": user_input})
 
@@ -64,6 +73,8 @@ class ChatHandler:
             self.tools = await self.prepare_tools()
 
         while True:
+            # 请求之前在本地估算token数，必要时提前精简或裁剪上下文
+            self.context_manager.prepare_request(self.history, self.tool_catalog.tools_json)
             # 3. 调用LLM API (根据use_stream参数决定是否使用流式调用)
             if use_stream:
                 response_message, finish_reason, tokens_used = await self._call_llm_stream()
@@ -73,22 +84,8 @@ class ChatHandler:
             # 更新token计数器
             if tokens_used:
                 self.message_tokens = getattr(tokens_used, 'prompt_tokens', 0)
-                self.tokens_used['prompt_cached_tokens'] += getattr(tokens_used, 'prompt_cache_hit_tokens', 0)
-                self.tokens_used['prompt_miss_tokens'] += getattr(tokens_used, 'prompt_cache_miss_tokens', 0)
-                self.tokens_used['prompt_tokens'] += getattr(tokens_used, 'prompt_tokens', 0)
-                self.tokens_used['completion_tokens'] += getattr(tokens_used, 'completion_tokens', 0)
-
-            # 输出token统计信息
-            if tokens_used:
-                print(
-                    f"\nCurrent tokens used: [prompt_cached_tokens]: {getattr(tokens_used, 'prompt_cache_hit_tokens', 0)}"
-                    f" - [prompt_miss_tokens]: {getattr(tokens_used, 'prompt_cache_miss_tokens', 0)}"
-                    f" - [prompt_tokens]: {getattr(tokens_used, 'prompt_tokens', 0)}"
-                    f" - [completion_tokens]: {getattr(tokens_used, 'completion_tokens', 0)}")
-                print(f"Total tokens used: [prompt_cached_tokens]: {self.tokens_used['prompt_cached_tokens']}"
-                      f" - [prompt_miss_tokens]: {self.tokens_used['prompt_miss_tokens']}"
-                      f" - [prompt_tokens]: {self.tokens_used['prompt_tokens']}"
-                      f" - [completion_tokens]: {self.tokens_used['completion_tokens']}")
+                self.context_manager.calibrate(self.message_tokens)
+                self._record_tokens(tokens_used)
 
             # 3.1 如果LLM没有工具调用，则直接返回结果
             if finish_reason != "tool_calls":
@@ -139,7 +136,7 @@ class ChatHandler:
 
         # 处理流式响应
         print("LLM: ", end="", flush=True)
-        for chunk in stream:
+        async for chunk in stream:
             if chunk.choices and chunk.choices[0].delta:
                 delta = chunk.choices[0].delta
 
@@ -168,6 +165,9 @@ class ChatHandler:
             # 检查完成原因
             if chunk.choices and chunk.choices[0].finish_reason:
                 finish_reason = chunk.choices[0].finish_reason
+
+            # token使用情况（可能在最后一个不包含choices的片段中返回）
+            if getattr(chunk, 'usage', None):
                 tokens_used = chunk.usage
 
         print()  # 换行
@@ -180,98 +180,44 @@ class ChatHandler:
 
         return response_message, finish_reason, tokens_used
 
+    def _record_tokens(self, tokens_used):
+        """累计本会话的token使用情况，输出本次请求、本会话的token数以及提示词缓存命中率（本会话和全局）"""
+        hit, miss = prompt_cache_usage(tokens_used)
+        prompt_tokens = getattr(tokens_used, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(tokens_used, 'completion_tokens', 0) or 0
+        self.tokens_used['prompt_cached_tokens'] += hit
+        self.tokens_used['prompt_miss_tokens'] += miss
+        self.tokens_used['prompt_tokens'] += prompt_tokens
+        self.tokens_used['completion_tokens'] += completion_tokens
+
+        print(f"\nCurrent tokens used: [prompt_cached_tokens]: {hit}"
+              f" - [prompt_miss_tokens]: {miss}"
+              f" - [prompt_tokens]: {prompt_tokens}"
+              f" - [completion_tokens]: {completion_tokens}")
+        print(f"Total tokens used: [prompt_cached_tokens]: {self.tokens_used['prompt_cached_tokens']}"
+              f" - [prompt_miss_tokens]: {self.tokens_used['prompt_miss_tokens']}"
+              f" - [prompt_tokens]: {self.tokens_used['prompt_tokens']}"
+              f" - [completion_tokens]: {self.tokens_used['completion_tokens']}")
+        print(f"Prompt cache hit ratio: [session]: {self.cache_hit_ratio:.1%}"
+              f" - [global]: {self.llm.cache_hit_ratio:.1%}")
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """本会话的提示词缓存命中率（命中的token数 / 提示词token数）"""
+        total = self.tokens_used['prompt_cached_tokens'] + self.tokens_used['prompt_miss_tokens']
+        return self.tokens_used['prompt_cached_tokens'] / total if total else 0.0
+
     async def _process_tool_calls(self, tool_calls):
         """
-        处理工具调用
+        处理工具调用：同时执行相互独立的工具调用，按 tool_calls 的顺序将结果添加回历史记录
         """
-        for tool_call in tool_calls:
-            print(f"  - Calling tool: {tool_call.function.name}")
-            try:
-                # 使用MCP管理器执行调用
-                tool_result = await self.mcp_client.client.call_tool(
-                    tool_call.function.name,
-                    json.loads(tool_call.function.arguments)
-                )
-
-                print(f"✅ Tool call successful: {tool_call.function.name}, arguments: {tool_call.function.arguments},  Result: {tool_result.content[0].text}")
-
-                # 将工具调用的结果添加回历史记录
-                self.history.append({
-                    "role": "tool",
-                    "content": tool_result.content[0].text,
-                    "tool_call_id": tool_call.id
-                })
-            except Exception as e:
-                # 捕获异常并记录错误
-                error_message = f"工具调用失败: {tool_call.function.name}, 错误: {str(e)}"
-                print(f"❌ {error_message}")
-
-                # 将错误信息作为工具响应添加到历史记录中
-                self.history.append({
-                    "role": "tool",
-                    "content": error_message,
-                    "tool_call_id": tool_call.id
-                })
+        self.history.extend(await self.tool_executor.execute(tool_calls))
 
     async def prepare_tools(self):
         """
-        准备工具列表，将MCP客户端的工具转换为OpenAI API所需的格式
-        并根据白名单过滤工具
+        准备工具列表：使用共享的工具目录（已按白名单过滤并转换为OpenAI API所需的格式）
         """
-        tools = await self.mcp_client.client.list_tools()
-        # 根据白名单过滤
-        filtered_tools = [
-            tool for tool in tools if self._is_tool_allowed(tool.name)
-        ]
-        print(f"总工具数: {len(tools)}, 过滤后工具数: {len(filtered_tools)}")
-
-        structured_tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            }
-            for tool in filtered_tools
-        ]
-
-        for tool in filtered_tools:
-            print(f"tool: {tool}")
-
-        return structured_tools
-
-    def _load_tools_whitelist(self, whitelist_path):
-        """加载工具白名单配置文件"""
-        if not whitelist_path or not Path(whitelist_path).exists():
-            return None
-
-        with open(whitelist_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
-
-    def _is_tool_allowed(self, tool_name: str):
-        """检查工具是否在白名单中"""
-        if not self.tools_whitelist:
-            return True  # 如果没有白名单，则允许所有工具
-
-        # 提取服务器名称（工具名称格式为 "server-service_tool_name"）
-        #  根据第一个 '_' 来分割
-        server_name, function_name = tool_name.split('_', maxsplit=1)
-
-        # 检查服务器是否在白名单中且已启用
-        if (server_name in self.tools_whitelist.get('mcp_servers', {}) and
-                self.tools_whitelist['mcp_servers'][server_name].get('enabled', False)):
-
-            # 如果允许所有
-            if self.tools_whitelist['mcp_servers'][server_name].get('allow_all', False):
-                return True
-
-            # 检查具体工具是否在白名单中
-            allowed_tools = self.tools_whitelist['mcp_servers'][server_name].get('tools', [])
-            return function_name in allowed_tools
-
-        return False
+        return await self.tool_catalog.get_tools()
 
     async def loop(self, use_stream=False):
         """
@@ -281,7 +227,7 @@ class ChatHandler:
             use_stream: 是否使用流式输出
         """
         while True:
-            user_input = input("You: ")
+            user_input = await asyncio.to_thread(input, "You: ")
             if user_input.lower() in ["exit", "quit"]:
                 print("Exiting chat...")
                 break
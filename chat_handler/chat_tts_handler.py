@@ -1,47 +1,70 @@
-import json
 import yaml
-from pathlib import Path
-import threading
-import queue
 import re
 from typing import List
 import asyncio
+import time
+from contextlib import asynccontextmanager
 from my_tts.audio_player import AudioPlayer
 from my_asr.audio_record import AudioRecord
 from chat_handler.chat_context_manager import ChatContextManager
+from chat_handler.session_store import message_to_dict, drop_dangling_tool_calls
+from my_mcp.tool_catalog import ToolCatalog
+from my_llm.openai_engine import prompt_cache_usage
+from my_mcp.tool_executor import ToolExecutor
+from my_metrics.metrics import observe_stage, stage_timer
 
 
 class ChatTTSHandler:
     def __init__(self, openai_engine, mcp_client, tts_engine, asr_engine,
-                 whitelist_path=None, max_context_tokens=64000, system_role="ai_assistant"):
+                 whitelist_path=None, max_context_tokens=64000, system_role="ai_assistant",
+                 session_id=None, turn_semaphore=None, queue_size=32,
+                 tts_concurrency=2, tts_global_semaphore=None, tts_lookahead=4, tts_streaming=True,
+                 response_cache=None, tool_cache=None, tool_catalog=None, device_id=None, session_store=None):
+        # 会话标识（多设备同时连接时区分不同的会话）
+        self.session_id = session_id
+        # 设备ID和会话存储：每轮对话结束后保存会话状态，设备重新连接时恢复（None表示不保存）
+        self.device_id = device_id
+        self.session_store = session_store
+        # 多个会话共享的对话并发限制（由SessionManager提供，None表示不限制）
+        self.turn_semaphore = turn_semaphore
+
         # LLM相关组件
         self.llm = openai_engine
         self.mcp_client = mcp_client
         self.system_role = system_role
+        # 所有会话共享的LLM回复缓存（None表示不使用）
+        self.response_cache = response_cache
 
         # TTS相关组件
         self.tts_engine = tts_engine
         self.audio_player = AudioPlayer()
+        # 本会话同时进行的TTS合成请求数量
+        self.tts_semaphore = asyncio.Semaphore(tts_concurrency)
+        # 所有会话共享的TTS合成并发限制（保护TTS后端，None表示不限制）
+        self.tts_global_semaphore = tts_global_semaphore
+        # 预先合成的句子数量上限（已开始合成但尚未发送的句子）
+        self.tts_lookahead = tts_lookahead
+        # 是否使用流式TTS（后端返回一块音频就立即发送一块）
+        self.tts_streaming = tts_streaming
 
         # ASR相关组件
         self.asr_engine = asr_engine
         self.audio_recorder = AudioRecord()
 
-        # 线程通信队列
-        #  用户输入input；llm读取input并输出到message；tts读取messages中的句子并转换为音频输出到audio
-        self.input_queue = queue.Queue()
-        self.message_queue = queue.Queue()
-        self.audio_queue = queue.Queue()
-
-        # 线程控制
-        self.llm_thread = None
-        self.audio_thread = None
-        self.should_stop = threading.Event()
+        # 流水线各阶段之间队列的容量
+        #  llm输出文本片段到message；分句后输出到sentence；tts将句子转换为音频输出到audio
+        self.queue_size = queue_size
+        # 当前对话轮次的流水线任务（用于停止时取消）
+        self.turn_tasks = []
 
         # 工具列表
         self.tools = None
+        # 工具目录（多个会话共享，由SessionManager提供；否则根据白名单配置创建）
+        self.tool_catalog = tool_catalog or ToolCatalog(mcp_client, whitelist_path)
         # 工具白名单配置
-        self.tools_whitelist = self._load_tools_whitelist(whitelist_path)
+        self.tools_whitelist = self.tool_catalog.tools_whitelist
+        # 工具执行器（并发执行工具调用，超时和缓存配置来自白名单；工具结果缓存由所有会话共享）
+        self.tool_executor = ToolExecutor(mcp_client, self.tools_whitelist, result_cache=tool_cache)
         
         # 上下文
         self.history = []
@@ -58,6 +81,27 @@ class ChatTTSHandler:
 
         # websocket：用于发送音频到客户端
         self.websocket = None
+        # 音频输出队列（全双工连接的下行队列，由连接的发送任务发送），None表示直接通过websocket发送
+        #  元素为 ("sentence", (轮次编号, 句子))（句子的第一块音频之前）、("audio", 音频数据)、("end", None)（句子结束）
+        self.audio_output = None
+
+        # 当前对话轮次的计时（time.perf_counter）：轮次开始的时间、用户说完话的时间（语音输入时），是否已发送第一块音频
+        self._turn_started_at = None
+        self._speech_end_at = None
+        self._first_audio_pending = False
+        # 对话轮次的编号：全双工连接的发送任务报告已发送的句子时，用于忽略之前轮次的句子
+        self._turn_id = 0
+
+        # 打断（barge-in）：用户在回复播放时开始说话，取消本轮对话剩余的LLM、TTS和待发送的音频
+        #  本轮是否已被打断、本轮的用户消息、正在流式接收的回复文本（已添加到历史记录后为None）、
+        #  已开始发送音频的句子的字符数（不计空白字符），打断后历史记录中只保留这部分回复
+        self._interrupted = False
+        self._turn_user_message = None
+        self._partial_reply = None
+        self._delivered_chars = 0
+        # 全双工连接：本轮各句子在设备上开始播放的估算时间和字符数 [(time.perf_counter, 字符数)]，
+        #  打断时只保留用户已经开始听到的句子（发送不按实时节奏，已发送的音频可能还在设备的缓冲中）
+        self._sentence_plays = []
 
     # 在 ChatHandler 类中更新 initialize 方法
     async def initialize(self, system_role_path=None):
@@ -105,90 +149,100 @@ class ChatTTSHandler:
 
         return sentences, remaining
 
-    # llm线程-------------------------------------------------------------------------------------------
-    async def llm_worker(self):
+    # LLM阶段-------------------------------------------------------------------------------------------
+    async def llm_worker(self, user_input: str, message_queue: asyncio.Queue):
         """
-        LLM处理线程的工作函数
+        LLM阶段：处理一轮用户输入，将流式回复的文本片段放入 message_queue，结束时放入 None（只放入一次）
         """
-        print("[LLM Thread] 启动")
-        while not self.should_stop.is_set():
-            try:
-                # 非阻塞获取输入，超时后继续循环检查 should_stop 标志
-                user_input = self.input_queue.get(timeout=0.5)
-
-                # 将用户输入添加到历史记录
-                self.history.append({"role": "user", "content": user_input})
-
-                # llm循环处理当前输入，直到没有工具调用为止
-                while True:
-                    # 调用LLM API
-                    response_message, finish_reason, tokens_used = await self._call_llm_stream()
-
-                    # 更新token计数器
-                    if tokens_used:
-                        self.message_tokens = getattr(tokens_used, 'prompt_tokens', 0)
-                        self.tokens_used['prompt_cached_tokens'] += getattr(tokens_used, 'prompt_cache_hit_tokens', 0)
-                        self.tokens_used['prompt_miss_tokens'] += getattr(tokens_used, 'prompt_cache_miss_tokens', 0)
-                        self.tokens_used['prompt_tokens'] += getattr(tokens_used, 'prompt_tokens', 0)
-                        self.tokens_used['completion_tokens'] += getattr(tokens_used, 'completion_tokens', 0)
-
-                    # 输出token统计信息
-                    if tokens_used:
-                        print(
-                            f"\nCurrent tokens used: [prompt_cached_tokens]: {getattr(tokens_used, 'prompt_cache_hit_tokens', 0)}"
-                            f" - [prompt_miss_tokens]: {getattr(tokens_used, 'prompt_cache_miss_tokens', 0)}"
-                            f" - [prompt_tokens]: {getattr(tokens_used, 'prompt_tokens', 0)}"
-                            f" - [completion_tokens]: {getattr(tokens_used, 'completion_tokens', 0)}")
-                        print(f"Total tokens used: [prompt_cached_tokens]: {self.tokens_used['prompt_cached_tokens']}"
-                              f" - [prompt_miss_tokens]: {self.tokens_used['prompt_miss_tokens']}"
-                              f" - [prompt_tokens]: {self.tokens_used['prompt_tokens']}"
-                              f" - [completion_tokens]: {self.tokens_used['completion_tokens']}")
-
-                    # 3.1 如果LLM没有工具调用，标记当前对话消息流完成，并且精简消息
-                    if finish_reason != "tool_calls":
-                        self.history.append({
-                            "role": "assistant",
-                            "content": response_message.content,
-                        })
-
-                        # 标记消息流已完成（主线程就会结束此轮对话）
-                        self.message_queue.put(None)
-                        # 标记输入队列任务完成
-                        self.input_queue.task_done()
-
-                        # 精简消息
-                        self.history = await self.context_manager.manage_context(self.history, self.message_tokens)
-                        break
-
-                    # 3.2 否则，LLM请求工具调用
-                    print("🤖 LLM requested tool calls...")
-                    # i. 将LLM的回复添加到历史记录
+        # 是否已经放入结束标记：之后出错（如写入回复缓存失败）只记录错误，不再向后续阶段发送内容
+        sent_end = False
+        try:
+            # 对话轮次之间：替换后台已完成的精简结果（一轮对话中历史记录的前缀保持不变，便于命中提示词缓存）
+            self.context_manager.apply_summary(self.history)
+
+            # 回复缓存：相同的输入（以及相同的最近对话）直接使用缓存的回复，像流式回复一样交给后续阶段
+            cache_key = None
+            if self.response_cache:
+                cache_key = self.response_cache.make_key(self.llm.model, self.history, user_input)
+                cached_reply = self.response_cache.get(cache_key)
+                if cached_reply is not None:
+                    self._turn_user_message = {"role": "user", "content": user_input}
+                    self.history.append(self._turn_user_message)
+                    self.history.append({"role": "assistant", "content": cached_reply})
+                    await message_queue.put(cached_reply)
+                    await message_queue.put(None)
+                    sent_end = True
+                    return
+
+            # 将用户输入添加到历史记录
+            self._turn_user_message = {"role": "user", "content": user_input}
+            self.history.append(self._turn_user_message)
+            # 本轮是否调用过工具（调用过工具的回复依赖工具结果，不能缓存）
+            used_tools = False
+
+            # llm循环处理当前输入，直到没有工具调用为止
+            while True:
+                # 调用LLM API
+                # 请求之前在本地估算token数，必要时提前精简或裁剪上下文
+                self.context_manager.prepare_request(self.history, self.tool_catalog.tools_json)
+                response_message, finish_reason, tokens_used = await self._call_llm_stream(message_queue)
+                self._partial_reply = None
+
+                # 更新token计数器
+                if tokens_used:
+                    self.message_tokens = getattr(tokens_used, 'prompt_tokens', 0)
+                    self.context_manager.calibrate(self.message_tokens)
+                    self._record_tokens(tokens_used)
+
+                # 3.1 如果LLM没有工具调用，标记当前对话消息流完成，并且精简消息
+                if finish_reason != "tool_calls":
                     self.history.append({
                         "role": "assistant",
                         "content": response_message.content,
-                        # 这里一定要有 tool_calls 字段，里面包含了LLM请求的所有工具调用的详细信息，
-                        #  否则下面调用完工具放入message 的tool字段中会出错
-                        "tool_calls": response_message.tool_calls
                     })
 
-                    # ii. 执行所有工具调用
-                    await self._process_tool_calls(response_message.tool_calls)
+                    # 标记消息流已完成（后续阶段处理完剩余内容后结束此轮对话）
+                    await message_queue.put(None)
+                    sent_end = True
+
+                    # 缓存正常结束且没有调用工具的回复
+                    if cache_key and not used_tools and finish_reason == "stop":
+                        self.response_cache.put(cache_key, response_message.content)
+                    break
+
+                # 3.2 否则，LLM请求工具调用
+                print("🤖 LLM requested tool calls...")
+                # i. 将LLM的回复添加到历史记录
+                self.history.append({
+                    "role": "assistant",
+                    "content": response_message.content,
+                    # 这里一定要有 tool_calls 字段，里面包含了LLM请求的所有工具调用的详细信息，
+                    #  否则下面调用完工具放入message 的tool字段中会出错
+                    "tool_calls": response_message.tool_calls
+                })
 
-                    # 带着工具调用的结果再次请求LLM进行总结，循环继续
-                    print("🔄 Sending tool results back to LLM for final response...")
+                # ii. 执行所有工具调用
+                used_tools = True
+                await self._process_tool_calls(response_message.tool_calls)
 
-            except queue.Empty:
-                # 队列为空，继续循环
-                continue
-            except Exception as e:
-                print(f"[LLM Thread] 错误: {e}")
-                self.message_queue.put(f"处理错误: {str(e)}")
-                self.message_queue.put(None)  # 标记完成
-                self.input_queue.task_done()
+                # 带着工具调用的结果再次请求LLM进行总结，循环继续
+                print("🔄 Sending tool results back to LLM for final response...")
 
-        print("[LLM Thread] 关闭")
+        except asyncio.CancelledError:
+            # 本轮对话被取消（打断或会话停止）：后续阶段同时被取消，不需要结束标记
+            sent_end = True
+            raise
+        except Exception as e:
+            if sent_end:
+                print(f"[LLM Stage] 回复结束之后出错: {e}")
+            else:
+                print(f"[LLM Stage] 错误: {e}")
+                await message_queue.put(f"处理错误: {str(e)}")
+        finally:
+            if not sent_end:
+                await message_queue.put(None)  # 标记完成
 
-    async def _call_llm_stream(self):
+    async def _call_llm_stream(self, message_queue: asyncio.Queue):
         """
         调用LLM API的流式方式
         """
@@ -196,23 +250,22 @@ class ChatTTSHandler:
 
         # 用于累积完整响应
         response_content = ""
+        self._partial_reply = ""
         tool_calls = []
         finish_reason = None
         tokens_used = None
 
-        # 处理流式响应（不需要print输出，主线程会输出）
-        # print("LLM: ", end="", flush=True)
-        for chunk in stream:
+        # 处理流式响应（不需要print输出，句子阶段会输出）
+        async for chunk in stream:
             if chunk.choices and chunk.choices[0].delta:
                 delta = chunk.choices[0].delta
 
                 # 收集内容片段
                 if delta.content:
                     response_content += delta.content
-                    # 流式输出
-                    # print(delta.content, end="", flush=True)
-                    # 同时还将内容片段放入到消息队列
-                    self.message_queue.put(delta.content)
+                    self._partial_reply = response_content
+                    # 同时还将内容片段放入到消息队列（队列满时等待下游消费，形成背压）
+                    await message_queue.put(delta.content)
 
                 # 收集工具调用信息
                 if delta.tool_calls:
@@ -234,9 +287,10 @@ class ChatTTSHandler:
             # 检查完成原因
             if chunk.choices and chunk.choices[0].finish_reason:
                 finish_reason = chunk.choices[0].finish_reason
-                tokens_used = chunk.usage
 
-        # print()  # 换行
+            # token使用情况（可能在最后一个不包含choices的片段中返回）
+            if getattr(chunk, 'usage', None):
+                tokens_used = chunk.usage
 
         # 构造响应消息
         response_message = type('obj', (object,), {
@@ -246,67 +300,190 @@ class ChatTTSHandler:
 
         return response_message, finish_reason, tokens_used
 
+    def _record_tokens(self, tokens_used):
+        """累计本会话的token使用情况，输出本次请求、本会话的token数以及提示词缓存命中率（本会话和全局）"""
+        hit, miss = prompt_cache_usage(tokens_used)
+        prompt_tokens = getattr(tokens_used, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(tokens_used, 'completion_tokens', 0) or 0
+        self.tokens_used['prompt_cached_tokens'] += hit
+        self.tokens_used['prompt_miss_tokens'] += miss
+        self.tokens_used['prompt_tokens'] += prompt_tokens
+        self.tokens_used['completion_tokens'] += completion_tokens
+
+        print(f"\nCurrent tokens used: [prompt_cached_tokens]: {hit}"
+              f" - [prompt_miss_tokens]: {miss}"
+              f" - [prompt_tokens]: {prompt_tokens}"
+              f" - [completion_tokens]: {completion_tokens}")
+        print(f"Total tokens used: [prompt_cached_tokens]: {self.tokens_used['prompt_cached_tokens']}"
+              f" - [prompt_miss_tokens]: {self.tokens_used['prompt_miss_tokens']}"
+              f" - [prompt_tokens]: {self.tokens_used['prompt_tokens']}"
+              f" - [completion_tokens]: {self.tokens_used['completion_tokens']}")
+        print(f"Prompt cache hit ratio: [session]: {self.cache_hit_ratio:.1%}"
+              f" - [global]: {self.llm.cache_hit_ratio:.1%}")
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """本会话的提示词缓存命中率（命中的token数 / 提示词token数）"""
+        total = self.tokens_used['prompt_cached_tokens'] + self.tokens_used['prompt_miss_tokens']
+        return self.tokens_used['prompt_cached_tokens'] / total if total else 0.0
+
+    # 分句阶段------------------------------------------------------------------------------------------
+    async def sentence_worker(self, message_queue: asyncio.Queue, sentence_queue: asyncio.Queue):
+        """
+        分句阶段：从 message_queue 读取LLM的文本片段，拼接成完整的句子放入 sentence_queue
+        """
+        message_buffer = ""
+        first_sentence = True
+
+        while True:
+            chunk = await message_queue.get()
+
+            # 如果收到None，表示流结束：处理最后剩余的文本
+            if chunk is None:
+                if message_buffer:
+                    await sentence_queue.put(message_buffer)
+                await sentence_queue.put(None)
+                break
+
+            # 累积消息（命令行输出）
+            message_buffer += chunk
+            print(chunk, end="", flush=True)
+
+            # 尝试拆分句子，完整的句子交给TTS阶段，保存剩余的不完整句子
+            sentences, message_buffer = self.split_sentences(message_buffer)
+            if sentences and first_sentence:
+                first_sentence = False
+                observe_stage("first_sentence", time.perf_counter() - self._turn_started_at, self.llm.provider)
+            for sentence in sentences:
+                await sentence_queue.put(sentence)
 
-    # 音频播放线程--------------------------------------------------------------------------------------
-    async def audio_worker(self):
+    # TTS阶段-------------------------------------------------------------------------------------------
+    async def tts_worker(self, sentence_queue: asyncio.Queue, audio_queue: asyncio.Queue):
         """
-        音频播放线程的工作函数
-        如果对话不停止，该线程一直存在，即一直处理对话
+        TTS阶段：为 sentence_queue 中的每个句子启动合成任务（不等待合成完成），按句子顺序放入 audio_queue
+        后面句子的合成与前面句子的发送/播放同时进行；audio_queue 的容量限制了预先合成的句子数量
+        audio_queue 中的元素为 (句子, 合成任务, 音频块队列)
         """
-        print("[Audio Thread] 启动")
-        while not self.should_stop.is_set():
+        while True:
+            sentence = await sentence_queue.get()
+            if sentence is None:
+                await audio_queue.put(None)
+                break
+
+            chunk_queue = asyncio.Queue()
+            task = asyncio.create_task(self._synthesize(sentence, chunk_queue))
             try:
-                # 非阻塞获取音频数据
-                audio_data = self.audio_queue.get(timeout=0.5)
+                await audio_queue.put((sentence, task, chunk_queue))
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
 
-                # 播放音频
-                self.audio_player.play_audio(audio_data)
+    @asynccontextmanager
+    async def _tts_slot(self):
+        """
+        占用一个TTS合成名额：先占用会话的名额，再占用全局名额
+        """
+        async with self.tts_semaphore:
+            if not self.tts_global_semaphore:
+                yield
+            else:
+                async with self.tts_global_semaphore:
+                    yield
 
-                # 标记音频队列任务完成
-                self.audio_queue.task_done()
-            except queue.Empty:
-                # 队列为空，继续循环
-                continue
-            except Exception as e:
-                print(f"[Audio Thread] 错误: {e}")
+    async def _synthesize(self, sentence: str, chunk_queue: asyncio.Queue):
+        """
+        合成单个句子的音频，将音频数据依次放入 chunk_queue，结束时放入 None
+        流式模式下后端每返回一块音频就放入一块；否则整句合成完成后放入一次
+        """
+        try:
+            async with self._tts_slot():
+                if self.tts_streaming:
+                    async for chunk in self.tts_engine.text_to_speech_stream(sentence):
+                        chunk_queue.put_nowait(chunk)
+                else:
+                    chunk_queue.put_nowait(await self.tts_engine.text_to_speech(sentence))
+        finally:
+            chunk_queue.put_nowait(None)
 
-        print("[Audio Thread] 关闭")
+    # 发送阶段------------------------------------------------------------------------------------------
+    async def send_worker(self, audio_queue: asyncio.Queue):
+        """
+        发送阶段：按句子顺序读取合成任务的音频块，收到后立即发送给客户端（或整句合成完后本地播放）
+        开始发送一个句子的音频时，该句子计入已发送的回复（被打断时历史记录只保留这部分）；
+        全双工连接的音频只是放入下行队列，由发送任务实际发送时报告（on_sentence_sent）
+        """
+        task = None
+        try:
+            while True:
+                entry = await audio_queue.get()
+                if entry is None:
+                    break
 
+                sentence, task, chunk_queue = entry
+                sentence_chunks = []
+                delivered = False
+                while True:
+                    chunk = await chunk_queue.get()
+                    if chunk is None:
+                        break
+                    if not delivered:
+                        delivered = True
+                        if self.audio_output is not None:
+                            await self.audio_output.put(("sentence", (self._turn_id, sentence)))
+                        else:
+                            self._delivered_chars += len("".join(sentence.split()))
+                    if self.websocket:
+                        await self._handle_audio_data(chunk)
+                    else:
+                        sentence_chunks.append(chunk)
+
+                # 全双工连接：句子的音频结束，发送任务输出编码器中不足一帧的剩余音频
+                if delivered and self.audio_output is not None:
+                    await self.audio_output.put(("end", None))
+
+                try:
+                    await task
+                except Exception as e:
+                    # 单个句子合成失败不影响后续句子
+                    print(f"\n[TTS Stage] 合成失败: {e}")
+                    continue
+
+                # 本地播放需要完整的音频
+                if sentence_chunks:
+                    await self._handle_audio_data(b"".join(sentence_chunks))
+        finally:
+            # 对话被取消或出错时，取消正在发送的和尚未发送的合成任务，释放TTS后端
+            if task and not task.done():
+                task.cancel()
+            while not audio_queue.empty():
+                entry = audio_queue.get_nowait()
+                if entry is not None:
+                    entry[1].cancel()
 
     async def start(self, system_role_path=None, websocket=None):
-        """启动处理器，初始化并创建工作线程"""
+        """启动处理器并初始化"""
         # 设置websocket
         self.websocket = websocket
 
         # 初始化
         await self.initialize(system_role_path)
 
-        # 创建并启动线程
-        self.should_stop.clear()
-
-        # 创建LLM处理线程
-        self.llm_thread = threading.Thread(target=lambda: asyncio.run(self.llm_worker()))
-        self.llm_thread.daemon = True   # 守护线程：主线程退出时自动结束
-        self.llm_thread.start()
-
-        # 创建音频播放线程（如果没有websocket的话）；如果有websocket就会在直接将音频发送给客户端
-        if not self.websocket:
-            self.audio_thread = threading.Thread(target=lambda: asyncio.run(self.audio_worker()))
-            self.audio_thread.daemon = True  # 守护线程：主线程退出时自动结束
-            self.audio_thread.start()
-
         print("ChatHandler 已启动")
 
     async def stop(self):
-        """停止处理器和相关线程"""
-        self.should_stop.set()
-
-        # 等待线程结束
-        if self.llm_thread and self.llm_thread.is_alive():
-            self.llm_thread.join(timeout=5)
-
-        if self.audio_thread and self.audio_thread.is_alive():
-            self.audio_thread.join(timeout=5)
+        """
+        停止处理器，取消正在进行的对话
+        未完成的一轮对话和被打断时一样修正历史记录（之后会保存会话状态，不能留下没有结果的工具调用）
+        """
+        unfinished = bool(self.turn_tasks)
+        for task in self.turn_tasks:
+            task.cancel()
+        await asyncio.gather(*self.turn_tasks, return_exceptions=True)
+        self.turn_tasks = []
+        if unfinished:
+            self._keep_delivered_reply()
+        # 取消正在进行的上下文精简
+        await self.context_manager.close()
 
         print("ChatHandler 已停止")
 
@@ -314,84 +491,245 @@ class ChatTTSHandler:
     async def chat_with_tts(self, user_input: str):
         """
         对话的逻辑函数：
-        1.将用户输入放入输入队列
-        2.循环从消息队列读取LLM的流式回复（命令行输出 + 供音频输出）
-        3.构建完整的句子，将其转换为音频并放入音频队列，供音频播放线程处理；或者通过websocket发送给客户端
+        1.LLM阶段：将用户输入交给LLM，流式回复的文本片段放入消息队列
+        2.分句阶段：从消息队列读取文本片段（命令行输出），构建完整的句子
+        3.TTS阶段：将句子转换为音频（提前合成后续句子，受并发数量限制）
+        4.发送阶段：按句子顺序将音频通过websocket发送给客户端；或者在本地播放
+        各阶段是同一事件循环中的asyncio任务，通过有界的asyncio队列连接
         """
         if not self.tts_engine:
             raise ValueError("TTS模型未初始化")
 
-        print("LLM: ", end="", flush=True)
+        # 限制同时进行对话的会话数量
+        if self.turn_semaphore:
+            async with self.turn_semaphore:
+                await self._chat_with_tts(user_input)
+        else:
+            await self._chat_with_tts(user_input)
 
-        # 将用户输入放入输入队列
-        self.input_queue.put(user_input)
-
-        # 从消息队列读取LLM的流式回复
-        message_buffer = ""
-
-        while True:
-            try:
-                # 获取一个消息片段
-                chunk = self.message_queue.get(timeout=10)
-
-                # 如果收到None，表示流结束（当llm_worker在处理完此轮对话后会发送None）
-                if chunk is None:
-                    # 处理最后剩余的文本
-                    if message_buffer:
-                        audio_data = await self.tts_engine.text_to_speech(message_buffer)
-                        await self._handle_audio_data(audio_data)
-
-                    self.message_queue.task_done()
-                    break
-
-                # 累积消息
-                message_buffer += chunk
-                print(chunk, end="", flush=True)
-
-                # 尝试拆分句子
-                sentences, remaining = self.split_sentences(message_buffer)
-
-                # 处理完整的句子
-                if sentences:
-                    # 为每个完整的句子生成语音
-                    for sentence in sentences:
-                        audio_data = await self.tts_engine.text_to_speech(sentence)
-                        await self._handle_audio_data(audio_data)
-
-                # 保存剩余的不完整句子
-                message_buffer = remaining
-
-                self.message_queue.task_done()
-
-            except queue.Empty:
-                print("\n[警告] 等待LLM响应超时")
-                break
+    async def _chat_with_tts(self, user_input: str):
+        """
+        一轮对话的具体处理逻辑
+        """
+        print("LLM: ", end="", flush=True)
+        self._turn_started_at = time.perf_counter()
+        self._first_audio_pending = True
+        self._turn_id += 1
+        self._interrupted = False
+        self._turn_user_message = None
+        self._partial_reply = None
+        self._delivered_chars = 0
+        self._sentence_plays = []
+
+        # 各阶段之间的有界队列（队列满时上游等待，避免无限堆积）
+        message_queue = asyncio.Queue(maxsize=self.queue_size)
+        sentence_queue = asyncio.Queue(maxsize=self.queue_size)
+        audio_queue = asyncio.Queue(maxsize=self.tts_lookahead)
+
+        tasks = [
+            asyncio.create_task(self.llm_worker(user_input, message_queue)),
+            asyncio.create_task(self.sentence_worker(message_queue, sentence_queue)),
+            asyncio.create_task(self.tts_worker(sentence_queue, audio_queue)),
+            asyncio.create_task(self.send_worker(audio_queue)),
+        ]
+        self.turn_tasks = tasks
+        try:
+            # 等待各阶段结束（任意阶段出错时立即返回）；本轮对话自身被取消时 CancelledError 直接向上传递
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            # 本轮对话被取消（会话停止或被新的连接接管）：和被打断时一样修正历史记录
+            self._keep_delivered_reply()
+            raise
+        finally:
+            # 任意阶段出错或本轮被取消时，取消其余仍在等待队列的阶段
+            for task in tasks:
+                task.cancel()
+            self.turn_tasks = []
+
+        if self._interrupted:
+            # 被打断时各阶段已取消，只保留已发送的回复，然后照常结束本轮对话
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._keep_delivered_reply()
+        else:
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+            if any(task.cancelled() for task in done):
+                # 各阶段被 stop 取消（会话停止，历史记录已在 stop 中修正）
+                raise asyncio.CancelledError()
+
+        # 本轮对话结束后，在后台精简上下文（下一轮对话不需要等待精简完成）
+        self.history = await self.context_manager.manage_context(self.history, self.message_tokens)
+        # 保存会话状态（异步写入）
+        self.save_state()
 
         print()  # 换行，保持输出整洁
 
-        # 等待所有音频播放完毕（即使一直为空也能join）
-        self.audio_queue.join()
+    # 打断----------------------------------------------------------------------------------------------
+    def interrupt(self) -> bool:
+        """
+        打断正在进行的回复（用户开始说话时由VAD触发）：
+        关闭LLM的流式请求，取消正在进行和尚未开始的TTS合成，丢弃尚未发送的音频
+        只在回复阶段生效（ASR识别中或等待对话名额时不打断），返回是否打断了回复
+        设备上已经缓冲的音频由连接通知设备清空（见 DuplexVoiceSession）
+        """
+        if not self.turn_tasks or self._interrupted:
+            return False
+        self._interrupted = True
+        self._count_heard_chars()
+        print("\n✋ 用户开始说话，打断当前的回复")
+        for task in self.turn_tasks:
+            task.cancel()
+        return True
+
+    def _keep_delivered_reply(self):
+        """
+        回复被打断（或会话停止）后修正历史记录：本轮的回复只保留已发送音频的部分（按字符数截断，不计空白字符）
+        - 等待工具结果时被打断：去掉没有结果的工具调用请求，只保留其中已发送的文本
+        - 回复仍在流式接收时被打断：将已发送的部分作为本轮的回复
+        多次调用的结果相同
+        """
+        if self._turn_user_message is None:
+            return
+        start = next((i for i, message in enumerate(self.history) if message is self._turn_user_message), None)
+        if start is None:
+            return
+
+        # 工具调用请求之后还没有工具结果（工具结果是一次性添加的）
+        last = self.history[-1]
+        if last.get("role") == "assistant" and last.get("tool_calls"):
+            self.history[-1] = {"role": "assistant", "content": last.get("content") or ""}
+        elif self._partial_reply:
+            self.history.append({"role": "assistant", "content": self._partial_reply})
+        self._partial_reply = None
+
+        budget = self._delivered_chars
+        kept = self.history[:start + 1]
+        for message in self.history[start + 1:]:
+            if message.get("role") == "assistant":
+                if message.get("content"):
+                    message = dict(message, content=self._take_chars(message["content"], budget))
+                    budget -= len("".join(message["content"].split()))
+                # 没有发送任何内容的回复（且不是工具调用请求）不保留
+                if not message.get("content") and not message.get("tool_calls"):
+                    continue
+            kept.append(message)
+        self.history[:] = kept
+        print(f"\n✂️ 回复被打断，历史记录中保留已发送的 {self._delivered_chars} 个字符")
+
+    def truncate_played_reply(self) -> bool:
+        """
+        本轮对话已经结束、回复还在设备上播放时用户开始说话（由全双工连接调用）：
+        历史记录中本轮的回复只保留用户已经开始听到的句子，返回是否修正了历史记录
+        """
+        if self.turn_tasks or self._turn_user_message is None or not self._sentence_plays:
+            return False
+        print("\n✋ 用户开始说话，停止播放当前的回复")
+        self._count_heard_chars()
+        self._keep_delivered_reply()
+        # 同一轮的回复只修正一次
+        self._turn_user_message = None
+        self._sentence_plays = []
+        self.save_state()
+        return True
+
+    def _count_heard_chars(self):
+        """全双工连接：已发送的回复只计入此刻已经开始播放的句子"""
+        if self._sentence_plays:
+            now = time.perf_counter()
+            self._delivered_chars = sum(chars for play_at, chars in self._sentence_plays if play_at <= now)
+
+    def on_sentence_sent(self, turn_id: int, sentence: str, play_at: float = None):
+        """
+        全双工连接的发送任务开始发送一个句子的音频时调用：该句子计入已发送的回复，
+        本轮的第一个句子记录开始输出音频的延迟（下行队列中被丢弃的句子不会计入）
+        :param play_at: 估算的该句子在设备上开始播放的时间（time.perf_counter），None表示立即播放
+        """
+        # 打断之后才发送出去的音频会被设备清空，不计入
+        if turn_id != self._turn_id or self._interrupted:
+            return
+        chars = len("".join(sentence.split()))
+        self._delivered_chars += chars
+        self._sentence_plays.append((play_at or time.perf_counter(), chars))
+        self._observe_first_audio()
+
+    def _observe_first_audio(self):
+        """本轮对话的第一块音频：记录从轮次开始（以及从用户说完话）到开始输出音频的延迟"""
+        if self._first_audio_pending:
+            self._first_audio_pending = False
+            now = time.perf_counter()
+            observe_stage("first_audio", now - self._turn_started_at, self.llm.provider)
+            if self._speech_end_at is not None:
+                observe_stage("voice_to_voice", now - self._speech_end_at, self.llm.provider)
+
+    @staticmethod
+    def _take_chars(text: str, count: int) -> str:
+        """保留文本开头的 count 个非空白字符"""
+        if count <= 0:
+            return ""
+        for i, char in enumerate(text):
+            if not char.isspace():
+                count -= 1
+                if count == 0:
+                    return text[:i + 1]
+        return text
+
+    # 会话状态------------------------------------------------------------------------------------------
+    def get_state(self) -> dict:
+        """会话状态（对话历史、滚动摘要、token计数），可以JSON序列化"""
+        return {
+            "history": [message_to_dict(message) for message in self.history],
+            "summary": self.context_manager.summary,
+            "message_tokens": self.message_tokens,
+            "tokens_used": dict(self.tokens_used),
+        }
+
+    def restore_state(self, state: dict):
+        """
+        恢复会话状态（在 start 之后调用）
+        角色提示词使用当前的配置，其余的历史记录（摘要、对话）使用保存的状态
+        之前保存的状态中没有结果的工具调用请求会被去掉（LLM接口不接受）
+        """
+        history = drop_dangling_tool_calls(list(state.get("history") or []))
+        if history and self.history and history[0].get("role") == "system" == self.history[0].get("role"):
+            history[0] = self.history[0]
+        self.history = history
+        self.context_manager.restore(self.history, state.get("summary"))
+        self.message_tokens = state.get("message_tokens", 0)
+        self.tokens_used.update(state.get("tokens_used") or {})
+
+    def save_state(self):
+        """将会话状态交给会话存储（不等待写入完成）"""
+        if self.session_store and self.device_id:
+            self.session_store.save(self.device_id, self.get_state())
 
     async def _handle_audio_data(self, audio_data: bytes):
         """
-        处理音频数据，将其发送到WebSocket或放入音频队列
-        如果有WebSocket连接，则直接发送音频数据到客户端
-        否则，将音频数据放入音频队列供音频播放线程处理
+        处理音频数据，将其发送到WebSocket或在本地播放
+        全双工连接放入下行队列；如果有WebSocket连接，则直接发送音频数据到客户端
+        否则，在线程池中播放音频（播放是阻塞的，不能占用事件循环）
         """
         if audio_data:
+            if self.audio_output is not None:
+                # 全双工连接：放入下行队列（队列满时等待，形成背压），不在流水线中等待发送完成
+                #  开始输出音频的延迟在发送任务实际发送时记录
+                await self.audio_output.put(("audio", audio_data))
+                return
+
+            self._observe_first_audio()
             if self.websocket:
                 # 如果有WebSocket连接，直接发送音频数据
-                await self.websocket.send_bytes(audio_data)
+                with stage_timer("ws_send", "websocket"):
+                    await self.websocket.send_bytes(audio_data)
             else:
-                # 否则，将音频数据放入音频队列
-                self.audio_queue.put(audio_data)
+                await asyncio.to_thread(self.audio_player.play_audio, audio_data)
 
     # 交互式对话循环-----------------------------------------------------------------------------------
     async def interactive_loop_with_tts(self):
         """交互式对话循环，带TTS功能"""
         try:
             while True:
-                user_input = input("\nYou: ")
+                user_input = await asyncio.to_thread(input, "\nYou: ")
                 if user_input.lower() in ["exit", "quit"]:
                     print("退出对话...")
                     break
@@ -407,10 +745,11 @@ class ChatTTSHandler:
         """
         try:
             while True:
-                # 使用ASR录音并转换为文本
-                audio_file_path = self.audio_recorder.record_audio()
+                # 使用ASR录音并转换为文本（录音数据直接在内存中上传）
+                audio = self.audio_recorder.record_audio()
                 print("--start audio -> text--")
-                user_input = self.asr_engine.audio_to_text(audio_file_path)
+                user_input = await asyncio.to_thread(self.asr_engine.audio_to_text, audio,
+                                                     sample_rate=AudioRecord.SAMPLE_RATE)
                 print(f"\nYou: {user_input}")
                 # 下面操作对语音输入没用，对键盘输入有用
                 if user_input.lower() in ["exit", "quit"]:
@@ -418,22 +757,22 @@ class ChatTTSHandler:
                     break
 
                 await self.chat_with_tts(user_input)
-
-                # 需要清除临时文件
-                self.audio_recorder.cleanup()
         finally:
             await self.stop()
 
     # 交互式单次对话-----------------------------------------------------------------------------------
-    async def interactive_with_audio_input(self, audio_file_path: str):
+    async def interactive_with_audio_input(self, audio, sample_rate: int = None, speech_end_at: float = None):
         """
         单次交互式对话，带音频输入，用于和客户端交互
         最后不需要stop中止，而是等到websocket断开后才中止
         param:
-            audio_file_path: 音频文件路径
+            audio: 音频文件路径，或16bit单声道PCM字节/NumPy数组（直接在内存中处理，不写临时文件）
+            sample_rate: PCM音频的采样率
+            speech_end_at: VAD检测到语音结束的时间（time.perf_counter），用于统计语音到语音的延迟
         """
-        # 使用ASR将音频转换为文本
-        user_input = self.asr_engine.audio_to_text(audio_file_path)
+        self._speech_end_at = speech_end_at
+        # 使用ASR将音频转换为文本（ASR请求是阻塞的，放到线程中执行）
+        user_input = await asyncio.to_thread(self.asr_engine.audio_to_text, audio, sample_rate=sample_rate)
         print(f"\nYou: {user_input}")
 
         await self.chat_with_tts(user_input)
@@ -447,6 +786,7 @@ class ChatTTSHandler:
         """
         # 使用ASR将音频转换为文本
         print(f"\nYou: {input_text}")
+        self._speech_end_at = None
 
         await self.chat_with_tts(input_text)
 
@@ -457,93 +797,12 @@ class ChatTTSHandler:
     # 工具相关------------------------------------------------------------------------------------------
     async def prepare_tools(self):
         """
-        准备工具列表，将MCP客户端的工具转换为OpenAI API所需的格式
-        并根据白名单过滤工具
+        准备工具列表：使用共享的工具目录（已按白名单过滤并转换为OpenAI API所需的格式）
         """
-        tools = await self.mcp_client.client.list_tools()
-        # 根据白名单过滤
-        filtered_tools = [
-            tool for tool in tools if self._is_tool_allowed(tool.name)
-        ]
-        print(f"总工具数: {len(tools)}, 过滤后工具数: {len(filtered_tools)}")
-
-        structured_tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            }
-            for tool in filtered_tools
-        ]
-
-        for tool in filtered_tools:
-            print(f"tool: {tool}")
-
-        return structured_tools
-
-    def _load_tools_whitelist(self, whitelist_path):
-        """加载工具白名单配置文件"""
-        if not whitelist_path or not Path(whitelist_path).exists():
-            return None
-
-        with open(whitelist_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
-
-    def _is_tool_allowed(self, tool_name: str):
-        """检查工具是否在白名单中"""
-        if not self.tools_whitelist:
-            return True  # 如果没有白名单，则允许所有工具
-
-        # 提取服务器名称（工具名称格式为 "server-service_tool_name"）
-        #  根据第一个 '_' 来分割
-        server_name, function_name = tool_name.split('_', maxsplit=1)
-
-        # 检查服务器是否在白名单中且已启用
-        if (server_name in self.tools_whitelist.get('mcp_servers', {}) and
-                self.tools_whitelist['mcp_servers'][server_name].get('enabled', False)):
-
-            # 如果允许所有
-            if self.tools_whitelist['mcp_servers'][server_name].get('allow_all', False):
-                return True
-
-            # 检查具体工具是否在白名单中
-            allowed_tools = self.tools_whitelist['mcp_servers'][server_name].get('tools', [])
-            return function_name in allowed_tools
-
-        return False
+        return await self.tool_catalog.get_tools()
 
     async def _process_tool_calls(self, tool_calls):
         """
-        处理工具调用
+        处理工具调用：同时执行相互独立的工具调用，按 tool_calls 的顺序将结果添加回历史记录
         """
-        for tool_call in tool_calls:
-            print(f"  - Calling tool: {tool_call.function.name}")
-            try:
-                # 使用MCP管理器执行调用
-                tool_result = await self.mcp_client.client.call_tool(
-                    tool_call.function.name,
-                    json.loads(tool_call.function.arguments)
-                )
-
-                print(f"✅ Tool call successful: {tool_call.function.name}, arguments: {tool_call.function.arguments},  Result: {tool_result.content[0].text}")
-
-                # 将工具调用的结果添加回历史记录
-                self.history.append({
-                    "role": "tool",
-                    "content": tool_result.content[0].text,
-                    "tool_call_id": tool_call.id
-                })
-            except Exception as e:
-                # 捕获异常并记录错误
-                error_message = f"工具调用失败: {tool_call.function.name}, 错误: {str(e)}"
-                print(f"❌ {error_message}")
-
-                # 将错误信息作为工具响应添加到历史记录中
-                self.history.append({
-                    "role": "tool",
-                    "content": error_message,
-                    "tool_call_id": tool_call.id
-                })
+        self.history.extend(await self.tool_executor.execute(tool_calls))
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import time
+
+from my_codec.audio_codec import AudioCodec
+from my_metrics.metrics import stage_timer
+
+
+class DuplexVoiceSession:
+    """
+    全双工的语音对话连接：接收和发送在不同的任务中同时进行，互不等待
+    - 接收任务：持续读取设备上传的音频，解码、降噪后交给VAD；一句话结束后拷贝成bytes放入待处理队列，立即继续读取
+    - 对话任务：从待处理队列依次取出语音，执行ASR、LLM、TTS；回复的音频放入下行队列
+    - 发送任务：从下行队列读取音频，编码后发送给设备（发送慢时下行队列满，对话的流水线等待，接收不受影响）
+      回复被打断时，发送任务在丢弃未发送的音频之后向设备发送文本消息 {"type": "interrupt"}，设备收到后清空播放缓冲
+    三个任务通过会话内的事件和队列协作：
+      user_speaking / user_silent：用户正在说话（语音帧累计达到打断的阈值）/ 没有说话，用于打断正在播放的回复
+      play_end：估算的设备播放完已发送音频的时间；发送不按实时节奏，一轮对话结束后回复可能还要在设备上播放很久，
+        在此之前用户开始说话同样打断回复（停止设备的播放，历史记录只保留已经开始播放的句子）
+      closed：连接断开（或会话被同一设备的新连接接管，见 close）
+    """
+
+    def __init__(self, handler, websocket, vad, denoiser=None, barge_in=True, min_speech_ms=300,
+                 max_pending_utterances=2, downlink_queue_size=64, codec: AudioCodec = None):
+        """
+        :param handler: 会话的ChatTTSHandler
+        :param websocket: WebSocket连接
+        :param vad: 本连接的WebRTCVAD
+        :param denoiser: 本连接的流式降噪器（StreamDenoiser），None表示不降噪
+        :param barge_in: 是否允许打断正在播放的回复
+        :param min_speech_ms: 语音帧累计达到该时长（毫秒）才视为用户开始说话
+        :param max_pending_utterances: 等待处理的语音数量上限（超过时丢弃最早的）
+        :param downlink_queue_size: 下行队列中的音频块数量上限
+        :param codec: 本连接协商的编解码器（AudioCodec），None表示原有格式（pcm16）
+        """
+        self.handler = handler
+        self.websocket = websocket
+        self.vad = vad
+        self.denoiser = denoiser
+        self.barge_in = barge_in
+        self.min_speech_ms = min_speech_ms
+        self.codec = codec or AudioCodec()
+
+        # 待处理的语音：(PCM字节, 检测到语音结束的时间)
+        self.utterances = asyncio.Queue(maxsize=max_pending_utterances)
+        # 下行消息（对话任务写入，发送任务读取）：
+        #  ("sentence", (轮次编号, 句子))（句子的第一块音频之前）、("audio", 音频数据)、("end", None)（句子结束）、
+        #  ("interrupt", None)（回复被打断）
+        self.downlink = asyncio.Queue(maxsize=downlink_queue_size)
+
+        self.user_speaking = asyncio.Event()
+        self.user_silent = asyncio.Event()
+        self.user_silent.set()
+        self.closed = asyncio.Event()
+        # 设备播放完已发送音频的时间（估算，time.perf_counter）
+        self.play_end = 0.0
+        # run 结束时设置；close 时需要关闭连接的关闭码和原因
+        self._finished = asyncio.Event()
+        self._close_frame = None
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        """
+        停止会话（会话被同一设备的新连接接管时由SessionManager调用）：
+        结束 run（停止接收、对话和发送任务），关闭连接，等待 run 退出
+        """
+        self._close_frame = (code, reason)
+        self.closed.set()
+        await self._finished.wait()
+
+    async def run(self):
+        """运行到连接断开（或调用 close）为止"""
+        try:
+            await self._run()
+        finally:
+            self._finished.set()
+
+    async def _run(self):
+        # 回复的音频交给下行队列，由发送任务发送
+        self.handler.audio_output = self.downlink
+        tasks = [
+            asyncio.create_task(self._receive_loop()),
+            asyncio.create_task(self._turn_loop()),
+            asyncio.create_task(self._send_loop()),
+        ]
+        if self.barge_in:
+            tasks.append(asyncio.create_task(self._watch_barge_in()))
+        try:
+            await self.closed.wait()
+        finally:
+            self.closed.set()
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"❌ 会话 {self.handler.session_id} 的任务异常退出: {result}")
+            if self.handler.audio_output is self.downlink:
+                self.handler.audio_output = None
+            if self._close_frame:
+                try:
+                    await self.websocket.close(*self._close_frame)
+                except Exception as e:
+                    # 连接已经断开
+                    print(f"关闭连接失败: {type(e).__name__} {e}")
+
+    # 接收----------------------------------------------------------------------------------------------
+    async def _receive_loop(self):
+        """接收任务：VAD检测到一句话后放入待处理队列，不等待处理完成"""
+        try:
+            # 会话被同一设备的新连接接管后，旧的连接不再处理
+            while self.handler.websocket is self.websocket:
+                audio = await self.vad.detect_voice_from_ws(self.websocket, denoiser=self.denoiser,
+                                                            on_speech=self._on_speech,
+                                                            min_speech_ms=self.min_speech_ms,
+                                                            decoder=self.codec.decode)
+                self.user_speaking.clear()
+                self.user_silent.set()
+                if not audio:
+                    print("没有检测到语音活动，等待下一次输入...")
+                    continue
+
+                # VAD返回的视图在下一次检测时会被覆盖，拷贝一份交给对话任务
+                if self.utterances.full():
+                    self.utterances.get_nowait()
+                    print("⚠️ 待处理的语音过多，丢弃最早的一句")
+                self.utterances.put_nowait((bytes(audio), self.vad.speech_end_at))
+        except Exception as e:
+            # WebSocketDisconnect 等：连接断开
+            print(f"客户端断开连接: {type(e).__name__} {e}")
+        finally:
+            self.closed.set()
+
+    def _on_speech(self):
+        self.user_silent.clear()
+        self.user_speaking.set()
+
+    # 对话----------------------------------------------------------------------------------------------
+    async def _turn_loop(self):
+        """对话任务：依次处理待处理的语音"""
+        while True:
+            audio, speech_end_at = await self.utterances.get()
+            print("检测到语音活动，开始处理...")
+            # PCM数据直接交给handler处理（ASR在内存中生成wav，不写临时文件）
+            turn = asyncio.create_task(self.handler.interactive_with_audio_input(
+                audio, sample_rate=self.vad.sample_rate, speech_end_at=speech_end_at))
+            try:
+                await turn
+            except Exception as e:
+                # 单轮对话失败不影响后续的对话
+                print(f"❌ 对话处理失败: {e}")
+            finally:
+                if not turn.done():
+                    turn.cancel()
+                    # 等待本轮对话退出（修正历史记录），之后会话才能交给新的连接或保存
+                    await asyncio.gather(turn, return_exceptions=True)
+
+    async def _watch_barge_in(self):
+        """
+        打断任务：用户开始说话时打断正在进行的回复，丢弃下行队列中尚未发送的音频并通知设备停止播放
+        一轮对话已经结束、但设备还在播放回复（估算的播放结束时间之前）时同样停止播放，并修正历史记录
+        """
+        while True:
+            await self.user_speaking.wait()
+            interrupted = self.handler.interrupt()
+            if not interrupted and time.perf_counter() < self.play_end:
+                self.handler.truncate_played_reply()
+                interrupted = True
+            if interrupted:
+                self._drop_downlink()
+                # 通知设备清空已经缓冲、尚未播放的音频
+                self.downlink.put_nowait(("interrupt", None))
+            # 一句话只打断一次（回复还没有开始时，如ASR识别中，不打断）：等这句话结束后再继续监测
+            await self.user_silent.wait()
+
+    def _drop_downlink(self):
+        """丢弃下行队列中的消息：其中的句子还没有开始发送，不计入已发送的回复"""
+        dropped = 0
+        while not self.downlink.empty():
+            kind, _ = self.downlink.get_nowait()
+            if kind == "audio":
+                dropped += 1
+        if dropped:
+            print(f"🗑️ 丢弃尚未发送的 {dropped} 块音频")
+
+    # 发送----------------------------------------------------------------------------------------------
+    async def _send_loop(self):
+        """
+        发送任务：将下行队列中的音频编码后依次发送给设备
+        分帧的编解码器在线程池中编码；不足一帧的剩余音频留到下一块音频，只在句子结束时补齐静音发送
+        （下行队列暂时为空不代表音频结束，此时补静音会在句子中间产生杂音）
+        回复被打断时丢弃编码器中剩余的音频，并通知设备清空播放缓冲
+        一个句子的音频实际发送出去时，才向handler报告该句子已发送（计入已发送的回复，记录开始输出音频的延迟）
+        按设备收到后实时播放估算播放进度（play_end），用于回复播放期间的打断
+        """
+        # 已经开始、但还没有发送出任何音频的句子
+        sentence = None
+        try:
+            while True:
+                kind, audio_data = await self.downlink.get()
+                if kind == "sentence":
+                    sentence = audio_data
+                    continue
+                if kind == "interrupt":
+                    sentence = None
+                    self.play_end = 0.0
+                    self.codec.reset()
+                    await self.websocket.send_text(json.dumps({"type": "interrupt"}))
+                    continue
+                if kind == "end":
+                    messages = self.codec.flush()
+                elif self.codec.frame_ms:
+                    messages = await asyncio.to_thread(self.codec.encode, audio_data)
+                else:
+                    messages = self.codec.encode(audio_data)
+
+                # 每条消息的音频时长（无法解析时为0，不估算播放进度）
+                message_seconds = self.codec.encoded_seconds / len(messages) if messages else 0.0
+                for message in messages:
+                    with stage_timer("ws_send", "websocket"):
+                        await self.websocket.send_bytes(message)
+                    now = time.perf_counter()
+                    # 设备播放完之前的音频后（或者已经播放完时立即）开始播放这一条消息
+                    play_at = max(self.play_end, now)
+                    if message_seconds:
+                        self.play_end = play_at + message_seconds
+                    if sentence is not None:
+                        self.handler.on_sentence_sent(*sentence, play_at)
+                        sentence = None
+        except Exception as e:
+            print(f"发送音频失败，连接已断开: {e}")
+        finally:
+            self.closed.set()
@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+from chat_handler.chat_tts_handler import ChatTTSHandler
+from my_mcp.tool_catalog import ToolCatalog
+
+
+class SessionLimitError(Exception):
+    """当前连接的会话数量已达到上限"""
+
+
+class SessionManager:
+    """
+    会话管理器：一个进程服务多个客户端设备
+    - 重量级组件（LLM引擎、TTS引擎、ASR引擎、MCP客户端）在所有会话之间共享
+    - 每个WebSocket连接拥有独立的ChatTTSHandler（对话历史、队列、token计数）
+    - 带有设备ID的会话在断开后保存到会话存储，并在内存中保留一段时间（休眠）；
+      设备重新连接时优先使用内存中的会话，否则从会话存储中恢复，内存中的休眠会话数量有上限
+    """
+
+    def __init__(self, openai_engine, mcp_client, tts_engine, asr_engine,
+                 whitelist_path=None, system_role_path=None, max_context_tokens=64000,
+                 system_role="ai_assistant", max_sessions=500, max_active_sessions=32,
+                 tts_session_concurrency=2, tts_global_concurrency=8, tts_lookahead=4, tts_streaming=True,
+                 response_cache=None, tool_cache=None, tool_catalog=None,
+                 session_store=None, idle_timeout=300, max_idle_sessions=100):
+        """
+        参数:
+            openai_engine / mcp_client / tts_engine / asr_engine: 共享的引擎实例
+            whitelist_path: 工具白名单配置路径
+            system_role_path: 系统角色提示词配置路径
+            max_context_tokens: 模型的最大上下文长度
+            system_role: 系统角色
+            max_sessions: 同时保持连接的会话数量上限（包括空闲的设备）
+            max_active_sessions: 同时进行对话（LLM/TTS处理中）的会话数量上限
+            tts_session_concurrency: 每个会话同时进行的TTS合成请求数量
+            tts_global_concurrency: 所有会话同时进行的TTS合成请求数量
+            tts_lookahead: 每个会话预先合成的句子数量上限
+            tts_streaming: 是否使用流式TTS
+            response_cache: 所有会话共享的LLM回复缓存（ResponseCache），None表示不使用
+            tool_cache: 所有会话共享的工具结果缓存（ToolResultCache），None表示不使用
+            tool_catalog: 所有会话共享的工具目录（ToolCatalog），None表示根据 whitelist_path 创建
+            session_store: 按设备ID保存会话状态的存储（SessionStore），None表示不保存
+            idle_timeout: 断开连接的设备会话在内存中保留的时长（秒），之后只保存在会话存储中
+            max_idle_sessions: 内存中保留的断开连接的设备会话数量上限
+        """
+        self.llm = openai_engine
+        self.mcp_client = mcp_client
+        self.tts_engine = tts_engine
+        self.asr_engine = asr_engine
+
+        self.whitelist_path = whitelist_path
+        self.system_role_path = system_role_path
+        self.max_context_tokens = max_context_tokens
+        self.system_role = system_role
+
+        self.max_sessions = max_sessions
+        # 所有会话共享的对话并发限制：超过上限的对话轮次会排队等待
+        self.turn_semaphore = asyncio.Semaphore(max_active_sessions)
+        # 所有会话共享的TTS合成并发限制，保护CosyVoice/GPT-SoVITS后端
+        self.tts_global_semaphore = asyncio.Semaphore(tts_global_concurrency)
+        self.tts_session_concurrency = tts_session_concurrency
+        self.tts_lookahead = tts_lookahead
+        self.tts_streaming = tts_streaming
+        self.response_cache = response_cache
+        self.tool_cache = tool_cache
+        # 所有会话共享的工具目录：新的连接直接使用已有的工具列表
+        self.tool_catalog = tool_catalog or ToolCatalog(mcp_client, whitelist_path)
+
+        # 会话注册表：session_id -> ChatTTSHandler
+        self.sessions = {}
+        self._session_ids = itertools.count(1)
+
+        self.session_store = session_store
+        self.idle_timeout = idle_timeout
+        self.max_idle_sessions = max_idle_sessions
+        # 已连接的设备：device_id -> ChatTTSHandler
+        self.devices = {}
+        # 会话当前的连接：ChatTTSHandler -> (WebSocket连接, 处理该连接的会话对象（如DuplexVoiceSession），尚未登记时为None)
+        #  会话对象需要提供 close(code, reason)：停止处理并关闭连接，接管会话时用于停止旧的连接
+        self.connections = {}
+        # 断开连接、仍保留在内存中的设备会话：device_id -> (ChatTTSHandler, 断开的时间)，按断开的时间排序
+        self.idle_sessions = OrderedDict()
+
+    async def open_session(self, websocket=None, device_id=None) -> ChatTTSHandler:
+        """
+        为新的连接创建并启动一个会话
+        有设备ID时恢复该设备之前的会话（内存中的休眠会话或会话存储中的状态）；
+        同一个设备在旧连接断开之前重新连接时，新的连接接管原来的会话：
+          先停止处理旧连接的会话对象（接收、对话、发送）并关闭旧的连接，再把会话交给新的连接
+        处理该连接的会话对象创建后用 attach 登记
+        超过会话数量上限时抛出 SessionLimitError
+        """
+        self._evict_idle_sessions()
+
+        if device_id and device_id in self.devices:
+            handler = self.devices[device_id]
+            await self._take_over(handler, websocket)
+            print(f"[Session {handler.session_id}] 设备 {device_id} 重新连接，接管原来的会话")
+            return handler
+
+        if len(self.sessions) >= self.max_sessions:
+            raise SessionLimitError(f"会话数量已达到上限: {self.max_sessions}")
+
+        if device_id and device_id in self.idle_sessions:
+            handler, _ = self.idle_sessions.pop(device_id)
+            handler.websocket = websocket
+            self.connections[handler] = (websocket, None)
+            self.sessions[handler.session_id] = handler
+            self.devices[device_id] = handler
+            print(f"[Session {handler.session_id}] 设备 {device_id} 已恢复（内存），当前会话数: {len(self.sessions)}")
+            return handler
+
+        session_id = next(self._session_ids)
+        handler = ChatTTSHandler(self.llm, self.mcp_client, self.tts_engine, self.asr_engine,
+                                 whitelist_path=self.whitelist_path,
+                                 max_context_tokens=self.max_context_tokens,
+                                 system_role=self.system_role,
+                                 session_id=session_id,
+                                 turn_semaphore=self.turn_semaphore,
+                                 tts_concurrency=self.tts_session_concurrency,
+                                 tts_global_semaphore=self.tts_global_semaphore,
+                                 tts_lookahead=self.tts_lookahead,
+                                 tts_streaming=self.tts_streaming,
+                                 response_cache=self.response_cache,
+                                 tool_cache=self.tool_cache,
+                                 tool_catalog=self.tool_catalog,
+                                 device_id=device_id,
+                                 session_store=self.session_store if device_id else None)
+        # 先占位再启动，避免并发连接在 await 期间突破上限
+        self.sessions[session_id] = handler
+        self.connections[handler] = (websocket, None)
+        if device_id:
+            self.devices[device_id] = handler
+        try:
+            await handler.start(system_role_path=self.system_role_path, websocket=websocket)
+            # 从会话存储中恢复设备之前的会话
+            state = await self.session_store.load(device_id) if device_id and self.session_store else None
+            if state:
+                handler.restore_state(state)
+        except Exception:
+            self.sessions.pop(session_id, None)
+            self.connections.pop(handler, None)
+            if device_id:
+                self.devices.pop(device_id, None)
+            raise
+
+        if state:
+            print(f"[Session {session_id}] 设备 {device_id} 已恢复（会话存储，{len(handler.history)} 条消息），"
+                  f"当前会话数: {len(self.sessions)}")
+        else:
+            print(f"[Session {session_id}] 已创建，当前会话数: {len(self.sessions)}")
+        return handler
+
+    async def close_session(self, handler: ChatTTSHandler, websocket=None):
+        """
+        停止并注销会话；设备会话保存到会话存储，并在内存中休眠一段时间
+        :param websocket: 关闭的连接；会话已被同一设备的新连接接管时不做处理
+        """
+        connection = self.connections.get(handler)
+        if websocket is not None and (connection is None or connection[0] is not websocket):
+            return
+
+        try:
+            await handler.stop()
+        finally:
+            self.connections.pop(handler, None)
+            self.sessions.pop(handler.session_id, None)
+            device_id = handler.device_id
+            if device_id and self.devices.get(device_id) is handler:
+                del self.devices[device_id]
+                handler.websocket = None
+                handler.save_state()
+                self.idle_sessions[device_id] = (handler, time.monotonic())
+                self._evict_idle_sessions()
+            print(f"[Session {handler.session_id}] 已关闭，当前会话数: {len(self.sessions)}")
+
+    def attach(self, handler: ChatTTSHandler, websocket, connection) -> bool:
+        """
+        登记处理该连接的会话对象（被同一设备的新连接接管时调用其 close）
+        会话在此之前已被新的连接接管时返回False，此时不应再处理该连接
+        """
+        current = self.connections.get(handler)
+        if current is None or current[0] is not websocket:
+            return False
+        self.connections[handler] = (websocket, connection)
+        return True
+
+    async def _take_over(self, handler: ChatTTSHandler, websocket):
+        """
+        新的连接接管会话：停止处理旧连接的会话对象并等待其退出（由它关闭旧的连接），再把会话交给新的连接
+        先登记新的连接，旧连接退出时的 close_session 因此不会关闭（休眠）会话
+        不取消处理旧连接的任务（ASGI服务器的任务），旧的连接处理函数正常返回
+        """
+        old_websocket, old_connection = self.connections.get(handler, (handler.websocket, None))
+        self.connections[handler] = (websocket, None)
+
+        if old_connection is not None:
+            await old_connection.close(code=1000, reason="session taken over")
+        elif old_websocket is not None and old_websocket is not websocket:
+            # 旧的连接还没有开始处理（会话对象尚未登记）：直接关闭，之后它的 attach 返回False
+            try:
+                await old_websocket.close(code=1000, reason="session taken over")
+            except Exception as e:
+                # 旧的连接已经断开
+                print(f"[Session {handler.session_id}] 关闭旧的连接失败: {type(e).__name__} {e}")
+        # 停止仍在进行的对话
+        await handler.stop()
+        handler.websocket = websocket
+
+    def _evict_idle_sessions(self):
+        """将超过保留时长或超过数量上限的休眠会话移出内存（状态已经保存在会话存储中）"""
+        now = time.monotonic()
+        while self.idle_sessions:
+            device_id, (handler, closed_at) = next(iter(self.idle_sessions.items()))
+            if len(self.idle_sessions) <= self.max_idle_sessions and now - closed_at < self.idle_timeout:
+                break
+            del self.idle_sessions[device_id]
+
+    async def close_all(self):
+        """关闭所有会话（服务器退出时调用）"""
+        await asyncio.gather(*(self.close_session(handler) for handler in list(self.sessions.values())),
+                             return_exceptions=True)
+        self.idle_sessions.clear()
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def message_to_dict(message: dict) -> dict:
+    """
+    将历史记录中的消息转换为可以JSON序列化的字典
+    流式回复中的 tool_calls 是OpenAI SDK的对象，需要转换为字典（转换后仍然可以直接发送给LLM）
+    """
+    if not message.get("tool_calls"):
+        return dict(message)
+
+    tool_calls = []
+    for tool_call in message["tool_calls"]:
+        if not isinstance(tool_call, dict):
+            tool_call = {
+                "id": tool_call.id,
+                "type": tool_call.type or "function",
+                "function": {
+                    "name": tool_call.function.name,
+                    "arguments": tool_call.function.arguments or "",
+                },
+            }
+        tool_calls.append(tool_call)
+    return {**message, "tool_calls": tool_calls}
+
+
+def drop_dangling_tool_calls(history: list) -> list:
+    """
+    去掉没有全部工具结果的工具调用请求（只保留其中的文本），以及没有对应请求的工具结果
+    会话在工具调用期间停止时保存的历史记录可能是这样的，LLM接口不接受这样的历史记录
+    """
+    cleaned = []
+    i = 0
+    while i < len(history):
+        message = history[i]
+        i += 1
+        if message.get("role") == "tool":
+            # 没有对应请求的工具结果
+            continue
+        if message.get("role") != "assistant" or not message.get("tool_calls"):
+            cleaned.append(message)
+            continue
+
+        results = []
+        while i < len(history) and history[i].get("role") == "tool":
+            results.append(history[i])
+            i += 1
+        call_ids = {tool_call["id"] if isinstance(tool_call, dict) else tool_call.id
+                    for tool_call in message["tool_calls"]}
+        if call_ids <= {result.get("tool_call_id") for result in results}:
+            cleaned.append(message)
+            cleaned.extend(results)
+        elif message.get("content"):
+            cleaned.append({"role": "assistant", "content": message["content"]})
+    return cleaned
+
+
+class SessionStore:
+    """
+    按设备ID保存会话状态（对话历史、滚动摘要、token计数）的本地存储（SQLite）
+    - 写入是异步的：save 只记录最新的状态，由后台任务批量写入，同一设备多次保存只写入最后一次
+    - 所有数据库操作都在同一个专用线程中执行，不会阻塞事件循环
+    - 读取时优先使用尚未写入的状态，保证刚断开的设备重新连接时能读到最新的状态
+    """
+
+    def __init__(self, db_path="cache/sessions.db", flush_interval=1.0):
+        """
+        :param db_path: SQLite数据库文件路径
+        :param flush_interval: 后台写入的间隔（秒），间隔内的多次保存合并为一次写入
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+
+        # 等待写入的状态：device_id -> 状态
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._conn = None
+        self._task = None
+
+    async def start(self):
+        """打开数据库并启动后台写入任务"""
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._writer())
+        print(f"✅ 会话存储已打开: {self.db_path}")
+
+    async def close(self):
+        """写入所有尚未写入的状态，停止后台任务并关闭数据库"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def save(self, device_id: str, state: dict):
+        """保存设备的会话状态（不等待写入完成）"""
+        self._pending[device_id] = state
+        self._wakeup.set()
+
+    async def load(self, device_id: str):
+        """读取设备的会话状态，没有保存过时返回None"""
+        if device_id in self._pending:
+            return self._pending[device_id]
+        row = await self._run(self._select, device_id)
+        return json.loads(row) if row else None
+
+    async def flush(self):
+        """立即写入所有尚未写入的状态"""
+        if not self._pending or self._conn is None:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await self._run(self._write_batch, batch)
+        except Exception as e:
+            # 写入失败时放回队列，下次重试（期间又保存过的设备以新的状态为准）
+            self._pending = {**batch, **self._pending}
+            print(f"❌ 会话状态写入失败: {e}")
+
+    async def _writer(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.flush()
+            await asyncio.sleep(self.flush_interval)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # 以下方法在数据库线程中执行------------------------------------------------------------------------
+    def _open(self):
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " device_id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _select(self, device_id):
+        row = self._conn.execute("SELECT state FROM sessions WHERE device_id = ?", (device_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write_batch(self, batch: dict):
+        now = time.time()
+        rows = [(device_id, json.dumps(state, ensure_ascii=False), now) for device_id, state in batch.items()]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO sessions (device_id, state, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(device_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                rows,
+            )
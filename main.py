@@ -38,7 +38,7 @@ async def main():
     # 初始化ASR引擎
     asr_engine = SenseVoiceEngine(asr_config, asr_remote)
 
-    async with mcp_client.client:
+    async with mcp_client:
         # 创建聊天处理器实例
         chat_tts_handler = ChatTTSHandler(llm_engine, mcp_client, tts_engine, asr_engine,
                                           whitelist_path=config_file["config_paths"]["whitelist_path"],
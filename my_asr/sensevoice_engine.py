@@ -1,6 +1,12 @@
+import json
+import struct
+
+import numpy as np
 import requests
 from gradio_client import Client, handle_file
 
+from my_metrics.metrics import stage_timer
+
 class SenseVoiceEngine:
     def __init__(self, asr_config: dict, remote=True):
         # 是否使用远程调用
@@ -8,29 +14,76 @@ class SenseVoiceEngine:
         self.api_key = asr_config.get("api_key", "")
         self.base_url = asr_config.get("base_url", "")
         self.model = asr_config.get("model", "")
+        # PCM字节/NumPy数组输入时默认的采样率
+        self.sample_rate = asr_config.get("sample_rate", 16000)
+        # WebUI客户端（创建时会请求一次服务配置，复用避免每次识别都重新请求）
+        self._webui_client = None
 
-    def audio_to_text(self, file_path: str, file_lang: str="auto") -> str:
+    def audio_to_text(self, audio, file_lang: str="auto", sample_rate: int=None) -> str:
         """
-        将音频文件通过 API 调用得到文本结果
+        将音频通过 API 调用得到文本结果
+        :param audio: 音频文件路径、16bit单声道PCM字节，或NumPy数组（int16 / [-1, 1]的浮点数）
+        :param file_lang: 音频语言
+        :param sample_rate: PCM字节/NumPy数组的采样率，默认使用配置中的采样率
+        内存中的音频直接在内存中生成wav数据上传，不会写入磁盘
         """
+        wav_data = self._to_wav_bytes(audio, sample_rate or self.sample_rate)
+
+        # 记录识别请求的耗时（从发出请求到收到结果）
         if self.remote:
-            return self._remote_audio_to_text(file_path)
+            with stage_timer("asr", "sensevoice_remote"):
+                return self._remote_audio_to_text(wav_data)
         else:
             # 下面这个api调用会很慢，暂时找不到解决方法
-            # return self._local_audio_to_text(file_path, file_lang)
+            # return self._local_audio_to_text(wav_data, file_lang)
             # 而开启webui来调用api就很快
-            return self._local_audio_to_text_webui(file_path, file_lang)
+            with stage_timer("asr", "sensevoice_webui"):
+                return self._local_audio_to_text_webui(wav_data, file_lang)
+
+    @staticmethod
+    def _wav_header(data_size: int, sample_rate: int, channels: int = 1, sample_width: int = 2) -> bytes:
+        """
+        生成PCM格式的wav文件头（44字节）
+        """
+        byte_rate = sample_rate * channels * sample_width
+        block_align = channels * sample_width
+        return struct.pack("<4sI4s4sIHHIIHH4sI",
+                           b"RIFF", 36 + data_size, b"WAVE",
+                           b"fmt ", 16, 1, channels, sample_rate, byte_rate, block_align, sample_width * 8,
+                           b"data", data_size)
+
+    def _to_wav_bytes(self, audio, sample_rate: int) -> bytes:
+        """
+        将不同形式的音频输入转换为wav字节数据
+        """
+        # 音频文件：直接读取文件内容（读取后立即关闭文件）
+        if isinstance(audio, str):
+            with open(audio, "rb") as f:
+                return f.read()
+
+        channels = 1
+        if isinstance(audio, np.ndarray):
+            if audio.ndim == 2:
+                channels = audio.shape[1]
+            # 浮点数音频转换为16bit PCM
+            if np.issubdtype(audio.dtype, np.floating):
+                audio = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+            pcm = np.ascontiguousarray(audio, dtype=np.int16).tobytes()
+        else:
+            pcm = bytes(audio)
+
+        return self._wav_header(len(pcm), sample_rate, channels) + pcm
 
-    def _remote_audio_to_text(self, file_path: str) -> str:
+    def _remote_audio_to_text(self, wav_data: bytes) -> str:
         """
-        通过远程API将音频文件转换为文本
+        通过远程API将音频转换为文本
         """
         headers = {
             "Authorization": f"Bearer {self.api_key}",
         }
 
         files = {
-            "file": open(file_path, "rb"),
+            "file": ("audio.wav", wav_data, "audio/wav"),
         }
 
         data = {
@@ -45,9 +98,9 @@ class SenseVoiceEngine:
         else:
             raise Exception(f"❌ 出错：{response.status_code} {response.text}")
 
-    def _local_audio_to_text(self, file_path: str, file_lang: str) -> str:
+    def _local_audio_to_text(self, wav_data: bytes, file_lang: str) -> str:
         """
-        本地处理音频文件转换为文本
+        本地处理音频转换为文本
         """
         # Headers：期望收到json数据格式
         headers = {
@@ -56,8 +109,7 @@ class SenseVoiceEngine:
 
         # 上传文件（可以上传多个文件，需要按照下面格式）
         files = [
-            ("files", (file_path, open(file_path, "rb"), "audio/wav")),
-            # ("files", ("zero_shot_0.wav", open("zero_shot_0.wav", "rb"), "audio/wav"))
+            ("files", ("my_audio_file.wav", wav_data, "audio/wav")),
         ]
         data = {
             # 音频文件名，用逗号分开
@@ -78,17 +130,42 @@ class SenseVoiceEngine:
             print("响应内容:", response.text)
             return response.text
 
-    def _local_audio_to_text_webui(self, file_path: str, file_lang: str) -> str:
+    def _local_audio_to_text_webui(self, wav_data: bytes, file_lang: str) -> str:
         """
-        使用WebUI处理音频文件转换为文本
+        使用WebUI处理音频转换为文本
+        gradio_client 只能上传磁盘上的文件，这里直接调用WebUI的REST接口：
+        先上传内存中的wav数据，再调用 /model_inference 并读取SSE结果
         """
-        client = Client(self.base_url)
-        result = client.predict(
-            input_wav=handle_file(file_path),
-            language=file_lang,
-            api_name="/model_inference"
-        )
-        return result
+        if self._webui_client is None:
+            self._webui_client = Client(self.base_url)
+        client = self._webui_client
+
+        # 1.上传音频，得到服务端的文件路径
+        upload_response = requests.post(client.upload_url, headers=client.headers,
+                                        files=[("files", ("audio.wav", wav_data, "audio/wav"))])
+        upload_response.raise_for_status()
+        server_path = upload_response.json()[0]
+
+        # 2.提交识别任务
+        call_url = f"{client.src_prefixed}call/model_inference"
+        file_data = {"path": server_path, "orig_name": "audio.wav", "meta": {"_type": "gradio.FileData"}}
+        call_response = requests.post(call_url, headers=client.headers,
+                                      json={"data": [file_data, file_lang]})
+        call_response.raise_for_status()
+        event_id = call_response.json()["event_id"]
+
+        # 3.读取结果（SSE格式，complete事件的data为输出列表）
+        with requests.get(f"{call_url}/{event_id}", headers=client.headers, stream=True) as result_response:
+            event = None
+            for line in result_response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:") and event == "complete":
+                    return json.loads(line[len("data:"):])[0]
+                elif line.startswith("data:") and event == "error":
+                    raise Exception(f"❌ WebUI识别出错：{line[len('data:'):].strip()}")
+
+        raise Exception("❌ WebUI没有返回识别结果")
 
 
 if __name__ == "__main__":
@@ -101,4 +178,4 @@ if __name__ == "__main__":
         api_name="/model_inference"
     )
     print("end---")
-    print(result)
\ No newline at end of file
+    print(result)
@@ -0,0 +1,191 @@
+"""
+基准测试使用的本地替身后端（一个HTTP服务同时提供以下接口，结果是确定的，不需要联网）：
+- OpenAI兼容的对话接口 /v1/chat/completions：流式/非流式，可配置首token延迟、token速率、每隔几轮请求一次工具调用
+- CosyVoice（SiliconFlow）形式的TTS接口 /v1/audio/speech，以及GPT-SoVITS形式的 /tts：
+  返回合成的WAV音频（正弦波），按配置的实时率（RTF）流式返回
+- SenseVoice形式的ASR接口 /v1/audio/transcriptions：按音频时长和配置的实时率延迟后返回固定的文本
+
+用法：python -m my_benchmark.fake_backends --port 18080 --token-rate 50 --tts-rtf 0.2
+"""
+import argparse
+import asyncio
+import json
+import math
+import struct
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 回复中的句子（按轮次循环使用，保证每轮的回复是确定的）
+REPLY_SENTENCES = [
+    "好的，我来帮你看一下。",
+    "今天的天气晴朗，气温在二十度左右，适合出门散步。",
+    "如果你下午要出门，记得带上一瓶水。",
+    "还有什么需要我帮忙的吗？",
+]
+
+
+@dataclass
+class BackendSettings:
+    """替身后端的配置"""
+    # LLM：收到请求到返回第一个token的延迟（秒）、每秒输出的token数、每个token的字符数、每轮回复的句子数
+    first_token_delay: float = 0.3
+    token_rate: float = 50.0
+    chars_per_token: int = 2
+    reply_sentences: int = 3
+    # 每隔几轮用户输入请求一次工具调用（0表示不调用工具）和调用的工具名称
+    tool_call_every: int = 0
+    tool_name: str = "bench_lookup"
+    # TTS：合成的实时率（合成耗时 / 音频时长）、首个音频块的延迟（秒）、每个字符的音频时长（秒）、采样率、每块的音频时长（秒）
+    tts_rtf: float = 0.2
+    tts_first_chunk_delay: float = 0.1
+    tts_seconds_per_char: float = 0.2
+    tts_sample_rate: int = 24000
+    tts_chunk_seconds: float = 0.2
+    # ASR：固定延迟（秒）和识别的实时率，以及返回的文本
+    asr_delay: float = 0.05
+    asr_rtf: float = 0.05
+    asr_text: str = "今天天气怎么样？"
+
+
+def wav_header(data_size: int, sample_rate: int) -> bytes:
+    """16bit单声道PCM的wav文件头"""
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, 1,
+                       sample_rate, sample_rate * 2, 2, 16, b"data", data_size)
+
+
+def synth_pcm(seconds: float, sample_rate: int, frequency: float = 440.0) -> bytes:
+    """生成指定时长的正弦波PCM（16bit单声道）"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (np.sin(2 * math.pi * frequency * t) * 8000).astype(np.int16).tobytes()
+
+
+def create_app(settings: BackendSettings) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    # LLM----------------------------------------------------------------------------------------------
+    def build_reply(messages: list) -> str:
+        turn = sum(1 for message in messages if message.get("role") == "user")
+        sentences = [REPLY_SENTENCES[(turn + i) % len(REPLY_SENTENCES)] for i in range(settings.reply_sentences)]
+        # 工具调用之后的回复带上工具结果
+        if messages and messages[-1].get("role") == "tool":
+            sentences.insert(0, f"查询结果是{messages[-1].get('content')}。")
+        return "".join(sentences)
+
+    def wants_tool_call(messages: list, tools) -> bool:
+        if not tools or not settings.tool_call_every or not messages or messages[-1].get("role") != "user":
+            return False
+        turn = sum(1 for message in messages if message.get("role") == "user")
+        return turn % settings.tool_call_every == 0
+
+    def usage(messages: list, completion: str) -> dict:
+        prompt_tokens = sum(len(message.get("content") or "") for message in messages) // 2 + 1
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": len(completion) // settings.chars_per_token + 1,
+                "total_tokens": prompt_tokens + len(completion) // settings.chars_per_token + 1}
+
+    def chunk(model: str, delta: dict, finish_reason=None, usage_data=None) -> str:
+        data = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        if usage_data:
+            data["usage"] = usage_data
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "bench")
+        messages = body.get("messages", [])
+        tool_call = wants_tool_call(messages, body.get("tools"))
+        reply = "" if tool_call else build_reply(messages)
+        arguments = json.dumps({"query": messages[-1].get("content", "") if messages else ""}, ensure_ascii=False)
+
+        if not body.get("stream"):
+            await asyncio.sleep(settings.first_token_delay + len(reply) / settings.chars_per_token / settings.token_rate)
+            return JSONResponse({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                             "finish_reason": "stop"}],
+                "usage": usage(messages, reply),
+            })
+
+        async def stream():
+            await asyncio.sleep(settings.first_token_delay)
+            if tool_call:
+                yield chunk(model, {"role": "assistant", "content": None, "tool_calls": [
+                    {"index": 0, "id": "call_bench", "type": "function",
+                     "function": {"name": settings.tool_name, "arguments": arguments}}]})
+                yield chunk(model, {}, "tool_calls", usage(messages, arguments))
+            else:
+                interval = 1.0 / settings.token_rate
+                for i in range(0, len(reply), settings.chars_per_token):
+                    yield chunk(model, {"role": "assistant", "content": reply[i:i + settings.chars_per_token]})
+                    await asyncio.sleep(interval)
+                yield chunk(model, {}, "stop", usage(messages, reply))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # TTS----------------------------------------------------------------------------------------------
+    async def synth_stream(text: str):
+        seconds = max(len(text), 1) * settings.tts_seconds_per_char
+        pcm = synth_pcm(seconds, settings.tts_sample_rate)
+        chunk_bytes = int(settings.tts_chunk_seconds * settings.tts_sample_rate) * 2
+
+        await asyncio.sleep(settings.tts_first_chunk_delay)
+        yield wav_header(len(pcm), settings.tts_sample_rate)
+        for i in range(0, len(pcm), chunk_bytes):
+            part = pcm[i:i + chunk_bytes]
+            # 按实时率合成：每块音频的合成耗时 = 音频时长 * RTF
+            await asyncio.sleep(len(part) / 2 / settings.tts_sample_rate * settings.tts_rtf)
+            yield part
+
+    @app.post("/v1/audio/speech")
+    async def audio_speech(request: Request):
+        body = await request.json()
+        return StreamingResponse(synth_stream(body.get("input", "")), media_type="audio/wav")
+
+    @app.post("/tts")
+    async def gpt_sovits_tts(request: Request):
+        body = await request.json()
+        return StreamingResponse(synth_stream(body.get("text", "")), media_type="audio/wav")
+
+    @app.get("/set_gpt_weights")
+    @app.get("/set_sovits_weights")
+    async def set_weights():
+        return JSONResponse({"message": "success"})
+
+    # ASR----------------------------------------------------------------------------------------------
+    @app.post("/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        body = await request.body()
+        # 上传的是16kHz 16bit的wav（multipart中还有少量表单数据，不影响时长的估算）
+        audio_seconds = len(body) / 32000
+        await asyncio.sleep(settings.asr_delay + audio_seconds * settings.asr_rtf)
+        return JSONResponse({"text": settings.asr_text})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基准测试使用的本地替身后端（LLM/TTS/ASR）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    defaults = BackendSettings()
+    for name, value in vars(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+
+    settings = BackendSettings(**{name: getattr(args, name) for name in vars(defaults)})
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
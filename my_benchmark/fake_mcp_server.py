@@ -0,0 +1,25 @@
+"""
+基准测试使用的MCP服务器（stdio）：工具按固定的延迟返回确定的结果
+延迟通过环境变量 BENCH_TOOL_LATENCY（秒）配置
+"""
+import asyncio
+import os
+
+from fastmcp import FastMCP
+
+mcp = FastMCP(name="BenchServer")
+
+TOOL_LATENCY = float(os.environ.get("BENCH_TOOL_LATENCY", "0.1"))
+
+
+@mcp.tool()
+async def lookup(query: str = "") -> str:
+    """
+    Look up information for the query (benchmark stand-in, returns a fixed answer).
+    """
+    await asyncio.sleep(TOOL_LATENCY)
+    return f"晴，二十度（{len(query)}）"
+
+
+if __name__ == "__main__":
+    mcp.run()
@@ -0,0 +1,332 @@
+"""
+ESP32设备群的负载生成工具：同时打开N个WebSocket客户端连接ws_server，像设备固件一样按真实时间发送音频
+- 每条消息512个采样点（16kHz int16，1024字节），每32毫秒发送一条；说完一句话之后继续发送静音（麦克风一直在采集）
+- 语音对话端点（/ws_chat）：记录每一轮的语音到语音延迟（从说完话到收到第一块回复音频），回复结束后等待思考时间再说下一句
+- 接收端点（/ws）：只发送音频，用于测试服务器接收和降噪的容量
+- 发送跟不上时（服务器或网络阻塞）记录迟到的消息，积压超过设备缓冲时丢弃最旧的音频（与固件的环形缓冲一致）
+按会话数量逐级增加负载，输出容量曲线（会话数量 -> 语音到语音延迟的p50/p95/p99）
+
+用法（先启动 uvicorn ws_server:app）：
+    python -m my_benchmark.load_generator --url ws://127.0.0.1:8000 --sessions 1,2,4,8,16 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import wave
+
+import numpy as np
+import websockets
+import yaml
+
+SAMPLE_RATE = 16000
+# 每条消息的采样点数和字节数（与固件一致）
+FRAME_SAMPLES = 512
+FRAME_BYTES = FRAME_SAMPLES * 2
+FRAME_SECONDS = FRAME_SAMPLES / SAMPLE_RATE
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def synth_utterance(seconds: float, seed: int = 0) -> bytes:
+    """生成一段类似语音的测试音频（带谐波和音节起伏的浊音），可以被VAD识别为语音"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 20 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+    # 每秒约4个音节
+    envelope = 0.55 + 0.45 * np.sin(2 * np.pi * 4 * t) ** 2
+    signal = voiced * envelope + 0.02 * rng.standard_normal(len(t))
+    return (signal / np.max(np.abs(signal)) * 12000).astype(np.int16).tobytes()
+
+
+def load_utterances(paths: list, seconds: float) -> list:
+    """读取输入的语音（16kHz 16bit单声道的wav/pcm），没有指定时生成测试语音"""
+    if not paths:
+        return [synth_utterance(seconds, seed) for seed in range(4)]
+    utterances = []
+    for path in paths:
+        if path.endswith(".wav"):
+            with wave.open(path, "rb") as f:
+                if f.getframerate() != SAMPLE_RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+                    raise ValueError(f"需要16kHz 16bit单声道的音频: {path}")
+                utterances.append(f.readframes(f.getnframes()))
+        else:
+            with open(path, "rb") as f:
+                utterances.append(f.read())
+    return utterances
+
+
+class DeviceClient:
+    """
+    模拟一个设备：按真实时间发送音频帧，同时接收服务器返回的音频
+    发送和接收在两个任务中进行，发送不会等待回复
+    """
+
+    def __init__(self, client_id: int, url: str, utterances: list, args, rng: random.Random):
+        self.client_id = client_id
+        self.url = url
+        self.utterances = utterances
+        self.args = args
+        self.rng = rng
+        self.silence = bytes(FRAME_BYTES)
+
+        # 统计数据
+        self.latencies = []
+        self.turns = 0
+        self.timeouts = 0
+        self.frames_sent = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.max_send_lag = 0.0
+        self.response_stalls = 0
+        # 不属于当前这一轮的回复音频（上一轮超时后才到达的、说话期间收到的）
+        self.stale_chunks = 0
+        # 开始等待回复时上一轮的音频还在到达，无法区分是哪一轮的回复，不计入延迟
+        self.contaminated = 0
+        self.error = None
+
+        # 当前这一轮：说完话的时间、第一块回复音频的时间、最近一块回复音频的时间
+        self._speech_end_at = None
+        self._first_audio_at = None
+        self._last_audio_at = None
+        # 只有说完话之后、这一轮结束之前收到的音频才算作这一轮的回复
+        self._listening = False
+        self._last_stale_at = None
+
+    async def run(self, stop_at: float):
+        try:
+            async with websockets.connect(self.url, max_size=None, open_timeout=self.args.connect_timeout) as ws:
+                receiver = asyncio.create_task(self._receive(ws))
+                try:
+                    await self._send_loop(ws, stop_at)
+                finally:
+                    receiver.cancel()
+                    await asyncio.gather(receiver, return_exceptions=True)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+
+    async def _send_loop(self, ws, stop_at: float):
+        """按32毫秒一帧的节奏发送：语音 -> 静音（等待回复）-> 思考时间的静音 -> 下一句"""
+        loop = asyncio.get_running_loop()
+        # 错开各个设备的开始时间，避免所有设备同时说话
+        next_send = loop.time() + self.rng.uniform(0, self.args.ramp_jitter)
+        utterance_index = self.client_id
+
+        while loop.time() < stop_at:
+            utterance = self.utterances[utterance_index % len(self.utterances)]
+            utterance_index += 1
+            frames = [utterance[i:i + FRAME_BYTES] for i in range(0, len(utterance), FRAME_BYTES)]
+            frames[-1] = frames[-1].ljust(FRAME_BYTES, b"\0")
+
+            # 1.说话（说话期间收到的音频不属于这一轮）
+            self._speech_end_at = None
+            self._first_audio_at = self._last_audio_at = None
+            next_send = await self._send_frames(ws, frames, next_send)
+            self._speech_end_at = time.perf_counter()
+
+            # 2.等待回复（期间继续发送静音）：收到回复后，回复音频停止一段时间视为这一轮结束
+            if self.args.endpoint == "ws_chat":
+                # 上一轮的音频刚刚还在到达：这一轮收到的第一块音频可能是上一轮的，不计入延迟
+                contaminated = self._last_stale_at is not None and \
+                    self._speech_end_at - self._last_stale_at < self.args.response_idle
+                self._listening = True
+                try:
+                    while loop.time() < stop_at:
+                        now = time.perf_counter()
+                        if self._first_audio_at is None and now - self._speech_end_at > self.args.response_timeout:
+                            self.timeouts += 1
+                            break
+                        if self._last_audio_at is not None and now - self._last_audio_at > self.args.response_idle:
+                            latency = self._first_audio_at - self._speech_end_at
+                            if contaminated:
+                                self.contaminated += 1
+                            elif latency > 0:
+                                self.latencies.append(latency)
+                            break
+                        next_send = await self._send_frames(ws, [self.silence], next_send)
+                finally:
+                    self._listening = False
+                self.turns += 1
+            else:
+                self.turns += 1
+
+            # 3.思考时间
+            think_frames = int(self.rng.uniform(*self.args.think_time) / FRAME_SECONDS)
+            next_send = await self._send_frames(ws, [self.silence] * think_frames, next_send, stop_at)
+
+    async def _send_frames(self, ws, frames: list, next_send: float, stop_at: float = None) -> float:
+        """
+        按固定节奏发送帧，返回下一帧的计划发送时间
+        发送落后于计划时记为迟到；落后超过设备缓冲的帧数时丢弃积压的帧（不补发）
+        """
+        loop = asyncio.get_running_loop()
+        index = 0
+        while index < len(frames):
+            if stop_at is not None and loop.time() >= stop_at:
+                break
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            lag = loop.time() - next_send
+            self.max_send_lag = max(self.max_send_lag, lag)
+            if lag > FRAME_SECONDS:
+                self.late_frames += 1
+                backlog = int(lag / FRAME_SECONDS)
+                if backlog > self.args.device_buffer_frames:
+                    # 设备的缓冲已满：丢弃最旧的帧，跳到当前时间
+                    skipped = min(backlog - self.args.device_buffer_frames, len(frames) - index - 1)
+                    self.dropped_frames += skipped
+                    index += skipped
+                    next_send += skipped * FRAME_SECONDS
+
+            await ws.send(frames[index])
+            self.frames_sent += 1
+            index += 1
+            next_send += FRAME_SECONDS
+        return next_send
+
+    async def _receive(self, ws):
+        """
+        接收服务器返回的音频，记录第一块和最近一块的时间，以及回复中的停顿
+        不在等待回复期间收到的音频（上一轮超时后才到达、或者说话期间收到的）只计数，不算作任何一轮的回复
+        """
+        async for message in ws:
+            if not isinstance(message, bytes):
+                continue
+            now = time.perf_counter()
+            if not self._listening:
+                self.stale_chunks += 1
+                self._last_stale_at = now
+                continue
+            if self._first_audio_at is None:
+                self._first_audio_at = now
+            elif now - self._last_audio_at > self.args.stall_threshold:
+                self.response_stalls += 1
+            self._last_audio_at = now
+
+
+async def run_level(args, sessions: int, utterances: list) -> dict:
+    """运行一级负载：同时运行指定数量的设备，持续 duration 秒"""
+    url = f"{args.url.rstrip('/')}/{args.endpoint}"
+    rng = random.Random(args.seed + sessions)
+    clients = []
+    for i in range(sessions):
+        client_url = f"{url}?device_id={args.device_prefix}-{i}" if args.endpoint == "ws_chat" else url
+        clients.append(DeviceClient(i, client_url, utterances, args, random.Random(rng.random())))
+
+    stop_at = asyncio.get_running_loop().time() + args.duration
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client.run(stop_at) for client in clients))
+    elapsed = time.perf_counter() - started_at
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    frames_sent = sum(client.frames_sent for client in clients)
+    result = {
+        "sessions": sessions,
+        "seconds": elapsed,
+        "turns": sum(client.turns for client in clients),
+        "responses": len(latencies),
+        "timeouts": sum(client.timeouts for client in clients),
+        "errors": sum(1 for client in clients if client.error),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "frames_sent": frames_sent,
+        "late_frames": sum(client.late_frames for client in clients),
+        "dropped_frames": sum(client.dropped_frames for client in clients),
+        "max_send_lag": max((client.max_send_lag for client in clients), default=0.0),
+        "response_stalls": sum(client.response_stalls for client in clients),
+        "stale_chunks": sum(client.stale_chunks for client in clients),
+        "contaminated": sum(client.contaminated for client in clients),
+        "error_samples": sorted({client.error for client in clients if client.error})[:5],
+    }
+    return result
+
+
+def print_result(result: dict):
+    print(f"[load] sessions={result['sessions']:4d} responses={result['responses']:5d} "
+          f"p50={result['latency_p50'] * 1000:7.0f}ms p95={result['latency_p95'] * 1000:7.0f}ms "
+          f"p99={result['latency_p99'] * 1000:7.0f}ms timeouts={result['timeouts']} errors={result['errors']} "
+          f"late={result['late_frames']}/{result['frames_sent']} dropped={result['dropped_frames']} "
+          f"stalls={result['response_stalls']} stale={result['stale_chunks']} "
+          f"contaminated={result['contaminated']} max_lag={result['max_send_lag'] * 1000:.0f}ms")
+    for error in result["error_samples"]:
+        print(f"       error: {error}")
+
+
+async def main(args):
+    # 语音结束的判定依赖服务器的VAD配置（静音时长计入语音到语音的延迟）
+    vad_config = {}
+    if args.config and not os.path.exists(args.config):
+        print(f"⚠️ 配置文件 {args.config} 不存在，使用默认的VAD配置")
+    elif args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            vad_config = (yaml.safe_load(f) or {}).get("vad") or {}
+    max_silence_ms = vad_config.get("max_silence_ms", 2000)
+    print(f"[load] 端点: {args.url}/{args.endpoint}，VAD静音时长: {max_silence_ms}ms（包含在语音到语音延迟中）")
+    if args.response_timeout <= max_silence_ms / 1000:
+        print("⚠️ response_timeout 小于VAD的静音时长，所有轮次都会超时")
+
+    utterances = load_utterances(args.audio, args.utterance_seconds)
+    results = []
+    for sessions in args.sessions:
+        result = await run_level(args, sessions, utterances)
+        print_result(result)
+        results.append(result)
+        if args.stop_p95 and result["latency_p95"] > args.stop_p95:
+            print(f"[load] p95延迟超过 {args.stop_p95}s，停止增加负载")
+            break
+        await asyncio.sleep(args.cooldown)
+
+    print("\n========== 容量曲线（会话数量 -> 语音到语音延迟） ==========")
+    print(f"{'sessions':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'timeouts':>9} {'errors':>7} {'dropped':>8}")
+    for result in results:
+        print(f"{result['sessions']:>8} {result['latency_p50'] * 1000:>9.0f} {result['latency_p95'] * 1000:>9.0f} "
+              f"{result['latency_p99'] * 1000:>9.0f} {result['timeouts']:>9} {result['errors']:>7} "
+              f"{result['dropped_frames']:>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "vad": vad_config, "levels": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ESP32设备群的WebSocket负载生成工具")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000", help="ws_server的地址")
+    parser.add_argument("--endpoint", choices=["ws_chat", "ws"], default="ws_chat",
+                        help="ws_chat: 语音对话（统计延迟）；ws: 只发送音频")
+    parser.add_argument("--sessions", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4, 8, 16],
+                        help="逐级增加的会话数量，如 1,2,4,8,16")
+    parser.add_argument("--duration", type=float, default=60.0, help="每一级负载的持续时间（秒）")
+    parser.add_argument("--cooldown", type=float, default=5.0, help="两级负载之间的间隔（秒）")
+    parser.add_argument("--config", default="config.yaml", help="服务器使用的配置文件（读取VAD配置，不存在时使用默认值）")
+    parser.add_argument("--audio", nargs="*", default=[], help="输入的语音（16kHz 16bit单声道wav/pcm），可以指定多个")
+    parser.add_argument("--utterance-seconds", type=float, default=2.0, help="生成的测试语音时长（秒）")
+    parser.add_argument("--think-time", type=float, nargs=2, default=[2.0, 5.0], metavar=("MIN", "MAX"),
+                        help="两轮对话之间的思考时间范围（秒）")
+    parser.add_argument("--response-timeout", type=float, default=30.0, help="等待回复的超时时间（秒）")
+    parser.add_argument("--response-idle", type=float, default=1.5, help="回复音频停止多久视为这一轮结束（秒）")
+    parser.add_argument("--stall-threshold", type=float, default=0.3, help="回复音频中超过该间隔视为停顿（秒）")
+    parser.add_argument("--device-buffer-frames", type=int, default=16, help="设备缓冲的帧数，积压超过时丢弃")
+    parser.add_argument("--ramp-jitter", type=float, default=2.0, help="各个设备开始说话的随机错开时间（秒）")
+    parser.add_argument("--connect-timeout", type=float, default=10.0)
+    parser.add_argument("--stop-p95", type=float, default=0.0, help="p95延迟超过该值（秒）时停止增加负载，0表示不停止")
+    parser.add_argument("--device-prefix", default="load", help="设备ID的前缀")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="保存结果的JSON文件")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
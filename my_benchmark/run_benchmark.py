@@ -0,0 +1,292 @@
+"""
+端到端的对话流水线基准测试：使用本地替身后端（fake_backends / fake_mcp_server），不需要联网，结果可以重复
+每一轮对话都走完整的流程：ASR -> LLM（可选工具调用）-> 分句 -> TTS -> 发送，统计：
+- 首个音频的延迟（从一轮对话开始到发送第一块音频）
+- 句子之间的停顿（按音频时长模拟播放，后一句的音频到达时前一句已经播放完的时长）
+- 每轮对话的CPU时间和内存占用
+
+用法（在项目根目录执行）：
+    python -m my_benchmark.run_benchmark --turns 20 --token-rate 50 --tts-rtf 0.2 --tool-call-every 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import httpx
+import numpy as np
+import yaml
+
+from chat_handler.chat_tts_handler import ChatTTSHandler
+from my_asr.sensevoice_engine import SenseVoiceEngine
+from my_benchmark.fake_backends import BackendSettings
+from my_llm.openai_engine import OpenAIEngine
+from my_mcp.mcp_client import MCPClientManager
+from my_metrics.metrics import STAGE_LATENCY
+from my_tts.cosy_voice_engine import CosyVoiceEngine
+from my_tts.gpt_sovits_engine import GPTSoVTISEngine
+from my_tts.tts_cache import TTSCache, CachedTTSEngine
+
+# 输入音频的采样率（与设备端一致）
+SAMPLE_RATE = 16000
+
+
+class RecordingWebSocket:
+    """代替WebSocket连接：记录每块音频的发送时间"""
+
+    def __init__(self):
+        self.chunks = []
+
+    async def send_bytes(self, data: bytes):
+        self.chunks.append((time.perf_counter(), bytes(data)))
+
+    def reset(self):
+        self.chunks = []
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def current_rss_mb() -> float:
+    """当前进程的常驻内存（MB），不支持 /proc 的系统使用峰值内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 的单位是字节，Linux 是KB
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def load_utterance(path: str, seconds: float) -> bytes:
+    """读取输入音频（16kHz 16bit单声道的wav/pcm），没有指定时生成一段测试音频"""
+    if not path:
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        return (np.sin(2 * np.pi * 220 * t) * 6000).astype(np.int16).tobytes()
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as f:
+            return f.readframes(f.getnframes())
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def split_sentences(chunks: list) -> list:
+    """
+    将发送的音频块按句子分组（每个句子的音频以wav头开始）
+    :return: [(第一块的时间, 最后一块的时间, 音频时长)]
+    """
+    sentences = []
+    for sent_at, data in chunks:
+        if data[:4] == b"RIFF" or not sentences:
+            sample_rate = int.from_bytes(data[24:28], "little") if data[:4] == b"RIFF" else SAMPLE_RATE
+            sentences.append([sent_at, sent_at, 0, sample_rate])
+            data = data[44:] if data[:4] == b"RIFF" else data
+        sentence = sentences[-1]
+        sentence[1] = sent_at
+        sentence[2] += len(data)
+    return [(first, last, size / 2 / sample_rate) for first, last, size, sample_rate in sentences]
+
+
+def playback_gaps(sentences: list) -> list:
+    """模拟播放：收到第一块音频后开始播放，返回每两句之间的停顿（秒）"""
+    gaps = []
+    if not sentences:
+        return gaps
+    playback_end = sentences[0][0] + sentences[0][2]
+    for first, _, duration in sentences[1:]:
+        gaps.append(max(first - playback_end, 0.0))
+        playback_end = max(playback_end, first) + duration
+    return gaps
+
+
+async def wait_for_backends(url: str, process, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("替身后端启动失败")
+            try:
+                if (await client.get(f"{url}/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError("等待替身后端启动超时")
+
+
+def build_engines(args, url: str, mcp_config_path: str):
+    llm_engine = OpenAIEngine({"api_key": "bench", "base_url": f"{url}/v1", "model": "bench-llm",
+                               "max_tokens": 512, "provider": "bench"})
+    if args.tts_engine == "gpt_sovits":
+        tts_engine = GPTSoVTISEngine({"local": {"base_url": url, "bench": {
+            "gpt_model_path": "bench.ckpt", "sovits_model_path": "bench.pth", "prompt_lang": "zh",
+            "ref_audio_emotion": {"normal": {"ref_audio_path": "bench.wav", "prompt_text": "测试"}},
+        }}}, remote=False, role="bench")
+    else:
+        tts_engine = CosyVoiceEngine({"api_key": "bench", "base_url": f"{url}/v1", "model": "bench-tts",
+                                      "voice": "bench", "response_format": "wav"})
+    if args.tts_cache:
+        tts_engine = CachedTTSEngine(tts_engine, TTSCache())
+    asr_engine = SenseVoiceEngine({"api_key": "bench", "base_url": f"{url}/v1/audio/transcriptions",
+                                   "model": "bench-asr", "sample_rate": SAMPLE_RATE}, remote=True)
+    mcp_client = MCPClientManager(mcp_config_path)
+    return llm_engine, tts_engine, asr_engine, mcp_client
+
+
+async def run_turns(args, handler: ChatTTSHandler, websocket: RecordingWebSocket, utterance: bytes) -> list:
+    results = []
+    for turn in range(args.warmup + args.turns):
+        websocket.reset()
+        cpu_start = cpu_seconds()
+        started_at = time.perf_counter()
+        # 语音输入：从“用户说完话”开始计时（VAD的静音等待不在测试范围内）
+        await handler.interactive_with_audio_input(utterance, sample_rate=SAMPLE_RATE, speech_end_at=started_at)
+        finished_at = time.perf_counter()
+
+        sentences = split_sentences(websocket.chunks)
+        gaps = playback_gaps(sentences)
+        result = {
+            "turn": turn,
+            "warmup": turn < args.warmup,
+            "time_to_first_audio": websocket.chunks[0][0] - started_at if websocket.chunks else None,
+            "turn_seconds": finished_at - started_at,
+            "sentences": len(sentences),
+            "audio_seconds": sum(sentence[2] for sentence in sentences),
+            "max_gap": max(gaps, default=0.0),
+            "gaps": gaps,
+            "cpu_seconds": cpu_seconds() - cpu_start,
+            "rss_mb": current_rss_mb(),
+        }
+        results.append(result)
+        ttfa = result["time_to_first_audio"]
+        print(f"[bench] turn {turn:3d}{' (warmup)' if result['warmup'] else ''}: "
+              f"ttfa={ttfa if ttfa is None else f'{ttfa * 1000:.0f}ms'} "
+              f"turn={result['turn_seconds'] * 1000:.0f}ms sentences={result['sentences']} "
+              f"max_gap={result['max_gap'] * 1000:.0f}ms cpu={result['cpu_seconds'] * 1000:.0f}ms "
+              f"rss={result['rss_mb']:.1f}MB")
+        # 预热结束后清空各阶段的耗时样本，与每轮的统计一样不计入预热
+        if turn == args.warmup - 1:
+            STAGE_LATENCY.reset()
+    return results
+
+
+def summarize(results: list) -> dict:
+    measured = [result for result in results if not result["warmup"]]
+    ttfa = [result["time_to_first_audio"] for result in measured if result["time_to_first_audio"] is not None]
+    gaps = [gap for result in measured for gap in result["gaps"]]
+    cpu = [result["cpu_seconds"] for result in measured]
+    summary = {
+        "turns": len(measured),
+        "time_to_first_audio": {"p50": percentile(ttfa, 0.5), "p95": percentile(ttfa, 0.95), "max": max(ttfa, default=0)},
+        "inter_sentence_gap": {"p50": percentile(gaps, 0.5), "p95": percentile(gaps, 0.95), "max": max(gaps, default=0)},
+        "cpu_seconds_per_turn": {"p50": percentile(cpu, 0.5), "p95": percentile(cpu, 0.95), "max": max(cpu, default=0)},
+        "rss_mb": {"last": measured[-1]["rss_mb"] if measured else 0, "peak": peak_rss_mb()},
+        "stages": {},
+    }
+    # 流水线内部各阶段的耗时（my_metrics 中记录的最近样本）
+    for labels in STAGE_LATENCY.label_sets():
+        quantiles = STAGE_LATENCY.quantiles(**labels)
+        summary["stages"][f"{labels['stage']}[{labels['provider']}]"] = {"p50": quantiles.get(0.5),
+                                                                          "p95": quantiles.get(0.95)}
+    return summary
+
+
+def print_summary(summary: dict):
+    print("\n========== 基准测试结果 ==========")
+    print(f"轮数: {summary['turns']}")
+    for name in ("time_to_first_audio", "inter_sentence_gap", "cpu_seconds_per_turn"):
+        values = summary[name]
+        print(f"{name:>22}: p50={values['p50'] * 1000:.0f}ms p95={values['p95'] * 1000:.0f}ms "
+              f"max={values['max'] * 1000:.0f}ms")
+    print(f"{'rss_mb':>22}: last={summary['rss_mb']['last']:.1f}MB peak={summary['rss_mb']['peak']:.1f}MB")
+    print("各阶段耗时:")
+    for stage, values in summary["stages"].items():
+        print(f"{stage:>34}: p50={values['p50'] * 1000:.1f}ms p95={values['p95'] * 1000:.1f}ms")
+
+
+async def main(args):
+    url = f"http://127.0.0.1:{args.port}"
+    # 替身后端在单独的进程中运行，CPU和内存的统计只包含对话流水线
+    backend_args = [sys.executable, "-m", "my_benchmark.fake_backends", "--port", str(args.port)]
+    for name in vars(BackendSettings()):
+        backend_args += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(backend_args)
+
+    mcp_config = {
+        "mcp_servers": {"bench": {"transport": "stdio", "command": sys.executable,
+                                  "args": ["my_benchmark/fake_mcp_server.py"],
+                                  "env": {"BENCH_TOOL_LATENCY": str(args.tool_latency)}}},
+        "mcp_pool": {"health_check_interval": 0},
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(mcp_config, f)
+        mcp_config_path = f.name
+
+    try:
+        await wait_for_backends(url, process)
+        llm_engine, tts_engine, asr_engine, mcp_client = build_engines(args, url, mcp_config_path)
+        websocket = RecordingWebSocket()
+        async with mcp_client:
+            handler = ChatTTSHandler(llm_engine, mcp_client, tts_engine, asr_engine,
+                                     tts_streaming=not args.no_tts_streaming,
+                                     tts_concurrency=args.tts_concurrency, tts_lookahead=args.tts_lookahead)
+            await handler.start(system_role_path="chat_handler/system_role_prompt.yaml", websocket=websocket)
+            try:
+                results = await run_turns(args, handler, websocket, load_utterance(args.audio, args.utterance_seconds))
+            finally:
+                await handler.stop()
+        await llm_engine.aclose()
+    finally:
+        process.terminate()
+        process.wait()
+        os.unlink(mcp_config_path)
+
+    summary = summarize(results)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summary": summary, "turns": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="端到端的对话流水线基准测试（本地替身后端）")
+    parser.add_argument("--turns", type=int, default=10, help="测试的对话轮数")
+    parser.add_argument("--warmup", type=int, default=1, help="预热的轮数（不计入结果）")
+    parser.add_argument("--port", type=int, default=18080, help="替身后端的端口")
+    parser.add_argument("--audio", default="", help="输入音频（16kHz 16bit单声道wav/pcm），为空时生成测试音频")
+    parser.add_argument("--utterance-seconds", type=float, default=2.0, help="生成的测试音频时长（秒）")
+    parser.add_argument("--tts-engine", choices=["cosy_voice", "gpt_sovits"], default="cosy_voice")
+    parser.add_argument("--tts-cache", action="store_true", help="使用TTS音频缓存")
+    parser.add_argument("--no-tts-streaming", action="store_true", help="整句合成后再发送")
+    parser.add_argument("--tts-concurrency", type=int, default=2)
+    parser.add_argument("--tts-lookahead", type=int, default=4)
+    parser.add_argument("--tool-latency", type=float, default=0.1, help="MCP工具的延迟（秒）")
+    parser.add_argument("--output", default="", help="保存结果的JSON文件")
+    # 替身后端的配置
+    for name, value in vars(BackendSettings()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
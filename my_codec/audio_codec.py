@@ -0,0 +1,432 @@
+"""
+WebSocket音频的编解码（每个连接协商一种编解码器）：
+- pcm16：原有格式（默认），上行为16kHz PCM（固件实际是8kHz音频、每个采样点重复一次），下行直接发送TTS返回的音频（wav）
+- pcm8k：上下行都是8kHz 16bit单声道PCM，数据量是pcm16的一半
+- adpcm：8kHz IMA-ADPCM（每个采样点4bit），数据量是pcm16的1/8；纯Python实现，不需要额外的依赖
+- opus：16kHz Opus（需要安装 opuslib 和系统的 libopus），固定码率（codec.opus_bitrate）
+上行在VAD之前解码为16kHz PCM；下行将TTS返回的wav流重采样到编解码器的采样率，按固定帧长编码，每帧一条消息
+"""
+import struct
+import threading
+
+import numpy as np
+
+try:
+    import opuslib
+except (ImportError, OSError):
+    # 没有安装 opuslib（或找不到libopus）时不支持Opus，协商时跳过
+    opuslib = None
+
+# VAD和ASR使用的采样率（上行解码后的采样率）
+UPLINK_SAMPLE_RATE = 16000
+
+# IMA-ADPCM的量化步长表和步长索引调整表
+ADPCM_STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871,
+    5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623,
+    27086, 29794, 32767,
+)
+ADPCM_INDEX_TABLE = (-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8)
+# ADPCM块头：编码这一块之前的预测值（int16）、步长索引（uint8）、保留（uint8）
+ADPCM_HEADER = struct.Struct("<hBB")
+
+# 所有连接累计的音频流量（字节）：上行（线路上）、下行（线路上）、下行编码之前（TTS返回的音频）
+_traffic = {"uplink_bytes": 0, "downlink_bytes": 0, "downlink_source_bytes": 0}
+_traffic_lock = threading.Lock()
+
+
+def traffic_stats() -> dict:
+    """所有连接累计的音频流量（/metrics 中输出）"""
+    with _traffic_lock:
+        return dict(_traffic)
+
+
+def _count_traffic(key: str, size: int):
+    with _traffic_lock:
+        _traffic[key] += size
+
+
+def adpcm_encode(samples, predictor: int = 0, index: int = 0) -> (bytes, int, int):
+    """
+    IMA-ADPCM编码（低4位在前），返回 (编码数据, 编码之后的预测值, 编码之后的步长索引)
+    :param samples: int16采样点（NumPy数组或序列）
+    """
+    if isinstance(samples, np.ndarray):
+        samples = samples.tolist()
+    out = bytearray((len(samples) + 1) // 2)
+    for i, sample in enumerate(samples):
+        step = ADPCM_STEP_TABLE[index]
+        diff = sample - predictor
+        code = 0
+        if diff < 0:
+            code = 8
+            diff = -diff
+        delta = step >> 3
+        if diff >= step:
+            code |= 4
+            diff -= step
+            delta += step
+        step >>= 1
+        if diff >= step:
+            code |= 2
+            diff -= step
+            delta += step
+        step >>= 1
+        if diff >= step:
+            code |= 1
+            delta += step
+
+        predictor = predictor - delta if code & 8 else predictor + delta
+        predictor = -32768 if predictor < -32768 else 32767 if predictor > 32767 else predictor
+        index += ADPCM_INDEX_TABLE[code]
+        index = 0 if index < 0 else 88 if index > 88 else index
+
+        if i & 1:
+            out[i >> 1] |= code << 4
+        else:
+            out[i >> 1] = code
+    return bytes(out), predictor, index
+
+
+def adpcm_decode(data: bytes, predictor: int = 0, index: int = 0) -> (np.ndarray, int, int):
+    """IMA-ADPCM解码，返回 (int16采样点, 解码之后的预测值, 解码之后的步长索引)"""
+    samples = [0] * (len(data) * 2)
+    i = 0
+    for byte in data:
+        for code in (byte & 0x0F, byte >> 4):
+            step = ADPCM_STEP_TABLE[index]
+            delta = step >> 3
+            if code & 4:
+                delta += step
+            if code & 2:
+                delta += step >> 1
+            if code & 1:
+                delta += step >> 2
+
+            predictor = predictor - delta if code & 8 else predictor + delta
+            predictor = -32768 if predictor < -32768 else 32767 if predictor > 32767 else predictor
+            index += ADPCM_INDEX_TABLE[code]
+            index = 0 if index < 0 else 88 if index > 88 else index
+
+            samples[i] = predictor
+            i += 1
+    return np.array(samples, dtype=np.int16), predictor, index
+
+
+class StreamResampler:
+    """
+    流式重采样（线性插值，跨块连续）；降采样时先做滑动平均，减少混叠
+    """
+
+    def __init__(self, src_rate: int, dst_rate: int):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.step = src_rate / dst_rate
+        # 下一个输出采样点在输入中的位置（相对于上一块的最后一个采样点）
+        self._pos = 0.0
+        self._last = None
+        # 滑动平均的长度和上一块末尾的采样点
+        self._taps = int(self.step) if self.step >= 2 else 1
+        self._history = np.zeros(self._taps - 1, dtype=np.float32)
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """输入int16采样点，返回重采样后的int16采样点"""
+        if self.src_rate == self.dst_rate or len(samples) == 0:
+            return samples
+        x = samples.astype(np.float32)
+        if self._taps > 1:
+            padded = np.concatenate((self._history, x))
+            self._history = padded[len(padded) - (self._taps - 1):]
+            x = np.convolve(padded, np.full(self._taps, 1 / self._taps, dtype=np.float32), mode="valid")
+
+        if self._last is not None:
+            x = np.concatenate(([self._last], x))
+        count = int(np.ceil((len(x) - 1 - self._pos) / self.step)) if len(x) - 1 > self._pos else 0
+        positions = self._pos + np.arange(count) * self.step
+        out = np.interp(positions, np.arange(len(x)), x)
+        self._pos = self._pos + count * self.step - (len(x) - 1)
+        self._last = x[-1]
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+
+class WavStreamParser:
+    """
+    解析TTS返回的wav流：每个句子以wav文件头（RIFF）开始，之后是PCM数据（流式TTS分成多块返回）
+    feed 返回 (int16采样点, 采样率)，遇到新的文件头时 new_stream 为True（需要重置重采样的状态）
+    """
+
+    def __init__(self, warn: bool = True):
+        """:param warn: 收到不是wav格式的音频时是否提示"""
+        self.sample_rate = None
+        self.channels = 1
+        self.new_stream = False
+        self._header = None
+        self._odd = b""
+        self._warned = not warn
+
+    def feed(self, chunk: bytes):
+        self.new_stream = False
+        if chunk[:4] == b"RIFF":
+            self._header = bytearray()
+            self._odd = b""
+        if self._header is not None:
+            # 文件头可能分在多块中：找到data块之后才开始输出PCM
+            self._header += chunk
+            data_at = self._parse_header(self._header)
+            if data_at is None:
+                return None
+            chunk = bytes(self._header[data_at:])
+            self._header = None
+            self.new_stream = True
+
+        if self.sample_rate is None:
+            if not self._warned:
+                self._warned = True
+                print("⚠️ 下行编码只支持wav格式的TTS音频（tts.*.response_format），不是wav的音频将被丢弃")
+            return None
+
+        data = self._odd + chunk
+        usable = len(data) - len(data) % (2 * self.channels)
+        self._odd = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype="<i2")
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1).astype(np.int16)
+        return samples, self.sample_rate
+
+    def _parse_header(self, header: bytearray):
+        """解析wav文件头，返回PCM数据的起始位置；文件头不完整时返回None"""
+        offset = 12
+        while offset + 8 <= len(header):
+            chunk_id, chunk_size = struct.unpack_from("<4sI", header, offset)
+            if chunk_id == b"data":
+                return offset + 8
+            if chunk_id == b"fmt ":
+                if offset + 8 + 16 > len(header):
+                    return None
+                self.channels, self.sample_rate = struct.unpack_from("<HI", header, offset + 10)
+            offset += 8 + chunk_size + chunk_size % 2
+        return None
+
+
+class AudioCodec:
+    """
+    编解码器基类（即 pcm16：上行原样交给VAD，下行原样发送TTS音频）
+    每个连接一个实例（内部带有状态）
+    """
+    name = "pcm16"
+    # 线路上的采样率
+    sample_rate = UPLINK_SAMPLE_RATE
+    # 下行每条消息的时长（毫秒），0表示不分帧
+    frame_ms = 0
+
+    def __init__(self):
+        # 最近一次 encode / flush 输出的音频时长（秒），用于估算设备的播放进度；无法解析（不是wav）时为0
+        self.encoded_seconds = 0.0
+        self._duration_parser = WavStreamParser(warn=False)
+
+    def decode(self, data: bytes) -> bytes:
+        """上行：将一条消息解码为16kHz 16bit单声道PCM"""
+        _count_traffic("uplink_bytes", len(data))
+        return data
+
+    def encode(self, chunk: bytes) -> list:
+        """下行：将TTS返回的一块音频编码为若干条消息"""
+        _count_traffic("downlink_source_bytes", len(chunk))
+        _count_traffic("downlink_bytes", len(chunk))
+        parsed = self._duration_parser.feed(chunk)
+        self.encoded_seconds = len(parsed[0]) / parsed[1] if parsed else 0.0
+        return [chunk]
+
+    def flush(self) -> list:
+        """下行：一个句子的音频结束时，输出不足一帧的剩余音频（补静音）"""
+        self.encoded_seconds = 0.0
+        return []
+
+    def reset(self):
+        """下行：丢弃不足一帧、尚未输出的音频（回复被打断时）"""
+
+    def describe(self) -> dict:
+        """协商结果（发送给设备）"""
+        return {"type": "codec", "codec": self.name, "sample_rate": self.sample_rate, "frame_ms": self.frame_ms}
+
+
+class FramedCodec(AudioCodec):
+    """
+    分帧的编解码器：下行将TTS的wav流重采样到 sample_rate，每 frame_ms 毫秒编码为一条消息
+    子类实现 decode_frame / encode_frame
+    """
+
+    def __init__(self, frame_ms: int = 20):
+        super().__init__()
+        self.frame_ms = frame_ms
+        self.frame_samples = self.sample_rate * frame_ms // 1000
+        self._parser = WavStreamParser()
+        self._resampler = None
+        # 不足一帧的下行采样点
+        self._pending = np.zeros(0, dtype=np.int16)
+
+    def decode(self, data: bytes) -> bytes:
+        _count_traffic("uplink_bytes", len(data))
+        samples = self.decode_frame(data)
+        # 8kHz转为16kHz：每个采样点重复一次（与原有固件的格式相同）
+        if self.sample_rate * 2 == UPLINK_SAMPLE_RATE:
+            samples = np.repeat(samples, 2)
+        return samples.tobytes()
+
+    def encode(self, chunk: bytes) -> list:
+        _count_traffic("downlink_source_bytes", len(chunk))
+        parsed = self._parser.feed(chunk)
+        if parsed is None:
+            self.encoded_seconds = 0.0
+            return []
+        samples, source_rate = parsed
+        # 新的音频流（下一个句子）：上一个音频流不足一帧的剩余音频补静音输出，不与新的音频拼接
+        flushed = self.flush() if self._parser.new_stream else []
+        if self._parser.new_stream or self._resampler is None or self._resampler.src_rate != source_rate:
+            self._resampler = StreamResampler(source_rate, self.sample_rate)
+        samples = np.concatenate((self._pending, self._resampler.process(samples)))
+
+        messages = []
+        usable = len(samples) - len(samples) % self.frame_samples
+        for start in range(0, usable, self.frame_samples):
+            messages.append(self.encode_frame(samples[start:start + self.frame_samples]))
+        self._pending = samples[usable:]
+        _count_traffic("downlink_bytes", sum(len(message) for message in messages))
+        self.encoded_seconds = (len(flushed) + len(messages)) * self.frame_ms / 1000
+        return flushed + messages
+
+    def flush(self) -> list:
+        self.encoded_seconds = 0.0
+        if not len(self._pending):
+            return []
+        frame = np.zeros(self.frame_samples, dtype=np.int16)
+        frame[:len(self._pending)] = self._pending
+        self._pending = np.zeros(0, dtype=np.int16)
+        message = self.encode_frame(frame)
+        _count_traffic("downlink_bytes", len(message))
+        self.encoded_seconds = self.frame_ms / 1000
+        return [message]
+
+    def reset(self):
+        self._pending = np.zeros(0, dtype=np.int16)
+
+    def decode_frame(self, data: bytes) -> np.ndarray:
+        raise NotImplementedError
+
+    def encode_frame(self, samples: np.ndarray) -> bytes:
+        raise NotImplementedError
+
+
+class Pcm8kCodec(FramedCodec):
+    """8kHz 16bit单声道PCM"""
+    name = "pcm8k"
+    sample_rate = 8000
+
+    def decode_frame(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(data[:len(data) - len(data) % 2], dtype="<i2")
+
+    def encode_frame(self, samples: np.ndarray) -> bytes:
+        return samples.astype("<i2").tobytes()
+
+
+class AdpcmCodec(FramedCodec):
+    """
+    8kHz IMA-ADPCM：每条消息是一个独立的块，块头（4字节）为编码这一块之前的预测值和步长索引，之后每字节两个采样点（低4位在前）
+    解码以块头为准，丢失或乱序的消息不会影响后续的消息
+    """
+    name = "adpcm"
+    sample_rate = 8000
+
+    def __init__(self, frame_ms: int = 20):
+        super().__init__(frame_ms)
+        self._predictor = 0
+        self._index = 0
+
+    def decode_frame(self, data: bytes) -> np.ndarray:
+        if len(data) < ADPCM_HEADER.size:
+            return np.zeros(0, dtype=np.int16)
+        predictor, index, _ = ADPCM_HEADER.unpack_from(data)
+        samples, _, _ = adpcm_decode(data[ADPCM_HEADER.size:], predictor, min(index, 88))
+        return samples
+
+    def encode_frame(self, samples: np.ndarray) -> bytes:
+        header = ADPCM_HEADER.pack(self._predictor, self._index, 0)
+        data, self._predictor, self._index = adpcm_encode(samples, self._predictor, self._index)
+        return header + data
+
+
+class OpusCodec(FramedCodec):
+    """
+    16kHz Opus（每条消息一个Opus包），下行使用固定码率
+    服务器只能看到数据进入本机的发送缓冲，看不到网络和设备的播放状态，因此不自动调整码率
+    """
+    name = "opus"
+    sample_rate = 16000
+    # 解码时每个包的最大采样点数（120毫秒）
+    MAX_FRAME_SAMPLES = 1920
+
+    def __init__(self, frame_ms: int = 20, bitrate: int = 24000):
+        if opuslib is None:
+            raise RuntimeError("Opus不可用：需要安装 opuslib 和 libopus")
+        super().__init__(frame_ms)
+        self.bitrate = bitrate
+        self._encoder = opuslib.Encoder(self.sample_rate, 1, opuslib.APPLICATION_VOIP)
+        self._encoder.bitrate = self.bitrate
+        self._decoder = opuslib.Decoder(self.sample_rate, 1)
+
+    def decode_frame(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(self._decoder.decode(data, self.MAX_FRAME_SAMPLES), dtype="<i2")
+
+    def encode_frame(self, samples: np.ndarray) -> bytes:
+        return self._encoder.encode(samples.astype("<i2").tobytes(), self.frame_samples)
+
+    def describe(self) -> dict:
+        return dict(super().describe(), bitrate=self.bitrate)
+
+
+CODECS = {
+    "opus": OpusCodec,
+    "adpcm": AdpcmCodec,
+    "pcm8k": Pcm8kCodec,
+    "pcm16": AudioCodec,
+}
+
+
+def available_codecs() -> list:
+    """当前环境支持的编解码器"""
+    return [name for name in CODECS if name != "opus" or opuslib is not None]
+
+
+def negotiate_codec(offer: str = None, allowed=None, frame_ms: int = 20, opus_bitrate: int = 24000) -> AudioCodec:
+    """
+    协商编解码器：按设备给出的顺序（如 "opus,adpcm,pcm8k"）选择第一个服务器允许且支持的编解码器
+    设备没有给出或都不支持时使用 pcm16（原有格式）
+    :param offer: 设备支持的编解码器，逗号分隔，按优先级排列
+    :param allowed: 服务器允许的编解码器（None表示全部）
+    :param frame_ms: 下行每条消息的时长（毫秒），Opus只支持 10/20/40/60
+    :param opus_bitrate: Opus的码率（bps）
+    """
+    supported = [name for name in available_codecs() if allowed is None or name in allowed]
+    for name in (offer or "").split(","):
+        name = name.strip().lower()
+        if name not in supported:
+            continue
+        if name == "opus":
+            return OpusCodec(frame_ms, opus_bitrate)
+        if name == "pcm16":
+            return AudioCodec()
+        return CODECS[name](frame_ms)
+    return AudioCodec()
+
+
+if __name__ == '__main__':
+    # 简单测试：ADPCM编解码的误差和压缩率
+    t = np.arange(8000) / 8000
+    pcm = (np.sin(2 * np.pi * 440 * t) * 8000).astype(np.int16)
+    encoded, _, _ = adpcm_encode(pcm)
+    decoded, _, _ = adpcm_decode(encoded)
+    snr = 10 * np.log10(np.mean(pcm.astype(np.float64) ** 2) /
+                        np.mean((pcm.astype(np.float64) - decoded) ** 2))
+    print(f"ADPCM: {pcm.nbytes} -> {len(encoded)} 字节，信噪比 {snr:.1f} dB；可用的编解码器: {available_codecs()}")
@@ -0,0 +1,147 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 所有连接共享的降噪线程池（降噪是CPU密集的计算，不能放在事件循环中执行）
+_executor = None
+
+
+def get_executor(max_workers=2) -> ThreadPoolExecutor:
+    """获取共享的降噪线程池（第一次调用时创建）"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="denoise")
+    return _executor
+
+
+class StreamDenoiser:
+    """
+    流式降噪（谱门限降噪，思路与 noisereduce 的平稳噪声模式相同，但按块在线处理）：
+    - 每个连接一个实例，送入任意长度的PCM数据，按块（block_ms）处理，增加的延迟为一个块
+    - 使用50%重叠的sqrt-hann窗做短时傅里叶变换，重叠相加后可以无失真重建
+    - 噪声谱从非语音块中滚动学习（指数平均），语音块不更新噪声谱
+    - 初始的噪声谱取自连续 warmup_blocks 个安静且能量稳定的块（一连接就开始说话时，不会把语音学习成噪声）
+    """
+
+    def __init__(self, sample_rate=16000, block_ms=32, prop_decrease=0.8, threshold=2.0,
+                 noise_alpha=0.05, gain_smoothing=0.5, warmup_blocks=10, max_noise_rms=1000, max_workers=2):
+        """
+        :param sample_rate: 采样率
+        :param block_ms: 每块的时长（毫秒），即增加的延迟；块越大单位时长的CPU开销越小
+        :param prop_decrease: 降噪强度（0到1之间），与 noisereduce 的同名参数含义相同
+        :param threshold: 幅度超过噪声谱的多少倍才认为是信号
+        :param noise_alpha: 噪声谱的更新速度
+        :param gain_smoothing: 增益在时间上的平滑系数（减少音乐噪声）
+        :param warmup_blocks: 初始的噪声谱需要的连续安静块的数量（这些块之间的能量相差不超过 threshold 的平方倍）
+        :param max_noise_rms: 噪声的最大幅度（int16采样点的均方根），超过的块不用于学习初始的噪声谱
+        :param max_workers: 共享线程池的线程数量
+        """
+        self.sample_rate = sample_rate
+        self.hop = int(sample_rate * block_ms / 1000)
+        self.n_fft = self.hop * 2
+        self.prop_decrease = prop_decrease
+        self.threshold = threshold
+        self.noise_alpha = noise_alpha
+        self.gain_smoothing = gain_smoothing
+        self.warmup_blocks = warmup_blocks
+        self.max_noise_rms = max_noise_rms
+        self.executor = get_executor(max_workers)
+
+        # sqrt-hann窗（分析和合成各一次，50%重叠时满足完全重建）
+        self.window = np.sqrt(np.hanning(self.n_fft + 1)[:-1]).astype(np.float32)
+
+        # 输入缓冲：上一块的后半部分 + 不足一块的新数据
+        self._input = np.zeros(self.n_fft, dtype=np.float32)
+        self._pending = np.zeros(self.hop, dtype=np.float32)
+        self._pending_len = 0
+        # 输出缓冲：重叠相加的尾部
+        self._output_tail = np.zeros(self.hop, dtype=np.float32)
+
+        # 噪声谱（幅度）和上一块的增益
+        self.noise_profile = None
+        self.noise_energy = None
+        self._gain = np.ones(self.n_fft // 2 + 1, dtype=np.float32)
+        # 学习初始噪声谱的连续安静块：[(幅度谱, 能量)]
+        self._warmup = []
+
+    def process(self, data, speech=None) -> bytes:
+        """
+        降噪处理（同步，在线程池中调用）
+        :param data: 16bit单声道PCM字节
+        :param speech: 外部提供的是否正在说话的提示（如VAD状态），None表示只根据能量判断
+        :return: 降噪后的PCM字节（比输入延迟一个块，长度为已处理完成的整块）
+        """
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+        output = []
+        offset = 0
+        while offset < len(samples):
+            take = min(self.hop - self._pending_len, len(samples) - offset)
+            self._pending[self._pending_len:self._pending_len + take] = samples[offset:offset + take]
+            self._pending_len += take
+            offset += take
+            if self._pending_len == self.hop:
+                output.append(self._process_block(self._pending, speech))
+                self._pending_len = 0
+
+        if not output:
+            return b""
+        return np.clip(np.concatenate(output), -32768, 32767).astype("<i2").tobytes()
+
+    async def process_async(self, data, speech=None) -> bytes:
+        """在共享线程池中降噪，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.process, data, speech)
+
+    def _process_block(self, block: np.ndarray, speech) -> np.ndarray:
+        """处理一个块（hop个采样点），返回一个块的输出"""
+        # 滑动输入窗口：前半部分为上一块，后半部分为新块
+        self._input[:self.hop] = self._input[self.hop:]
+        self._input[self.hop:] = block
+        spectrum = np.fft.rfft(self._input * self.window)
+        magnitude = np.abs(spectrum)
+        energy = float(np.mean(magnitude * magnitude))
+
+        # 1.更新噪声谱：外部提示正在说话时不更新
+        if speech:
+            self._warmup.clear()
+        elif self.noise_profile is None:
+            self._learn_initial_noise(block, magnitude, energy)
+        elif energy < self.noise_energy * self.threshold ** 2:
+            # 能量接近噪声水平的块用于更新
+            self.noise_profile += self.noise_alpha * (magnitude - self.noise_profile)
+            self.noise_energy += self.noise_alpha * (energy - self.noise_energy)
+
+        # 2.谱门限：低于噪声门限的频点按 prop_decrease 衰减，增益在时间上平滑
+        #  还没有学习到噪声谱（一连接就开始说话）时不衰减
+        if self.noise_profile is None:
+            gain = np.ones_like(self._gain)
+        else:
+            mask = magnitude > self.noise_profile * self.threshold
+            gain = np.where(mask, 1.0, 1.0 - self.prop_decrease).astype(np.float32)
+        self._gain = self.gain_smoothing * self._gain + (1.0 - self.gain_smoothing) * gain
+
+        # 3.逆变换并重叠相加
+        frame = np.fft.irfft(spectrum * self._gain, n=self.n_fft).astype(np.float32) * self.window
+        output = frame[:self.hop] + self._output_tail
+        self._output_tail = frame[self.hop:].copy()
+        return output
+
+    def _learn_initial_noise(self, block: np.ndarray, magnitude: np.ndarray, energy: float):
+        """
+        学习初始的噪声谱：幅度超过 max_noise_rms 的块（可能是语音）中断连续的安静块；
+        连续的安静块中能量相差过大时丢弃较早的块，凑够 warmup_blocks 个后取平均作为噪声谱
+        """
+        if np.sqrt(np.mean(block * block)) > self.max_noise_rms:
+            self._warmup.clear()
+            return
+        self._warmup.append((magnitude.copy(), energy))
+        while len(self._warmup) > 1:
+            energies = [item[1] for item in self._warmup]
+            if max(energies) <= min(energies) * self.threshold ** 2:
+                break
+            self._warmup.pop(0)
+        if len(self._warmup) >= self.warmup_blocks:
+            self.noise_profile = np.mean([item[0] for item in self._warmup], axis=0)
+            self.noise_energy = float(np.mean([item[1] for item in self._warmup]))
+            self._warmup.clear()
@@ -1,18 +1,106 @@
-from openai import OpenAI
+import asyncio
+import time
+from urllib.parse import urlparse
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from my_metrics.metrics import observe_stage
+
+
+class LLMTimeoutError(Exception):
+    """LLM请求超时（首个token或整个请求）"""
+
+
+def prompt_cache_usage(usage) -> tuple:
+    """
+    从响应的usage中读取提示词缓存命中和未命中的token数
+    DeepSeek 返回 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+    OpenAI 兼容接口（如SiliconFlow）返回 prompt_tokens_details.cached_tokens
+    """
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    hit = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if hit is None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        hit = getattr(details, 'cached_tokens', 0) if details else 0
+    hit = hit or 0
+    miss = getattr(usage, 'prompt_cache_miss_tokens', None)
+    if miss is None:
+        miss = max(prompt_tokens - hit, 0)
+    return hit, miss
+
 
 class OpenAIEngine:
     def __init__(self, llm_config: dict):
         self.api_key = llm_config["api_key"]
         self.base_url = llm_config["base_url"]
-        # 大模型对话客户端
-        self.llm_client = OpenAI(api_key=self.api_key, base_url=self.base_url)
 
         self.model = llm_config["model"]
         self.max_tokens = llm_config["max_tokens"]
+        # 服务提供方（指标的provider标签），默认使用接口地址的主机名
+        self.provider = llm_config.get("provider") or urlparse(self.base_url).hostname or "openai"
+
+        # 超时配置（秒）：建立连接、收到首个token、整个请求
+        timeout_config = llm_config.get("timeout", {})
+        self.connect_timeout = timeout_config.get("connect", 5.0)
+        self.first_token_timeout = timeout_config.get("first_token", 15.0)
+        self.total_timeout = timeout_config.get("total", 120.0)
+        # httpx层面的超时只作为兜底（单次读取的最长等待时间），首token和总时长在下面的流式读取中控制
+        http_timeout = httpx.Timeout(self.total_timeout, connect=self.connect_timeout,
+                                     read=self.first_token_timeout + self.connect_timeout)
+
+        # 是否使用异步客户端（默认开启）：异步模式下流式读取不会阻塞事件循环，多个会话的LLM请求可以并行
+        self.async_mode = llm_config.get("async_mode", True)
+        if self.async_mode:
+            # 所有会话共享同一个带连接池的HTTP客户端（keep-alive复用连接）
+            pool_config = llm_config.get("pool", {})
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=pool_config.get("max_connections", 100),
+                    max_keepalive_connections=pool_config.get("max_keepalive_connections", 20),
+                    keepalive_expiry=pool_config.get("keepalive_expiry", 30.0),
+                ),
+                timeout=http_timeout,
+            )
+            # 大模型对话客户端
+            self.llm_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                          http_client=self.http_client)
+        else:
+            self.http_client = None
+            # 大模型对话客户端（同步调用放到线程中执行）
+            self.llm_client = OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=http_timeout)
+
+        # 所有会话（包括摘要请求）累计的token使用情况，用于统计全局的提示词缓存命中率
+        self.usage_stats = {"requests": 0, "prompt_tokens": 0, "prompt_cache_hit_tokens": 0,
+                            "prompt_cache_miss_tokens": 0, "completion_tokens": 0}
+
+    def record_usage(self, usage):
+        """累计一次请求的token使用情况"""
+        if not usage:
+            return
+        hit, miss = prompt_cache_usage(usage)
+        self.usage_stats["requests"] += 1
+        self.usage_stats["prompt_tokens"] += getattr(usage, 'prompt_tokens', 0) or 0
+        self.usage_stats["prompt_cache_hit_tokens"] += hit
+        self.usage_stats["prompt_cache_miss_tokens"] += miss
+        self.usage_stats["completion_tokens"] += getattr(usage, 'completion_tokens', 0) or 0
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """全局的提示词缓存命中率（命中的token数 / 提示词token数）"""
+        total = self.usage_stats["prompt_cache_hit_tokens"] + self.usage_stats["prompt_cache_miss_tokens"]
+        return self.usage_stats["prompt_cache_hit_tokens"] / total if total else 0.0
+
+    async def _create(self, params: dict):
+        """发起一次chat completions请求"""
+        if self.async_mode:
+            return await self.llm_client.chat.completions.create(**params)
+        return await asyncio.to_thread(self.llm_client.chat.completions.create, **params)
 
     async def chat(self, messages: list, tools=None, stream=False):
         """
         调用LLM的chat接口对话
+        stream=True 时返回的是原始的流对象，一般应使用 chat_stream
         """
         params = {
             "model": self.model,
@@ -24,11 +112,85 @@ class OpenAIEngine:
         if tools:
             params["tools"] = tools
 
-        return self.llm_client.chat.completions.create(**params)
+        # 流式请求在收到响应头时就返回，用首token超时限制；非流式请求用总超时限制
+        timeout = self.first_token_timeout if stream else self.total_timeout
+        try:
+            response = await asyncio.wait_for(self._create(params), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise LLMTimeoutError(f"LLM请求超时（{timeout}s）: {self.model}")
 
+        if not stream:
+            self.record_usage(response.usage)
+        return response
 
     async def chat_stream(self, messages: list, tools=None):
         """
         调用LLM的chat接口流式对话
+        返回异步迭代器，使用 async for 逐个读取chunk
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.total_timeout
+        started_at = time.perf_counter()
+
+        stream = await self.chat(messages=messages, tools=tools, stream=True)
+        return self._iter_stream(stream, deadline, started_at)
+
+    async def _iter_stream(self, stream, deadline: float, started_at: float):
+        """
+        逐个读取流式响应的chunk，同时检查首token超时和总超时
+        迭代结束（或被取消）时关闭流，释放连接回连接池
+        记录首个token（第一个包含内容或工具调用的chunk）和整个回复的耗时（从发出请求开始）
+        只有角色信息或空内容的chunk不算首个token：首token超时从开始读取时计算，不会因为这些chunk而重新计时
         """
-        return await self.chat(messages=messages, tools=tools, stream=True)
+        loop = asyncio.get_running_loop()
+        if self.async_mode:
+            iterator = stream.__aiter__()
+            next_chunk = iterator.__anext__
+        else:
+            iterator = iter(stream)
+            next_chunk = lambda: asyncio.to_thread(next, iterator, None)
+
+        first_token = True
+        first_token_deadline = loop.time() + self.first_token_timeout
+        completed = False
+        try:
+            while True:
+                now = loop.time()
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise LLMTimeoutError(f"LLM请求总时长超时（{self.total_timeout}s）: {self.model}")
+                timeout = min(remaining, first_token_deadline - now) if first_token else remaining
+                if timeout <= 0:
+                    raise LLMTimeoutError(f"LLM首个token超时（{self.first_token_timeout}s）: {self.model}")
+                try:
+                    chunk = await asyncio.wait_for(next_chunk(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    if first_token:
+                        raise LLMTimeoutError(f"LLM首个token超时（{self.first_token_timeout}s）: {self.model}")
+                    raise LLMTimeoutError(f"LLM请求总时长超时（{self.total_timeout}s）: {self.model}")
+
+                # 同步模式下读取完毕返回None
+                if chunk is None:
+                    break
+                if first_token and chunk.choices and chunk.choices[0].delta and \
+                        (chunk.choices[0].delta.content or chunk.choices[0].delta.tool_calls):
+                    first_token = False
+                    observe_stage("llm_first_token", time.perf_counter() - started_at, self.provider)
+                if getattr(chunk, 'usage', None):
+                    self.record_usage(chunk.usage)
+                yield chunk
+            completed = True
+        finally:
+            if completed:
+                observe_stage("llm_completion", time.perf_counter() - started_at, self.provider)
+            if self.async_mode:
+                await stream.close()
+            else:
+                stream.close()
+
+    async def aclose(self):
+        """关闭共享的HTTP连接池（服务器退出时调用）"""
+        if self.http_client:
+            await self.http_client.aclose()
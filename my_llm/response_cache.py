@@ -0,0 +1,89 @@
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LLM回复缓存（完全匹配）：语音用户经常重复同样的话（“你是谁”、“讲个笑话”），
+    命中时直接使用缓存的回复，不再把整个对话历史发送给LLM
+    - 缓存键：模型、系统提示词、规范化后的用户输入、最近的若干条对话
+    - 只缓存没有工具调用、正常结束的回复
+    - 条目有过期时间，数量有上限（超过后淘汰最久未使用的条目）
+    所有会话共享一个实例（由SessionManager提供）
+    """
+
+    def __init__(self, ttl_seconds=3600, max_entries=1000, context_messages=2):
+        """
+        :param ttl_seconds: 缓存条目的有效时长（秒）
+        :param max_entries: 缓存条目数量上限
+        :param context_messages: 缓存键包含的最近对话条数（用户/助手消息），0表示只看用户当前的输入
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.context_messages = context_messages
+
+        # key -> (过期时间, 回复文本)
+        self._entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+    @staticmethod
+    def normalize_utterance(text: str) -> str:
+        """规范化用户输入：全角/半角统一、忽略大小写、空白和首尾的标点（ASR结果的标点并不稳定）"""
+        text = unicodedata.normalize("NFKC", text).lower()
+        text = re.sub(r"\s+", " ", text).strip()
+        return re.sub(r"^[\W_]+|[\W_]+$", "", text)
+
+    def make_key(self, model: str, history: list, user_input: str) -> str:
+        """
+        根据当前的对话历史（不包括本轮用户输入）和用户输入生成缓存键
+        """
+        system_prompt = history[0]["content"] if history and history[0].get("role") == "system" else ""
+
+        # 最近的对话（只包括有内容的用户/助手消息，工具调用和摘要不参与）
+        context = []
+        if self.context_messages:
+            for message in reversed(history):
+                if message.get("role") in ("user", "assistant") and message.get("content") \
+                        and not message.get("tool_calls"):
+                    context.append([message["role"], message["content"]])
+                    if len(context) >= self.context_messages:
+                        break
+            context.reverse()
+
+        parts = [model, system_prompt, context, self.normalize_utterance(user_input)]
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """读取缓存的回复，未命中或已过期返回None"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            self.counters["expired"] += 1
+            entry = None
+
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def put(self, key: str, text: str):
+        """缓存回复（空回复不缓存）"""
+        if not text:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, text)
+        self._entries.move_to_end(key)
+        self.counters["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        """缓存统计：命中/未命中次数、条目数量等"""
+        return dict(self.counters, entries=len(self._entries))
@@ -0,0 +1,90 @@
+import math
+import re
+
+# 中日韩文字（包括全角标点）
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+class TokenCounter:
+    """
+    本地token估算（不需要调用API，也不依赖分词器）：
+    - 按 DeepSeek 给出的经验值估算：1个中文字符约0.6个token，1个英文字符约0.3个token
+    - 每条消息的估算结果会缓存，历史记录追加消息时只需要计算新增的消息
+    - 可以用API返回的 prompt_tokens 校准估算的比例
+    """
+
+    # 每条消息的格式开销（角色、分隔符等）
+    MESSAGE_OVERHEAD = 4
+    # 每次请求的固定开销
+    REQUEST_OVERHEAD = 3
+
+    def __init__(self, cjk_ratio=0.6, other_ratio=0.3):
+        """
+        :param cjk_ratio: 每个中文字符的token数
+        :param other_ratio: 每个其他字符的token数
+        """
+        self.cjk_ratio = cjk_ratio
+        self.other_ratio = other_ratio
+        # 校准系数（实际token数 / 估算token数）
+        self.scale = 1.0
+
+        # 消息的缓存：id(message) -> (message, tokens)，保存消息的引用，保证id不会被复用
+        self._message_cache = {}
+        # 工具列表的缓存：(工具列表JSON, tokens)
+        self._tools_cache = ("", 0)
+
+    def count_text(self, text: str) -> int:
+        """估算一段文本的token数（未校准）"""
+        if not text:
+            return 0
+        cjk = len(_CJK_PATTERN.findall(text))
+        return math.ceil(cjk * self.cjk_ratio + (len(text) - cjk) * self.other_ratio)
+
+    def count_message(self, message: dict) -> int:
+        """估算一条消息的token数（未校准，结果会缓存）"""
+        entry = self._message_cache.get(id(message))
+        if entry is not None and entry[0] is message:
+            return entry[1]
+
+        tokens = self.MESSAGE_OVERHEAD + self.count_text(message.get("content") or "")
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call["function"] if isinstance(tool_call, dict) else tool_call.function
+            name, arguments = (function["name"], function["arguments"]) if isinstance(function, dict) \
+                else (function.name, function.arguments)
+            tokens += self.MESSAGE_OVERHEAD + self.count_text(name or "") + self.count_text(arguments or "")
+
+        self._message_cache[id(message)] = (message, tokens)
+        return tokens
+
+    def count_tools(self, tools_json: str) -> int:
+        """估算工具列表（JSON）的token数（未校准）"""
+        if self._tools_cache[0] is not tools_json:
+            self._tools_cache = (tools_json, self.count_text(tools_json))
+        return self._tools_cache[1]
+
+    def count(self, messages: list, tools_json: str = "") -> int:
+        """
+        估算一次请求的token数（消息 + 工具列表，已校准）
+        同时清理已经不在历史记录中的消息缓存
+        """
+        tokens = self.REQUEST_OVERHEAD + sum(self.count_message(message) for message in messages)
+        tokens += self.count_tools(tools_json)
+
+        if len(self._message_cache) > len(messages) * 2:
+            ids = {id(message) for message in messages}
+            self._message_cache = {key: entry for key, entry in self._message_cache.items() if key in ids}
+
+        return math.ceil(tokens * self.scale)
+
+    def calibrate(self, estimated_tokens: int, actual_tokens: int, alpha=0.3):
+        """
+        用API返回的实际token数校准估算比例
+        :param estimated_tokens: 请求前（已校准）估算的token数
+        :param actual_tokens: API返回的 prompt_tokens
+        :param alpha: 更新速度
+        """
+        if not estimated_tokens or not actual_tokens:
+            return
+        raw = estimated_tokens / self.scale
+        ratio = min(max(actual_tokens / raw, 0.5), 2.0)
+        self.scale += alpha * (ratio - self.scale)
@@ -1,13 +1,246 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
 import yaml
 from fastmcp import Client
+from fastmcp.client.messages import MessageHandler
+
+
+class _ToolListChangedHandler(MessageHandler):
+    """收到MCP服务器的 tools/list_changed 通知时，通知 MCPClientManager"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    async def on_tool_list_changed(self, message):
+        self.manager.notify_tools_changed()
+
+
+class MCPServerConnection:
+    """
+    单个MCP服务器的长连接：
+    - 第一次使用时连接（懒连接），断开后下次使用时自动重连，连续失败时按指数退避
+    - 同时进行的请求数量有上限，保护单个MCP服务器
+    - stdio服务器空闲一段时间后关闭子进程，下次使用时重新启动
+    """
+
+    def __init__(self, name, server_config, message_handler=None, max_concurrency=8, idle_timeout=600,
+                 reconnect_backoff=1, max_reconnect_backoff=60, ping_timeout=5):
+        """
+        :param name: 服务器名称（工具名称的前缀）
+        :param server_config: 服务器配置（config.yaml 中 mcp_servers 的一项）
+        :param message_handler: MCP消息处理器（工具列表变更通知等）
+        :param max_concurrency: 同时进行的请求数量上限
+        :param idle_timeout: stdio服务器空闲多久后关闭（秒），0表示不关闭
+        :param reconnect_backoff: 重连的初始退避时间（秒），每次失败后翻倍
+        :param max_reconnect_backoff: 重连的最大退避时间（秒）
+        :param ping_timeout: 健康检查的超时时间（秒）
+        """
+        self.name = name
+        self.is_stdio = server_config.get("transport") == "stdio" or "command" in server_config
+        # 每个服务器一个独立的客户端（工具名称不带前缀，由 MCPClientManager 统一加前缀）
+        self.client = Client({"mcpServers": {name: server_config}}, message_handler=message_handler)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.idle_timeout = idle_timeout
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.ping_timeout = ping_timeout
+
+        # 最近一次获取的工具列表（服务器因空闲关闭后，获取工具列表不需要重新启动服务器）
+        self.tools = None
+
+        self._lock = asyncio.Lock()
+        self._connected = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._active = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected and self.client.is_connected()
+
+    async def connect(self):
+        """确保已连接：断开的连接会重新连接，处于退避期时直接报错"""
+        async with self._lock:
+            if self.connected:
+                return
+            # 连接已经断开（服务器退出、网络中断等），先清理
+            if self._connected:
+                await self._disconnect()
+
+            now = time.monotonic()
+            if now < self._retry_at:
+                raise ConnectionError(f"MCP服务器 {self.name} 暂时不可用，{self._retry_at - now:.1f} 秒后重试")
+
+            try:
+                await self.client.__aenter__()
+            except Exception as e:
+                self._failures += 1
+                backoff = min(self.reconnect_backoff * 2 ** (self._failures - 1), self.max_reconnect_backoff)
+                self._retry_at = now + backoff
+                print(f"❌ MCP服务器 {self.name} 连接失败（{backoff} 秒内不再重试）: {e}")
+                raise
+
+            self._connected = True
+            self._failures = 0
+            self._retry_at = 0.0
+            self.last_used = time.monotonic()
+            print(f"✅ MCP服务器 {self.name} 已连接")
+
+    async def disconnect(self):
+        """断开连接（stdio服务器的子进程会退出）"""
+        async with self._lock:
+            await self._disconnect()
+
+    async def _disconnect(self):
+        if not self._connected:
+            return
+        self._connected = False
+        try:
+            await self.client.close()
+        except Exception as e:
+            print(f"❌ MCP服务器 {self.name} 断开连接出错: {e}")
+
+    @asynccontextmanager
+    async def session(self):
+        """占用一个请求名额并确保已连接，返回底层的客户端"""
+        async with self.semaphore:
+            await self.connect()
+            self._active += 1
+            try:
+                yield self.client
+            finally:
+                self._active -= 1
+                self.last_used = time.monotonic()
+
+    async def list_tools(self) -> list:
+        """获取工具列表（服务器未连接时使用最近一次的结果）"""
+        if self.tools is not None and not self.connected:
+            return self.tools
+        async with self.session() as client:
+            self.tools = await client.list_tools()
+        return self.tools
+
+    async def call_tool(self, tool_name: str, arguments: dict):
+        """调用工具（工具名称不带服务器前缀）"""
+        async with self.session() as client:
+            return await client.call_tool(tool_name, arguments)
+
+    async def health_check(self):
+        """
+        定期调用：关闭空闲的stdio服务器；检查空闲连接是否可用，不可用时断开（下次使用时重连）
+        """
+        if not self._connected or self._active:
+            return
+
+        if self.is_stdio and self.idle_timeout and time.monotonic() - self.last_used > self.idle_timeout:
+            print(f"💤 MCP服务器 {self.name} 空闲超过 {self.idle_timeout} 秒，关闭")
+            await self.disconnect()
+            return
+
+        try:
+            await asyncio.wait_for(self.client.ping(), self.ping_timeout)
+        except Exception as e:
+            print(f"❌ MCP服务器 {self.name} 健康检查失败，断开连接: {e}")
+            await self.disconnect()
+
 
 class MCPClientManager:
+    """
+    MCP客户端管理器：每个MCP服务器一个长连接，所有会话共享
+    - 工具名称格式为 "server_tool_name"（服务器名称 + '_' + 工具名称）
+    - 启动时预先连接所有服务器，之后定期做健康检查，连接断开后在下次使用时重连
+    """
+
     def __init__(self, config_path="config.yaml"):
         with open(config_path, "r") as f:
             config = yaml.safe_load(f)
-        # my_mcp client 实例（一个mcp client 对应 所有 my_mcp servers）
-        self.server_configs = {
-            "mcpServers": config.get("mcp_servers", {})
+        # 各个MCP服务器的配置
+        self.server_configs = config.get("mcp_servers", {})
+
+        # 连接池配置：默认配置 + 单个服务器的配置
+        pool_config = dict(config.get("mcp_pool") or {})
+        server_settings = pool_config.pop("servers", None) or {}
+        self.health_check_interval = pool_config.pop("health_check_interval", 30)
+
+        # 工具列表变化时的回调（如工具目录的刷新）
+        self.tools_changed_callbacks = []
+        message_handler = _ToolListChangedHandler(self)
+        self.servers = {
+            name: MCPServerConnection(name, server_config, message_handler,
+                                      **{**pool_config, **(server_settings.get(name) or {})})
+            for name, server_config in self.server_configs.items()
         }
-        # 使用转换后的配置初始化 Client
-        self.client = Client(self.server_configs)
+        self._health_task = None
+
+    async def start(self):
+        """预先连接所有服务器（连接失败的服务器在使用时重试），并启动健康检查"""
+        results = await asyncio.gather(*(server.connect() for server in self.servers.values()),
+                                       return_exceptions=True)
+        connected = sum(1 for result in results if not isinstance(result, BaseException))
+        print(f"MCP服务器已连接: {connected}/{len(self.servers)}")
+
+        if self.health_check_interval and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        """停止健康检查并断开所有服务器"""
+        if self._health_task:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        await asyncio.gather(*(server.disconnect() for server in self.servers.values()),
+                             return_exceptions=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await asyncio.gather(*(server.health_check() for server in self.servers.values()),
+                                 return_exceptions=True)
+
+    async def list_tools(self) -> list:
+        """
+        获取所有服务器的工具列表（工具名称加上服务器前缀）
+        某个服务器不可用时跳过该服务器
+        """
+        async def server_tools(name, server):
+            try:
+                tools = await server.list_tools()
+            except Exception as e:
+                print(f"❌ 获取MCP服务器 {name} 的工具列表失败: {e}")
+                return []
+            return [tool.model_copy(update={"name": f"{name}_{tool.name}"}) for tool in tools]
+
+        results = await asyncio.gather(*(server_tools(name, server) for name, server in self.servers.items()))
+        return [tool for tools in results for tool in tools]
+
+    async def call_tool(self, tool_name: str, arguments: dict):
+        """
+        调用工具
+        :param tool_name: 带服务器前缀的工具名称（根据第一个 '_' 来分割）
+        :param arguments: 工具参数
+        """
+        server_name, _, function_name = tool_name.partition('_')
+        server = self.servers.get(server_name)
+        if server is None:
+            raise ValueError(f"未知的MCP服务器: {server_name}")
+        return await server.call_tool(function_name, arguments)
+
+    def add_tools_changed_callback(self, callback):
+        """注册工具列表变化时的回调"""
+        self.tools_changed_callbacks.append(callback)
+
+    def notify_tools_changed(self):
+        """MCP服务器的工具列表发生变化"""
+        print("🔄 MCP工具列表已变化")
+        for callback in self.tools_changed_callbacks:
+            callback()
@@ -0,0 +1,70 @@
+import json
+import time
+from collections import OrderedDict
+
+
+class ToolResultCache:
+    """
+    工具结果缓存：结果不变或变化很慢的工具（地理编码、计算器等）直接使用缓存的结果，不再请求MCP服务器
+    - 缓存键：工具名称 + 规范化的JSON参数（键排序、去掉多余的空白）
+    - 每个工具是否缓存以及缓存时长在 tools_whitelist.yaml 中配置（cache_ttl），由 ToolExecutor 决定
+    - 条目数量和总字节数都有上限，超过后淘汰最久未使用的条目
+    所有会话共享一个实例（由SessionManager提供）
+    """
+
+    def __init__(self, max_entries=1000, max_mb=16):
+        """
+        :param max_entries: 缓存条目数量上限
+        :param max_mb: 缓存结果的总大小上限（MB）
+        """
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+        # key -> (过期时间, 结果文本, 字节数)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(tool_name: str, arguments: dict) -> str:
+        """生成缓存键（参数的顺序和格式不影响结果）"""
+        return tool_name + ":" + json.dumps(arguments, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    def get(self, key: str):
+        """读取缓存的结果，未命中或已过期返回None"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            self.counters["expired"] += 1
+            entry = None
+
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def put(self, key: str, content: str, ttl: float):
+        """缓存结果，ttl为缓存时长（秒）"""
+        size = len(content.encode("utf-8"))
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + ttl, content, size)
+        self._bytes += size
+        self.counters["stores"] += 1
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        """缓存统计：命中/未命中次数、条目数量、字节数等"""
+        return dict(self.counters, entries=len(self._entries), bytes=self._bytes)
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import yaml
+
+
+class ToolCatalog:
+    """
+    进程级的工具目录：所有会话共享同一份经过白名单过滤的工具列表
+    - 白名单在加载时编译为索引（服务器 -> 允许的工具集合），过滤时不再逐个遍历配置
+    - 工具列表（OpenAI API格式）只构建一次，所有会话共享同一个列表
+    - 超过有效期（catalog.ttl）或收到MCP服务器的 tools/list_changed 通知后，下次使用时重新获取
+    - 工具按名称排序，刷新后没有变化时保持原来的列表，请求中的工具定义保持不变（便于命中LLM的提示词缓存）
+    新的设备连接直接使用已有的工具列表，不需要请求每个MCP服务器
+    """
+
+    def __init__(self, mcp_client, whitelist_path=None):
+        """
+        :param mcp_client: MCPClientManager 实例
+        :param whitelist_path: 工具白名单配置路径（tools_whitelist.yaml），为空则允许所有工具
+        """
+        self.mcp_client = mcp_client
+        self.tools_whitelist = self._load_tools_whitelist(whitelist_path)
+
+        catalog_config = (self.tools_whitelist or {}).get("catalog") or {}
+        # 工具列表的有效期（秒），0表示只在收到变更通知时刷新
+        self.ttl = catalog_config.get("ttl", 300)
+
+        # 编译后的白名单：服务器名称 -> 允许的工具名称集合（None表示允许所有工具）
+        self._allowed = self._compile_whitelist(self.tools_whitelist)
+
+        # OpenAI API格式的工具列表及其JSON（用于估算token等）
+        self.tools = None
+        self.tools_json = ""
+        self._loaded_at = 0.0
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+        # MCP服务器的工具列表变化时，标记需要刷新
+        mcp_client.add_tools_changed_callback(self.invalidate)
+
+    @staticmethod
+    def _load_tools_whitelist(whitelist_path):
+        """加载工具白名单配置文件"""
+        if not whitelist_path or not Path(whitelist_path).exists():
+            return None
+
+        with open(whitelist_path, 'r', encoding='utf-8') as f:
+            return yaml.safe_load(f)
+
+    @staticmethod
+    def _compile_whitelist(tools_whitelist):
+        """将白名单配置编译为 服务器名称 -> 允许的工具集合 的索引（只包含已启用的服务器）"""
+        if not tools_whitelist:
+            return None
+
+        allowed = {}
+        for server_name, server_config in (tools_whitelist.get('mcp_servers') or {}).items():
+            server_config = server_config or {}
+            if not server_config.get('enabled', False):
+                continue
+            allowed[server_name] = None if server_config.get('allow_all', False) \
+                else frozenset(server_config.get('tools') or [])
+        return allowed
+
+    def is_tool_allowed(self, tool_name: str) -> bool:
+        """检查工具是否在白名单中（工具名称格式为 "server_tool_name"，根据第一个 '_' 来分割）"""
+        if self._allowed is None:
+            return True  # 如果没有白名单，则允许所有工具
+
+        server_name, _, function_name = tool_name.partition('_')
+        if server_name not in self._allowed:
+            return False
+        allowed_tools = self._allowed[server_name]
+        return allowed_tools is None or function_name in allowed_tools
+
+    def invalidate(self):
+        """标记工具列表需要刷新（下次获取时重新请求MCP服务器）"""
+        self._stale = True
+
+    def _is_fresh(self) -> bool:
+        if self.tools is None or self._stale:
+            return False
+        return not self.ttl or time.monotonic() - self._loaded_at < self.ttl
+
+    async def get_tools(self) -> list:
+        """
+        获取工具列表（OpenAI API格式），需要时刷新
+        并发的会话只会触发一次刷新
+        """
+        if self._is_fresh():
+            return self.tools
+
+        async with self._lock:
+            if not self._is_fresh():
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    # 刷新失败时继续使用旧的工具列表
+                    if self.tools is None:
+                        raise
+                    print(f"❌ 刷新工具列表失败，继续使用旧的工具列表: {e}")
+                    self._loaded_at = time.monotonic()
+        return self.tools
+
+    async def refresh(self):
+        """请求MCP服务器的工具列表，根据白名单过滤，并构建OpenAI API格式的工具列表"""
+        # 先清除标记：刷新过程中收到的变更通知会触发下一次刷新
+        self._stale = False
+        tools = await self.mcp_client.list_tools()
+        # 根据白名单过滤
+        filtered_tools = [tool for tool in tools if self.is_tool_allowed(tool.name)]
+
+        # 按名称排序，保证工具列表与MCP服务器返回的顺序无关（工具列表是请求前缀的一部分，需要逐字节稳定才能命中提示词缓存）
+        tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.inputSchema
+                }
+            }
+            for tool in sorted(filtered_tools, key=lambda tool: tool.name)
+        ]
+        # 工具没有变化时继续使用原来的列表
+        if tools != self.tools:
+            self.tools = tools
+            self.tools_json = json.dumps(self.tools, ensure_ascii=False)
+        self._loaded_at = time.monotonic()
+
+        print(f"总工具数: {len(tools)}, 过滤后工具数: {len(filtered_tools)}")
+        print(f"tools: {[tool.name for tool in filtered_tools]}")
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+
+from my_metrics.metrics import observe_stage
+
+
+class ToolExecutor:
+    """
+    工具执行器：执行LLM在一条回复中请求的所有工具调用
+    - 相互独立的工具调用同时执行（数量上限可配置），总耗时约等于最慢的那个工具
+    - 每个工具有自己的超时时间（在 tools_whitelist.yaml 中配置），超时的工具返回错误信息给LLM，不会卡住整轮对话
+    - 返回的工具结果与 tool_calls 的顺序一致
+    - 配置了 cache_ttl 的工具，结果会缓存在 result_cache 中
+    """
+
+    def __init__(self, mcp_client, tools_whitelist: dict = None, result_cache=None):
+        """
+        :param mcp_client: MCPClientManager 实例
+        :param tools_whitelist: 工具白名单配置（tools_whitelist.yaml 的内容），
+            其中 execution 为执行配置，mcp_servers.<server>.timeout / cache_ttl 为服务器的配置，
+            mcp_servers.<server>.tool_settings.<tool> 为单个工具的配置（覆盖服务器的配置）
+        :param result_cache: 工具结果缓存（ToolResultCache），None表示不缓存
+        """
+        self.mcp_client = mcp_client
+        self.tools_whitelist = tools_whitelist or {}
+        self.result_cache = result_cache
+
+        execution_config = self.tools_whitelist.get("execution") or {}
+        # 同一条回复中同时执行的工具调用数量上限
+        self.max_concurrency = execution_config.get("max_concurrency", 4)
+        # 默认的超时时间（秒）
+        self.default_timeout = execution_config.get("timeout", 30)
+
+    def _get_setting(self, tool_name: str, key: str, default):
+        """
+        获取工具的配置项：工具的配置 > 服务器的配置 > 默认值
+        工具名称格式为 "server_tool_name"，根据第一个 '_' 来分割
+        """
+        server_name, _, function_name = tool_name.partition('_')
+        server_config = (self.tools_whitelist.get("mcp_servers") or {}).get(server_name) or {}
+        tool_config = (server_config.get("tool_settings") or {}).get(function_name) or {}
+        return tool_config.get(key, server_config.get(key, default))
+
+    def get_timeout(self, tool_name: str) -> float:
+        """获取工具的超时时间（秒）"""
+        return self._get_setting(tool_name, "timeout", self.default_timeout)
+
+    def get_cache_ttl(self, tool_name: str) -> float:
+        """获取工具结果的缓存时长（秒），0表示不缓存"""
+        return self._get_setting(tool_name, "cache_ttl", 0)
+
+    async def execute(self, tool_calls) -> list:
+        """
+        执行所有工具调用
+        :param tool_calls: LLM回复中的 tool_calls
+        :return: 工具消息列表（role为tool），顺序与 tool_calls 一致，可以直接添加到对话历史
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(tool_call):
+            async with semaphore:
+                return await self._call_tool(tool_call)
+
+        contents = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+
+        return [
+            {
+                "role": "tool",
+                "content": content,
+                "tool_call_id": tool_call.id
+            }
+            for tool_call, content in zip(tool_calls, contents)
+        ]
+
+    async def _call_tool(self, tool_call) -> str:
+        """
+        执行单个工具调用，返回工具结果的文本；出错或超时时返回错误信息（交给LLM处理）
+        """
+        tool_name = tool_call.function.name
+        timeout = self.get_timeout(tool_name)
+        cache_ttl = self.get_cache_ttl(tool_name) if self.result_cache else 0
+        print(f"  - Calling tool: {tool_name}")
+        try:
+            arguments = json.loads(tool_call.function.arguments or "{}")
+
+            # 先查缓存
+            cache_key = None
+            if cache_ttl > 0:
+                cache_key = self.result_cache.make_key(tool_name, arguments)
+                content = self.result_cache.get(cache_key)
+                if content is not None:
+                    print(f"✅ Tool call cached: {tool_name}, arguments: {tool_call.function.arguments},  Result: {content}")
+                    return content
+
+            # 使用MCP管理器执行调用（记录耗时，超时和出错也会记录，provider为MCP服务器名称）
+            started_at = time.perf_counter()
+            try:
+                tool_result = await asyncio.wait_for(self.mcp_client.call_tool(tool_name, arguments), timeout)
+            finally:
+                observe_stage("tool_call", time.perf_counter() - started_at, tool_name.partition('_')[0])
+            content = tool_result.content[0].text
+
+            # 只缓存成功的结果
+            if cache_key and not getattr(tool_result, "is_error", False):
+                self.result_cache.put(cache_key, content, cache_ttl)
+
+            print(f"✅ Tool call successful: {tool_name}, arguments: {tool_call.function.arguments},  Result: {content}")
+            return content
+        except asyncio.TimeoutError:
+            error_message = f"工具调用超时: {tool_name}, 超过 {timeout} 秒没有返回结果"
+        except Exception as e:
+            error_message = f"工具调用失败: {tool_name}, 错误: {str(e)}"
+
+        print(f"❌ {error_message}")
+        return error_message
@@ -0,0 +1,205 @@
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 默认的直方图桶（秒）：覆盖从几毫秒的发送到几十秒的LLM回复
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+# 输出的分位数
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def _quantile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Series:
+    """直方图中一组标签对应的数据"""
+
+    __slots__ = ("bucket_counts", "count", "sum", "recent")
+
+    def __init__(self, bucket_count: int, window: int):
+        self.bucket_counts = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+        # 最近的样本（计算分位数用）
+        self.recent = deque(maxlen=window)
+
+
+class Histogram:
+    """
+    直方图（Prometheus的histogram类型），按标签分组记录耗时
+    - 累计的桶计数：可以在Prometheus中用 histogram_quantile 计算任意时间段的分位数
+    - 最近的若干个样本：直接在 /metrics 中输出 p50/p95/p99（不需要Prometheus也能查看）
+    记录样本时加锁，可以在线程中调用（如在线程池中执行的ASR请求）
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, window=1024):
+        """
+        :param name: 指标名称
+        :param documentation: 指标说明
+        :param labelnames: 标签名称
+        :param buckets: 桶的上限（秒），会自动加上 +Inf
+        :param window: 计算分位数使用的最近样本数量
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.window = window
+        # 标签值 -> _Series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """记录一个样本"""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.buckets), self.window)
+            series.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.count += 1
+            series.sum += value
+            series.recent.append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 代码块的耗时（出错时也会记录）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def reset(self):
+        """清空所有样本（如基准测试在预热之后重新开始统计）"""
+        with self._lock:
+            self._series.clear()
+
+    def label_sets(self) -> list:
+        """所有已记录样本的标签组合：[{标签名称: 标签值}]"""
+        with self._lock:
+            return [dict(zip(self.labelnames, key)) for key in sorted(self._series)]
+
+    def quantiles(self, **labels) -> dict:
+        """最近样本的分位数：{0.5: ..., 0.95: ..., 0.99: ...}，没有样本时返回空字典"""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None or not series.recent:
+            return {}
+        with self._lock:
+            values = sorted(series.recent)
+        return {q: _quantile(values, q) for q in QUANTILES}
+
+    def render(self) -> list:
+        """输出Prometheus文本格式的行（直方图 + 最近样本的分位数）"""
+        with self._lock:
+            snapshot = sorted((key, list(series.bucket_counts), series.count, series.sum, sorted(series.recent))
+                              for key, series in self._series.items())
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, bucket_counts, count, total, _ in snapshot:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+
+        # 分位数单独作为一个summary类型的指标（同一个指标不能同时是两种类型）
+        recent_name = f"{self.name}_recent"
+        lines.append(f"# HELP {recent_name} {self.documentation} (quantiles of the last {self.window} samples)")
+        lines.append(f"# TYPE {recent_name} summary")
+        for key, _, _, _, values in snapshot:
+            if not values:
+                continue
+            labels = dict(zip(self.labelnames, key))
+            for q in QUANTILES:
+                lines.append(f"{recent_name}{_format_labels({**labels, 'quantile': q})} "
+                             f"{_format_value(_quantile(values, q))}")
+            lines.append(f"{recent_name}_sum{_format_labels(labels)} {_format_value(sum(values))}")
+            lines.append(f"{recent_name}_count{_format_labels(labels)} {len(values)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表：直方图 + 在输出时读取的统计数据（缓存命中数、会话数量等）
+    render 输出Prometheus文本格式，由ws_server的 /metrics 接口返回
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        # (指标名称前缀, 说明, 返回 {名称: 数值} 的函数)
+        self._stats = []
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        """获取（不存在时创建）直方图"""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, documentation, labelnames, buckets)
+        return self.histograms[name]
+
+    def register_stats(self, prefix: str, documentation: str, stats_func):
+        """
+        注册统计数据：输出时调用 stats_func()，每一项输出为一个gauge指标 "<prefix>_<名称>"
+        如 register_stats("tts_cache", "TTS音频缓存", tts_cache.stats)
+        """
+        self._stats.append((prefix, documentation, stats_func))
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+
+        for prefix, documentation, stats_func in self._stats:
+            try:
+                stats = stats_func()
+            except Exception as e:
+                print(f"❌ 读取统计数据失败（{prefix}）: {e}")
+                continue
+            for key, value in stats.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {documentation}: {key}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程级的注册表
+REGISTRY = MetricsRegistry()
+
+# 语音对话各阶段的耗时，stage 为阶段名称，provider 为服务提供方（LLM/TTS/ASR引擎、MCP服务器等）
+STAGE_LATENCY = REGISTRY.histogram("voice_stage_latency_seconds", "Latency of each voice pipeline stage",
+                                   ("stage", "provider"))
+
+
+def observe_stage(stage: str, seconds: float, provider: str = ""):
+    """记录一个阶段的耗时（秒）"""
+    STAGE_LATENCY.observe(seconds, stage=stage, provider=provider)
+
+
+def stage_timer(stage: str, provider: str = ""):
+    """记录 with 代码块的耗时：with stage_timer("asr", "sensevoice"): ..."""
+    return STAGE_LATENCY.time(stage=stage, provider=provider)
@@ -1,4 +1,8 @@
-from openai import OpenAI
+import time
+
+from openai import AsyncOpenAI
+
+from my_metrics.metrics import observe_stage, stage_timer
 
 class CosyVoiceEngine:
     """文本转语音处理器"""
@@ -6,13 +10,20 @@ class CosyVoiceEngine:
     def __init__(self, tts_config: dict):
         self.api_key = tts_config["api_key"]
         self.base_url = tts_config["base_url"]
-        # TTS客户端
-        self.tts_client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        # TTS客户端（异步，多个句子/会话的合成请求可以并行）
+        self.tts_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
 
         self.model = tts_config["model"]
         self.voice = tts_config["voice"]
         self.response_format = tts_config["response_format"]
 
+    def cache_key_parts(self) -> dict:
+        """
+        影响合成结果的参数（不包括文本），用于TTS缓存的键
+        """
+        return {"engine": "cosy_voice", "model": self.model, "voice": self.voice,
+                "response_format": self.response_format}
+
     async def text_to_speech(self, text: str) -> bytes:
         """
         将文本转换为语音数据，返回可直接播放的音频字节数据
@@ -29,15 +40,53 @@ class CosyVoiceEngine:
         }
 
         try:
-            with self.tts_client.audio.speech.with_streaming_response.create(
-                    **params
-            ) as response:
-                # 读取所有音频数据
-                audio_data = response.read()
+            with stage_timer("tts_total", "cosy_voice"):
+                async with self.tts_client.audio.speech.with_streaming_response.create(
+                        **params
+                ) as response:
+                    # 读取所有音频数据
+                    audio_data = await response.read()
 
-                print(f"[CosyVoiceEngine] 音频数据长度: {len(audio_data)} bytes")
+            print(f"[CosyVoiceEngine] 音频数据长度: {len(audio_data)} bytes")
+
+            return audio_data
+        except Exception as e:
+            print(f"TTS API调用失败: {e}")
+            raise
+
+    async def text_to_speech_stream(self, text: str, chunk_size: int = 4096):
+        """
+        流式文本转语音：后端每返回一块音频数据就立即产出，不等待整句合成完成
+        Args:
+            text: 要转换为语音的文本
+            chunk_size: 每次读取的字节数
+        Yields:
+            bytes: 音频数据块（第一个块包含音频格式头）
+        """
+        params = {
+            "model": self.model,
+            "voice": self.voice,
+            "input": text,
+            "response_format": self.response_format,
+            # SiliconFlow 的语音合成接口支持流式返回
+            "extra_body": {"stream": True},
+        }
 
-                return audio_data
+        total_bytes = 0
+        started_at = time.perf_counter()
+        try:
+            async with self.tts_client.audio.speech.with_streaming_response.create(
+                    **params
+            ) as response:
+                async for chunk in response.iter_bytes(chunk_size):
+                    if not total_bytes:
+                        observe_stage("tts_first_byte", time.perf_counter() - started_at, "cosy_voice")
+                    total_bytes += len(chunk)
+                    yield chunk
         except Exception as e:
             print(f"TTS API调用失败: {e}")
             raise
+
+        observe_stage("tts_total", time.perf_counter() - started_at, "cosy_voice")
+
+        print(f"[CosyVoiceEngine] 流式音频数据长度: {total_bytes} bytes")
@@ -1,4 +1,8 @@
+import time
+
+import httpx
 import requests
+from my_metrics.metrics import observe_stage, stage_timer
 from my_tts.audio_player import AudioPlayer
 
 class GPTSoVTISEngine:
@@ -11,6 +15,7 @@ class GPTSoVTISEngine:
         初始化GPT-SoVITS引擎
         """
         location = "remote" if remote else "local"
+        self.role = role
         self.gpt_sovits_config = tts_config.get(location, {})
         # url
         self.base_url = self.gpt_sovits_config.get("base_url", {})
@@ -25,20 +30,17 @@ class GPTSoVTISEngine:
         self.prompt_lang = self.role_config.get("prompt_lang", {})
         self.ref_audio_emotion_config = self.role_config.get("ref_audio_emotion", {})
 
-    async def text_to_speech(self, text: str, text_lang="zh", emotion="normal") -> bytes:
+        # 合成请求使用异步HTTP客户端（复用连接，不阻塞事件循环）
+        self.http_client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=5.0))
+
+    def _build_tts_request(self, text: str, text_lang: str, emotion: str) -> dict:
         """
-        将文本转换为语音数据，返回可直接播放的音频字节数据
-        Args:
-            text: 要转换为语音的文本
-            text_lang: 文本语言，默认为中文（zh）
-            emotion: 参考音频情感，默认为"normal"，可选值包括"normal", "happy", "angry",不同角色拥有的情绪不同
-        Returns:
-            bytes: 音频字节数据
+        构造 /tts 接口的请求参数
         """
         # 如果有当前情绪的参考音频就使用，否则使用“normal”默认的
         ref_audio_config = self.ref_audio_emotion_config.get(emotion, self.ref_audio_emotion_config.get("normal", {}))
 
-        data = {
+        return {
             "text": text,
             "text_lang": text_lang,
             "prompt_lang": self.prompt_lang,
@@ -47,14 +49,64 @@ class GPTSoVTISEngine:
             "sample_steps": self.role_config.get("sample_steps", 16),
         }
 
+    def cache_key_parts(self, text_lang="zh", emotion="normal") -> dict:
+        """
+        影响合成结果的参数（不包括文本），用于TTS缓存的键
+        """
+        data = self._build_tts_request("", text_lang, emotion)
+        return {"engine": "gpt_sovits", "role": self.role, "emotion": emotion,
+                "sample_steps": data["sample_steps"], "text_lang": text_lang,
+                "ref_audio_path": data["ref_audio_path"]}
+
+    async def text_to_speech(self, text: str, text_lang="zh", emotion="normal") -> bytes:
+        """
+        将文本转换为语音数据，返回可直接播放的音频字节数据
+        Args:
+            text: 要转换为语音的文本
+            text_lang: 文本语言，默认为中文（zh）
+            emotion: 参考音频情感，默认为"normal"，可选值包括"normal", "happy", "angry",不同角色拥有的情绪不同
+        Returns:
+            bytes: 音频字节数据
+        """
+        data = self._build_tts_request(text, text_lang, emotion)
+
         # 使用v4版本的GPT-SoVITS API（v2暂时有问题，还没有改）
-        response = requests.post(f"{self.base_url}/tts", json=data)
+        with stage_timer("tts_total", "gpt_sovits"):
+            response = await self.http_client.post(f"{self.base_url}/tts", json=data)
 
         if response.status_code != 200:
             raise Exception(f"请求GPT-SoVITS出错: {response.text}")
 
         return response.content
 
+    async def text_to_speech_stream(self, text: str, text_lang="zh", emotion="normal"):
+        """
+        流式文本转语音：使用GPT-SoVITS的streaming_mode，后端每合成一段音频就立即产出
+        Args:
+            text: 要转换为语音的文本
+            text_lang: 文本语言，默认为中文（zh）
+            emotion: 参考音频情感
+        Yields:
+            bytes: 音频数据块（第一个块为wav头）
+        """
+        data = self._build_tts_request(text, text_lang, emotion)
+        data["streaming_mode"] = True
+
+        started_at = time.perf_counter()
+        first_chunk = True
+        async with self.http_client.stream("POST", f"{self.base_url}/tts", json=data) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"请求GPT-SoVITS出错: {response.text}")
+
+            async for chunk in response.aiter_bytes():
+                if first_chunk:
+                    first_chunk = False
+                    observe_stage("tts_first_byte", time.perf_counter() - started_at, "gpt_sovits")
+                yield chunk
+
+        observe_stage("tts_total", time.perf_counter() - started_at, "gpt_sovits")
+
     def switch_role_audio(self, gpt_model_path: str, sovits_model_path: str):
         """
         切换角色音频模型
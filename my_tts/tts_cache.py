@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本（全角/半角统一、合并空白），作为缓存键的一部分"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class _Flight:
+    """
+    一次正在进行的合成（single-flight）：相同的并发请求只调用一次后端，
+    其他请求跟随读取同一份音频块
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.changed = asyncio.Condition()
+
+    async def publish(self, chunk: bytes = None, done=False, error=None, cancelled=False):
+        async with self.changed:
+            if chunk:
+                self.chunks.append(chunk)
+            if done:
+                self.done = True
+                self.error = error
+                self.cancelled = cancelled
+            self.changed.notify_all()
+
+
+class TTSCache:
+    """
+    TTS音频缓存（按内容寻址）：
+    - 内存层：按字节数限制大小，LRU淘汰
+    - 磁盘层（可选）：内存中淘汰的音频仍可以从磁盘读取，磁盘也按字节数限制大小
+    - 相同的并发请求合并为一次后端调用（single-flight）
+    """
+
+    def __init__(self, max_memory_mb=64, disk_dir=None, max_disk_mb=512):
+        """
+        :param max_memory_mb: 内存层的大小上限（MB）
+        :param disk_dir: 磁盘层的目录，为空则不使用磁盘层
+        :param max_disk_mb: 磁盘层的大小上限（MB）
+        """
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = self._scan_disk() if self.disk_dir else 0
+        self._flights = {}
+        # 正在进行的磁盘写入任务（保留引用，避免被回收）
+        self._disk_tasks = set()
+        # 磁盘写入在多个线程中同时进行：磁盘层的字节数和淘汰需要加锁
+        self._disk_lock = threading.Lock()
+
+        self.counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+                         "bytes_served": 0, "bytes_stored": 0, "evictions": 0}
+
+    def stats(self) -> dict:
+        """缓存统计：命中/未命中次数、字节数等"""
+        return dict(self.counters, memory_bytes=self._memory_bytes, memory_items=len(self._memory),
+                    disk_bytes=self._disk_bytes, inflight=len(self._flights))
+
+    async def get(self, key: str):
+        """读取缓存，先查内存层再查磁盘层，未命中返回None"""
+        audio = self._memory.get(key)
+        if audio is not None:
+            self._memory.move_to_end(key)
+            self.counters["memory_hits"] += 1
+        elif self.disk_dir:
+            audio = await asyncio.to_thread(self._read_disk, key)
+            if audio is not None:
+                self.counters["disk_hits"] += 1
+                self._put_memory(key, audio)
+
+        if audio is not None:
+            self.counters["hits"] += 1
+            self.counters["bytes_served"] += len(audio)
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        """写入缓存（内存层立即写入，磁盘层在后台写入）"""
+        if not audio:
+            return
+        self.counters["bytes_stored"] += len(audio)
+        self._put_memory(key, audio)
+        if self.disk_dir:
+            task = asyncio.create_task(asyncio.to_thread(self._write_disk, key, audio))
+            self._disk_tasks.add(task)
+            task.add_done_callback(self._on_disk_write_done)
+
+    def _on_disk_write_done(self, task: asyncio.Task):
+        """磁盘写入任务结束：输出写入失败的原因（写入失败不影响内存层）"""
+        self._disk_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ TTS缓存写入磁盘失败: {task.exception()}")
+
+    async def fetch(self, key: str, produce):
+        """
+        读取缓存，未命中时调用 produce() 产生音频（异步迭代器，产出音频块）并写入缓存
+        相同key的并发请求只有第一个会调用 produce，其他请求跟随读取同一份音频块
+        :return: 异步生成器，产出音频块
+        """
+        audio = await self.get(key)
+        if audio is not None:
+            yield audio
+            return
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            # 跟随正在进行的合成
+            self.counters["coalesced"] += 1
+            index = 0
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: len(flight.chunks) > index or flight.done)
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.done:
+                    break
+            if flight.cancelled and index == 0:
+                # 发起合成的请求被取消（如用户打断），自己重新请求
+                async for chunk in self.fetch(key, produce):
+                    yield chunk
+            elif flight.cancelled:
+                raise RuntimeError("TTS合成在中途被取消，音频不完整")
+            elif flight.error:
+                raise flight.error
+            return
+
+        # 发起合成
+        self.counters["misses"] += 1
+        flight = _Flight()
+        self._flights[key] = flight
+        try:
+            async for chunk in produce():
+                await flight.publish(chunk)
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            await asyncio.shield(flight.publish(done=True, cancelled=True))
+            raise
+        except Exception as e:
+            await flight.publish(done=True, error=e)
+            raise
+        else:
+            self.put(key, b"".join(flight.chunks))
+            await flight.publish(done=True)
+        finally:
+            self._flights.pop(key, None)
+
+    def _put_memory(self, key: str, audio: bytes):
+        """写入内存层，超过大小上限时淘汰最久未使用的音频"""
+        if len(audio) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.audio")
+
+    def _read_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            # 更新访问时间，磁盘淘汰时按最久未使用的顺序
+            os.utime(path)
+            return audio
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key: str, audio: bytes):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        # 先写临时文件再重命名，避免读到写了一半的文件（每次写入使用不同的临时文件，同一个key可能同时写入）
+        fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            with self._disk_lock:
+                if os.path.exists(path):
+                    os.remove(temp_path)
+                    return
+                os.replace(temp_path, path)
+                self._disk_bytes += len(audio)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _scan_disk(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith(".audio"))
+
+    def _evict_disk(self):
+        """磁盘层超过大小上限时，删除最久未使用的文件，直到降到上限的90%（持有 _disk_lock 时调用）"""
+        entries = sorted((entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".audio")),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+        self._disk_bytes = total
+
+
+class CachedTTSEngine:
+    """
+    带缓存的TTS引擎：对外接口与TTS引擎相同（text_to_speech / text_to_speech_stream）
+    缓存键由引擎提供的参数（引擎、模型/音色或角色、情绪、sample_steps等）和规范化后的文本组成
+    """
+
+    def __init__(self, engine, cache: TTSCache):
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # 其他属性和方法直接使用原引擎的
+        return getattr(self.engine, name)
+
+    def _cache_key(self, text: str, mode: str, **kwargs) -> str:
+        parts = {
+            "engine": self.engine.cache_key_parts(**kwargs),
+            "mode": mode,
+            "text": normalize_text(text),
+        }
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def text_to_speech(self, text: str, **kwargs) -> bytes:
+        key = self._cache_key(text, "full", **kwargs)
+
+        async def produce():
+            yield await self.engine.text_to_speech(text, **kwargs)
+
+        return b"".join([chunk async for chunk in self.cache.fetch(key, produce)])
+
+    async def text_to_speech_stream(self, text: str, **kwargs):
+        key = self._cache_key(text, "stream", **kwargs)
+
+        async for chunk in self.cache.fetch(key, lambda: self.engine.text_to_speech_stream(text, **kwargs)):
+            yield chunk
@@ -0,0 +1,187 @@
+import time
+from typing import NamedTuple, Optional, List
+
+# 事件类型
+SPEECH_START = "speech_start"
+SPEECH_END = "speech_end"
+
+
+class VADEvent(NamedTuple):
+    """
+    VAD流输出的事件
+    type: SPEECH_START 或 SPEECH_END
+    audio: SPEECH_END 时为整段语音（包括预录部分）的memoryview，在下一次调用 feed 之前有效；SPEECH_START 时为None
+    """
+    type: str
+    audio: Optional[memoryview] = None
+
+
+class VADStream:
+    """
+    推送式的VAD流：不关心数据来自哪种传输方式，调用 feed 送入任意长度的PCM字节，返回检测到的事件
+    - 所有缓冲区都是预分配的bytearray，完整的帧直接在输入数据上切片检测（不拼接、不从头重新切片）
+    - 预录环形缓冲保留语音开始前的若干帧，避免第一个音节被截断
+    - 单段语音有长度上限，达到上限时强制结束
+    每个会话的内存和CPU开销与说话时长无关
+    """
+
+    def __init__(self, vad, pre_roll_ms=300, max_utterance_ms=20000, max_silence_ms=None, sample_rate=None):
+        """
+        :param vad: WebRTCVAD 实例（提供帧长度和语音检测）
+        :param pre_roll_ms: 预录时长（毫秒）
+        :param max_utterance_ms: 单段语音的最大时长（毫秒），超过后强制结束
+        :param max_silence_ms: 最大静音时长（毫秒），默认使用 vad 的配置
+        :param sample_rate: 检测时使用的采样率，默认使用 vad 的配置
+        """
+        self.vad = vad
+        self.sample_rate = sample_rate
+        self.frame_bytes = vad.frame_bytes
+        self.frame_duration_ms = vad.frame_duration_ms
+        self.max_silence_ms = max_silence_ms if max_silence_ms is not None else vad.max_silence_ms
+
+        # 输入缓冲：保存上一次 feed 剩下的不足一帧的数据
+        self._pending = bytearray(self.frame_bytes)
+        self._pending_len = 0
+
+        # 预录环形缓冲
+        self.pre_roll_frames = pre_roll_ms // self.frame_duration_ms
+        self._pre_roll = bytearray(self.pre_roll_frames * self.frame_bytes)
+        self._pre_roll_pos = 0
+        self._pre_roll_count = 0
+
+        # 语音缓冲（说话时才分配）：两块交替使用，
+        #  同一次 feed 中结束一段语音后又开始新的语音时，不会覆盖刚输出的那一段
+        self.max_utterance_bytes = (max_utterance_ms // self.frame_duration_ms) * self.frame_bytes
+        self._buffers = [None, None]
+        self._current = 0
+        self._utterance_len = 0
+
+        self.is_speaking = False
+        self._silence_ms = 0
+        self._ended_in_feed = False
+        # 当前这段语音中语音帧的数量（不包括预录和中间的静音帧），用于判断用户是否确实在说话（打断）
+        self.speech_frames = 0
+        # 最后一个语音帧的处理时间（time.perf_counter），用于统计从说完话到检测到语音结束的耗时
+        self.last_speech_at = None
+
+    def feed(self, data) -> List[VADEvent]:
+        """
+        送入PCM数据（16bit单声道，bytes/bytearray/memoryview/NumPy数组均可），返回本次检测到的事件列表
+        """
+        events = []
+        self._ended_in_feed = False
+
+        view = memoryview(data)
+        if view.format != "B" or view.ndim != 1:
+            view = view.cast("B")
+        size = len(view)
+        offset = 0
+
+        # 1.先补齐上一次剩下的不完整帧
+        if self._pending_len:
+            take = min(self.frame_bytes - self._pending_len, size)
+            self._pending[self._pending_len:self._pending_len + take] = view[:take]
+            self._pending_len += take
+            offset = take
+            if self._pending_len < self.frame_bytes:
+                return events
+            self._process_frame(memoryview(self._pending), events)
+            self._pending_len = 0
+
+        # 2.完整的帧直接在输入数据上切片处理（零拷贝）
+        while offset + self.frame_bytes <= size:
+            self._process_frame(view[offset:offset + self.frame_bytes], events)
+            offset += self.frame_bytes
+
+        # 3.保存剩余不足一帧的数据
+        rest = size - offset
+        if rest:
+            self._pending[:rest] = view[offset:]
+            self._pending_len = rest
+
+        return events
+
+    @property
+    def speech_ms(self) -> int:
+        """当前这段语音中语音帧的总时长（毫秒），静音状态下为0"""
+        return self.speech_frames * self.frame_duration_ms if self.is_speaking else 0
+
+    def reset(self):
+        """丢弃当前的语音和缓冲数据，回到静音状态"""
+        self._pending_len = 0
+        self._pre_roll_count = 0
+        self._utterance_len = 0
+        self._silence_ms = 0
+        self.speech_frames = 0
+        self.is_speaking = False
+
+    def _process_frame(self, frame: memoryview, events: list):
+        """检测一帧，并根据状态机更新缓冲和事件"""
+        speech = self.vad.is_speech(frame, self.sample_rate)
+        if speech:
+            self.last_speech_at = time.perf_counter()
+
+        # 静音状态：遇到语音帧开始记录，否则放入预录缓冲
+        if not self.is_speaking:
+            if speech:
+                self._start_utterance()
+                self._append(frame)
+                events.append(VADEvent(SPEECH_START))
+            else:
+                self._push_pre_roll(frame)
+            return
+
+        # 说话状态：只要正在说话，就记录音频帧（即使当前帧是静音的）
+        self._append(frame)
+        if speech:
+            self._silence_ms = 0
+            self.speech_frames += 1
+        else:
+            self._silence_ms += self.frame_duration_ms
+
+        if self._silence_ms >= self.max_silence_ms or self._utterance_len + self.frame_bytes > self.max_utterance_bytes:
+            self._end_utterance(events)
+
+    def _start_utterance(self):
+        """开始一段新的语音：选择语音缓冲，并拷贝预录部分"""
+        if self._ended_in_feed:
+            self._current ^= 1
+        if self._buffers[self._current] is None:
+            self._buffers[self._current] = bytearray(self.max_utterance_bytes)
+
+        self.is_speaking = True
+        self._silence_ms = 0
+        self._utterance_len = 0
+        self.speech_frames = 1
+
+        # 按时间顺序拷贝预录的帧（最旧的帧在前）
+        count = min(self._pre_roll_count, self.max_utterance_bytes // self.frame_bytes - 1)
+        for i in range(self._pre_roll_count - count, self._pre_roll_count):
+            index = (self._pre_roll_pos - self._pre_roll_count + i) % self.pre_roll_frames
+            start = index * self.frame_bytes
+            self._append(memoryview(self._pre_roll)[start:start + self.frame_bytes])
+        self._pre_roll_count = 0
+
+    def _append(self, frame: memoryview):
+        """将一帧追加到当前语音缓冲"""
+        buffer = self._buffers[self._current]
+        buffer[self._utterance_len:self._utterance_len + self.frame_bytes] = frame
+        self._utterance_len += self.frame_bytes
+
+    def _push_pre_roll(self, frame: memoryview):
+        """将一帧写入预录环形缓冲（覆盖最旧的帧）"""
+        if not self.pre_roll_frames:
+            return
+        start = self._pre_roll_pos * self.frame_bytes
+        self._pre_roll[start:start + self.frame_bytes] = frame
+        self._pre_roll_pos = (self._pre_roll_pos + 1) % self.pre_roll_frames
+        self._pre_roll_count = min(self._pre_roll_count + 1, self.pre_roll_frames)
+
+    def _end_utterance(self, events: list):
+        """结束当前语音，输出整段语音的视图"""
+        audio = memoryview(self._buffers[self._current])[:self._utterance_len]
+        events.append(VADEvent(SPEECH_END, audio))
+
+        self.is_speaking = False
+        self._silence_ms = 0
+        self._ended_in_feed = True
@@ -1,14 +1,24 @@
 import webrtcvad
+import numpy as np
 import os
+import struct
+import time
+
+from my_metrics.metrics import observe_stage
+from my_vad.vad_stream import VADStream, SPEECH_START, SPEECH_END
 
 
 class WebRTCVAD:
-    def __init__(self, mode=3, sample_rate=16000, frame_duration_ms=30, max_silence_ms=2000):
+    def __init__(self, mode=3, sample_rate=16000, frame_duration_ms=30, max_silence_ms=2000,
+                 pre_roll_ms=300, max_utterance_ms=20000):
         """
         初始化VAD
         :param mode: VAD模式，0-3，值越高越敏感
         :param sample_rate: 音频采样率（客户端那边默认16khz）
         :param frame_duration_ms: 每帧的时长（毫秒）（只能选10、20、30）
+        :param max_silence_ms: 最大静音时长（毫秒）
+        :param pre_roll_ms: VAD流的预录时长（毫秒），避免第一个音节被截断
+        :param max_utterance_ms: VAD流中单段语音的最大时长（毫秒）
         """
         self.vad = webrtcvad.Vad(mode)
         self.sample_rate = sample_rate
@@ -19,6 +29,12 @@ class WebRTCVAD:
         self.frame_bytes = self.frame_size * 2
         # 最大静音时长（毫秒），超过这个时间没有语音则认为是静音
         self.max_silence_ms = max_silence_ms
+        self.pre_roll_ms = pre_roll_ms
+        self.max_utterance_ms = max_utterance_ms
+        # detect_voice_from_ws 使用的VAD流（第一次调用时创建）
+        self.stream = None
+        # 最近一次检测到语音结束的时间（time.perf_counter），作为语音对话延迟的起点
+        self.speech_end_at = None
 
     def is_speech(self, frame, sample_rate=None):
         """
@@ -31,127 +47,205 @@ class WebRTCVAD:
             sample_rate = self.sample_rate
         return self.vad.is_speech(frame, sample_rate)
 
-    async def detect_voice_from_ws(self, websocket, sample_rate=None):
+    def create_stream(self, sample_rate=None) -> VADStream:
+        """
+        创建推送式的VAD流（每个连接一个），见 VADStream
+        :param sample_rate: 采样率
+        """
+        return VADStream(self, pre_roll_ms=self.pre_roll_ms, max_utterance_ms=self.max_utterance_ms,
+                         sample_rate=sample_rate)
+
+    async def detect_voice_from_ws(self, websocket, sample_rate=None, denoiser=None, on_speech=None,
+                                   min_speech_ms=0, decoder=None):
         """
         从WebSocket接收音频数据并检测语音活动
+        同一个连接多次调用时复用同一个VAD流，不完整的帧和预录数据会保留到下一次调用
         :param websocket: WebSocket连接对象
         :param sample_rate: 采样率
-        :return: 检测到的语音数据
+        :param denoiser: 流式降噪器（StreamDenoiser），在VAD之前对音频进行降噪
+        :param on_speech: 用户开始说话时的回调（无参数），每段语音最多调用一次，用于打断正在播放的回复
+        :param min_speech_ms: 语音帧累计达到该时长（毫秒）才调用 on_speech，避免咳嗽、回声等短促的声音触发打断
+        :param decoder: 上行音频的解码函数（连接协商的编解码器），将一条消息解码为PCM，在降噪和VAD之前调用
+        :return: 检测到的语音数据（memoryview，在下一次调用之前有效）
         """
-        audio_buffer = b""
-        record_audio = b""
-        is_speaking = False
-        silence_time_ms = 0
+        if self.stream is None:
+            self.stream = self.create_stream(sample_rate=sample_rate)
+        # 本段语音是否已调用过 on_speech（上一次调用时已经开始的语音同样计入）
+        notified = False
+
         while True:
-            try:
-                # 接收音频数据（每次传输音频的大小chunksize为512，字节数为1024）
-                audio_data = await websocket.receive_bytes()
-                if not audio_data:
-                    break  # 连接关闭或没有数据
-
-                audio_buffer += audio_data
-                # 将音频数据分成帧进行处理
-                for i in range(0, len(audio_buffer), self.frame_bytes):
-                    frame = audio_buffer[i:i + self.frame_bytes]
-                    # 如果帧长度小于预期的帧大小，跳过
-                    if len(frame) < self.frame_bytes:
-                        audio_buffer = frame
-                        break
-                    # 检测语音活动
-                    if self.is_speech(frame, sample_rate):
-                        if not is_speaking:
-                            print("检测到语音活动，开始记录音频...")
-                            is_speaking = True
-                            record_audio = b""  # 清空之前的记录
-                        # 重置静音计时器
-                        silence_time_ms = 0
-                    else:
-                        if is_speaking:
-                            silence_time_ms += self.frame_duration_ms
-                            if silence_time_ms >= self.max_silence_ms:
-                                print("检测到静音，结束记录音频。")
-                                is_speaking = False
-                                break
-                    # 只要正在说话，就将音频帧添加到记录中（及时当前帧是沉默的）
-                    if is_speaking:
-                        record_audio += frame
-                if not is_speaking and record_audio:
+            # 接收音频数据（每次传输音频的大小chunksize为512，字节数为1024）
+            audio_data = await websocket.receive_bytes()
+            if not audio_data:
+                continue
+            if decoder:
+                audio_data = decoder(audio_data)
+
+            # 在线程池中降噪（当前VAD状态作为噪声谱学习的提示：说话时不更新噪声谱）
+            if denoiser:
+                audio_data = await denoiser.process_async(audio_data, speech=self.stream.is_speaking)
+
+            for event in self.stream.feed(audio_data):
+                if event.type == SPEECH_START:
+                    print("检测到语音活动，开始记录音频...")
+                    notified = False
+                elif event.type == SPEECH_END:
                     print("语音活动结束，返回记录的音频数据。")
-                    break
+                    self.speech_end_at = time.perf_counter()
+                    # 从最后一个语音帧到判定语音结束的耗时（主要是静音等待时长）
+                    if self.stream.last_speech_at is not None:
+                        observe_stage("vad_end_of_speech", self.speech_end_at - self.stream.last_speech_at,
+                                      "webrtcvad")
+                    return event.audio
 
-            except Exception as e:
-                print(f"Error receiving data: {e}")
-                break
-
-        return record_audio
+            if on_speech and not notified and self.stream.speech_ms >= max(min_speech_ms, 1):
+                notified = True
+                on_speech()
 
     async def detect_voice_from_file(self, file_path, sample_rate=None):
         """
-        从本地音频文件进行语音活动检测
-        每次读取 frame_bytes 大小的数据，调用 VAD 检测
-        :param file_path: 音频文件路径 (必须是16kHz, 16bit PCM 格式)
+        从本地音频文件进行语音活动检测，返回第一段语音（需要所有语音段时使用 iter_segments）
+        :param file_path: 音频文件路径 (必须是16kHz, 16bit PCM 格式，可以是pcm或wav)
         :param sample_rate: 采样率
         :return: 检测到的语音数据（bytes）
         """
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"音频文件不存在: {file_path}")
+        for start, end, segment in self.iter_segments(file_path, sample_rate=sample_rate):
+            print("语音活动结束，返回记录的音频数据。")
+            return segment.tobytes()
 
-        record_audio = b""
-        is_speaking = False
-        silence_time_ms = 0
+        print("未检测到语音活动。")
+        return b""
 
+    def iter_segments(self, source, sample_rate=None, energy_threshold_db=-45.0, block_frames=4096):
+        """
+        对文件或数组进行多段语音检测，依次产出所有语音段
+        1.文件通过内存映射读取，不整体载入内存
+        2.先用NumPy按帧计算能量（dBFS），低于阈值的帧直接判为静音，不调用webrtcvad
+        3.其余帧调用webrtcvad检测，再按最大静音时长合并成语音段（前后各保留预录时长的音频）
+        :param source: pcm/wav文件路径、int16的NumPy数组或PCM字节
+        :param sample_rate: 采样率（文件为wav时以文件头为准）
+        :param energy_threshold_db: 能量预筛的阈值（dBFS）
+        :param block_frames: 计算能量时每批处理的帧数（限制临时内存）
+        :return: 生成器，产出 (起始采样点, 结束采样点, 该段的int16数组视图)
+        """
+        samples = self._load_samples(source, sample_rate)
+        n_frames = len(samples) // self.frame_size
+        if n_frames == 0:
+            return
+        frames = samples[:n_frames * self.frame_size].reshape(n_frames, self.frame_size)
+
+        # 1.能量预筛
+        threshold = (10 ** (energy_threshold_db / 20) * 32768) ** 2
+        loud = np.empty(n_frames, dtype=bool)
+        for i in range(0, n_frames, block_frames):
+            block = frames[i:i + block_frames].astype(np.float32)
+            loud[i:i + block_frames] = np.mean(block * block, axis=1) > threshold
+
+        # 2.对可能是语音的帧调用webrtcvad
+        speech = np.zeros(n_frames, dtype=bool)
+        for i in np.flatnonzero(loud):
+            speech[i] = self.vad.is_speech(memoryview(frames[i]).cast("B"), self.sample_rate)
+
+        speech_index = np.flatnonzero(speech)
+        if len(speech_index) == 0:
+            return
+
+        # 3.语音帧之间的间隔超过最大静音时长时断开，得到每段的第一帧和最后一帧
+        max_silence_frames = self.max_silence_ms // self.frame_duration_ms
+        breaks = np.flatnonzero(np.diff(speech_index) > max_silence_frames)
+        first_frames = speech_index[np.concatenate(([0], breaks + 1))]
+        last_frames = speech_index[np.concatenate((breaks, [len(speech_index) - 1]))]
+
+        pad_frames = self.pre_roll_ms // self.frame_duration_ms
+        max_frames = max(self.max_utterance_ms // self.frame_duration_ms, 1)
+        for first, last in zip(first_frames, last_frames):
+            first = max(int(first) - pad_frames, 0)
+            last = min(int(last) + 1 + pad_frames, n_frames)
+            # 超过最大时长的语音段按最大时长切分
+            for seg_first in range(first, last, max_frames):
+                seg_last = min(seg_first + max_frames, last)
+                start, end = seg_first * self.frame_size, seg_last * self.frame_size
+                yield start, end, samples[start:end]
+
+    def _load_samples(self, source, sample_rate=None) -> np.ndarray:
+        """
+        将不同形式的音频输入转换为int16数组（文件使用只读内存映射）
+        """
+        if isinstance(source, np.ndarray):
+            samples = source
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            samples = np.frombuffer(source, dtype="<i2")
+        else:
+            if not os.path.exists(source):
+                raise FileNotFoundError(f"音频文件不存在: {source}")
+            offset, length, file_rate, channels, sample_width = self._read_wav_header(source)
+            if file_rate is not None:
+                if channels != 1 or sample_width != 2:
+                    raise ValueError(f"只支持16bit单声道wav文件: {source}")
+                sample_rate = file_rate
+            if length // 2 == 0:
+                return np.zeros(0, dtype=np.int16)
+            samples = np.memmap(source, dtype="<i2", mode="r", offset=offset, shape=(length // 2,))
+
+        if samples.dtype != np.int16 or samples.ndim != 1:
+            raise ValueError("音频数据必须是一维的int16数组")
+        if sample_rate is not None and sample_rate != self.sample_rate:
+            raise ValueError(f"音频采样率({sample_rate})与VAD采样率({self.sample_rate})不一致")
+        return samples
+
+    @staticmethod
+    def _read_wav_header(file_path):
+        """
+        读取wav文件头，找到data块的位置
+        :return: (数据偏移, 数据字节数, 采样率, 声道数, 采样宽度)；不是wav文件时按裸PCM处理，采样率等为None
+        """
+        file_size = os.path.getsize(file_path)
         with open(file_path, "rb") as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                return 0, file_size, None, None, None
+
+            sample_rate = channels = sample_width = None
             while True:
-                frame = f.read(self.frame_bytes)
-                if len(frame) < self.frame_bytes:
-                    break  # 文件读完
-
-                if self.is_speech(frame, sample_rate):
-                    if not is_speaking:
-                        print("检测到语音活动，开始记录音频...")
-                        is_speaking = True
-                        record_audio = b""
-                    silence_time_ms = 0
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    raise ValueError(f"wav文件中没有data块: {file_path}")
+                chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    channels, sample_rate = struct.unpack("<HI", fmt[2:8])
+                    sample_width = struct.unpack("<H", fmt[14:16])[0] // 8
+                    if chunk_size % 2:
+                        f.seek(1, 1)
+                elif chunk_id == b"data":
+                    offset = f.tell()
+                    # 流式写出的wav文件data长度可能不准确，以实际文件大小为准
+                    return offset, min(chunk_size, file_size - offset), sample_rate, channels, sample_width
                 else:
-                    if is_speaking:
-                        silence_time_ms += self.frame_duration_ms
-                        if silence_time_ms >= self.max_silence_ms:
-                            print("检测到静音，结束记录音频。")
-                            is_speaking = False
-                            break
-
-                if is_speaking:
-                    record_audio += frame
-
-        if record_audio:
-            print("语音活动结束，返回记录的音频数据。")
-        else:
-            print("未检测到语音活动。")
-
-        return record_audio
+                    f.seek(chunk_size + chunk_size % 2, 1)
 
 
 if __name__ == '__main__':
-    import asyncio
     import wave
 
     vad = WebRTCVAD()
 
-    async def test_vad():
+    def test_vad():
         file_path = "../audio_16khz.wav"
-        save_path = "../audio_16khz_detected.wav"
         sample_rate = 16000
-        audio_data = await vad.detect_voice_from_file(file_path)
-        if audio_data:
-            print(f"检测到语音数据，长度: {len(audio_data)} bytes")
+        count = 0
+        for start, end, segment in vad.iter_segments(file_path):
+            count += 1
+            save_path = f"../audio_16khz_detected_{count}.wav"
+            print(f"第{count}段语音: {start / sample_rate:.2f}s - {end / sample_rate:.2f}s")
             # 将字节保存成wav文件，方便播放测试
             with wave.open(save_path, "wb") as wf:
                 wf.setnchannels(1)
                 wf.setsampwidth(2)
                 wf.setframerate(sample_rate)
-                wf.writeframes(audio_data)
+                wf.writeframes(segment.tobytes())
             print(f"已保存检测到的语音数据到: {save_path}")
-        else:
+        if not count:
             print("未检测到语音数据")
 
-    asyncio.run(test_vad())
\ No newline at end of file
+    test_vad()
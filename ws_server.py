@@ -1,21 +1,27 @@
+import json
 import wave
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket
-from chat_handler.chat_tts_handler import ChatTTSHandler
+from fastapi.responses import PlainTextResponse
+from chat_handler.duplex_session import DuplexVoiceSession
+from chat_handler.session_manager import SessionManager, SessionLimitError
+from chat_handler.session_store import SessionStore
+from my_codec.audio_codec import negotiate_codec, traffic_stats
 from my_asr.sensevoice_engine import SenseVoiceEngine
 from my_llm.openai_engine import OpenAIEngine
+from my_llm.response_cache import ResponseCache
 from my_mcp.mcp_client import MCPClientManager
+from my_mcp.tool_cache import ToolResultCache
+from my_metrics.metrics import REGISTRY
 from my_tts.cosy_voice_engine import CosyVoiceEngine
 from my_tts.gpt_sovits_engine import GPTSoVTISEngine
+from my_tts.tts_cache import TTSCache, CachedTTSEngine
 from my_vad.webrtc_vad import WebRTCVAD
 from starlette.websockets import WebSocketDisconnect
-from scipy.io.wavfile import write
-import tempfile
 import yaml
 import os
 
-app = FastAPI()
-
 config_file = None
 # 获取各种配置文件路径
 with open("config.yaml", 'r', encoding='utf-8') as f:
@@ -43,21 +49,107 @@ if system_role == "ai_assistant":
     tts_engine = CosyVoiceEngine(tts_config)
 else:
     tts_engine = GPTSoVTISEngine(tts_config, remote=tts_remote, role=system_role)
+# TTS音频缓存：常用的回复（问候语、提示语等）直接使用缓存的音频，相同的并发请求只合成一次
+tts_cache_config = config_file.get("tts_cache", {})
+if tts_cache_config.get("enabled", True):
+    tts_engine = CachedTTSEngine(tts_engine, TTSCache(max_memory_mb=tts_cache_config.get("max_memory_mb", 64),
+                                                      disk_dir=tts_cache_config.get("disk_dir"),
+                                                      max_disk_mb=tts_cache_config.get("max_disk_mb", 512)))
 # 初始化ASR引擎
 asr_engine = SenseVoiceEngine(asr_config, asr_remote)
 
-# 创建聊天处理器实例
-chat_tts_handler = ChatTTSHandler(llm_engine, mcp_client, tts_engine, asr_engine,
-                                  whitelist_path=config_file["config_paths"]["whitelist_path"],
-                                  max_context_tokens=llm_config["max_context_tokens"], system_role=system_role)
-
-# VAD（语音活动检测）引擎
-vad = WebRTCVAD()
+# 会话管理器：引擎在所有连接之间共享，每个连接拥有独立的对话状态
+session_config = config_file.get("session", {})
+vad_config = config_file.get("vad", {})
+denoise_config = config_file.get("denoise", {})
+# 是否在VAD之前进行流式降噪
+denoise_enabled = denoise_config.pop("enabled", True)
+pipeline_config = config_file.get("pipeline", {})
+# 音频编解码：每个连接协商一种编解码器（设备没有给出时使用原有的pcm16）
+codec_config = config_file.get("codec", {})
+# 打断（barge-in）：回复播放时用户开始说话，取消本轮剩余的回复
+barge_in_config = config_file.get("barge_in", {})
+barge_in_enabled = barge_in_config.get("enabled", True)
+barge_in_min_speech_ms = barge_in_config.get("min_speech_ms", 300)
+# LLM回复缓存（可选）：常见的重复问题直接使用缓存的回复
+llm_cache_config = config_file.get("llm_cache", {})
+response_cache = None
+if llm_cache_config.get("enabled", False):
+    response_cache = ResponseCache(ttl_seconds=llm_cache_config.get("ttl_seconds", 3600),
+                                   max_entries=llm_cache_config.get("max_entries", 1000),
+                                   context_messages=llm_cache_config.get("context_messages", 2))
+# 工具结果缓存：哪些工具可以缓存以及缓存时长在 tools_whitelist.yaml 中配置
+tool_cache_config = config_file.get("tool_cache", {})
+tool_cache = None
+if tool_cache_config.get("enabled", True):
+    tool_cache = ToolResultCache(max_entries=tool_cache_config.get("max_entries", 1000),
+                                 max_mb=tool_cache_config.get("max_mb", 16))
+# 会话存储（可选）：按设备ID保存对话历史，设备断线重连后继续之前的对话
+session_store = None
+if session_config.get("store_path"):
+    session_store = SessionStore(session_config["store_path"],
+                                 flush_interval=session_config.get("store_flush_interval", 1.0))
+session_manager = SessionManager(llm_engine, mcp_client, tts_engine, asr_engine,
+                                 whitelist_path=config_file["config_paths"]["whitelist_path"],
+                                 system_role_path=config_file["config_paths"]["system_role_path"],
+                                 max_context_tokens=llm_config["max_context_tokens"],
+                                 system_role=system_role,
+                                 max_sessions=session_config.get("max_sessions", 500),
+                                 max_active_sessions=session_config.get("max_active_sessions", 32),
+                                 tts_session_concurrency=pipeline_config.get("tts_session_concurrency", 2),
+                                 tts_global_concurrency=pipeline_config.get("tts_global_concurrency", 8),
+                                 tts_lookahead=pipeline_config.get("tts_lookahead", 4),
+                                 tts_streaming=pipeline_config.get("tts_streaming", True),
+                                 response_cache=response_cache,
+                                 tool_cache=tool_cache,
+                                 session_store=session_store,
+                                 idle_timeout=session_config.get("idle_timeout", 300),
+                                 max_idle_sessions=session_config.get("max_idle_sessions", 100))
+
+# /metrics 中输出的统计数据（各阶段的耗时直方图由各个模块直接记录）
+REGISTRY.register_stats("llm_usage", "LLM token usage",
+                        lambda: dict(llm_engine.usage_stats, prompt_cache_hit_ratio=llm_engine.cache_hit_ratio))
+REGISTRY.register_stats("sessions", "Voice chat sessions",
+                        lambda: {"connected": len(session_manager.sessions),
+                                 "idle": len(session_manager.idle_sessions)})
+REGISTRY.register_stats("audio_traffic", "WebSocket audio traffic in bytes", traffic_stats)
+if isinstance(tts_engine, CachedTTSEngine):
+    REGISTRY.register_stats("tts_cache", "TTS audio cache", tts_engine.cache.stats)
+if response_cache:
+    REGISTRY.register_stats("llm_response_cache", "LLM response cache", response_cache.stats)
+if tool_cache:
+    REGISTRY.register_stats("tool_cache", "MCP tool result cache", tool_cache.stats)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # MCP服务器的长连接在整个服务器生命周期内保持，所有会话共享（断开后自动重连）
+    async with mcp_client:
+        # 启动时构建共享的工具目录，新的连接不再请求每个MCP服务器
+        await session_manager.tool_catalog.get_tools()
+        if session_store:
+            await session_store.start()
+        yield
+        await session_manager.close_all()
+        # 关闭会话之后再关闭会话存储（写入所有会话的最新状态）
+        if session_store:
+            await session_store.close()
+    # 关闭LLM引擎共享的HTTP连接池
+    await llm_engine.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus文本格式的指标：各阶段的耗时直方图（包括最近样本的p50/p95/p99）和缓存等统计数据"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 # 播放音频测试
 import numpy as np
-import noisereduce as nr # 引入降噪库
+from my_denoise.stream_denoiser import StreamDenoiser
 
 # --- 文件名定义 ---
 SAMPLE_WIDTH = 2  # 每个采样点 2字节（int16）
@@ -72,111 +164,62 @@ PCM_FILE_8K_DENOISED = "audio_8khz_denoised.pcm"
 WAV_FILE_8K_DENOISED = "audio_8khz_denoised.wav"
 
 
+class PCMWavWriter:
+    """边接收边写入：同时增量写入PCM文件和WAV文件（WAV文件头在关闭时更新）"""
+
+    def __init__(self, pcm_path, wav_path, sample_rate):
+        self.pcm_path = pcm_path
+        self.wav_path = wav_path
+        self.pcm_file = open(pcm_path, "wb")
+        self.wav_file = wave.open(wav_path, "wb")
+        self.wav_file.setnchannels(1)
+        self.wav_file.setsampwidth(SAMPLE_WIDTH)
+        self.wav_file.setframerate(sample_rate)
+
+    def write(self, data: bytes):
+        self.pcm_file.write(data)
+        self.wav_file.writeframes(data)
+
+    def close(self):
+        self.pcm_file.close()
+        self.wav_file.close()
+        print(f"已保存文件: {self.pcm_path}, {self.wav_path}")
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("客户端已连接")
 
-    # 使用 bytearray 作为内存中的缓冲区，比反复读写文件更高效
-    raw_buffer = bytearray()
+    # 边接收边降噪、边写文件，不在内存中缓存整个会话的音频
+    #  降噪是流式的（在线学习噪声谱），在线程池中执行，不阻塞事件循环
+    writer_16k = PCMWavWriter(PCM_FILE_16K, WAV_FILE_16K, 16000)
+    writer_8k = PCMWavWriter(PCM_FILE_8K, WAV_FILE_8K, 8000)
+    writer_16k_denoised = PCMWavWriter(PCM_FILE_16K_DENOISED, WAV_FILE_16K_DENOISED, 16000)
+    writer_8k_denoised = PCMWavWriter(PCM_FILE_8K_DENOISED, WAV_FILE_8K_DENOISED, 8000)
+    denoiser_16k = StreamDenoiser(sample_rate=16000, **denoise_config)
+    denoiser_8k = StreamDenoiser(sample_rate=8000, **denoise_config)
 
     try:
         async for message in websocket.iter_bytes():
-            # 将接收到的原始数据直接追加到缓冲区
-            # 数据格式为 [S1, S1, S2, S2, ...]
-            raw_buffer.extend(message)
+            # --- 1. 16kHz 原始数据（数据格式为 [S1, S1, S2, S2, ...]） ---
+            writer_16k.write(message)
+
+            # --- 2. 提取不重复的采样点 (得到原始的8kHz数据) ---
+            clean_bytes = np.frombuffer(message, dtype=np.int16)[::2].tobytes()
+            writer_8k.write(clean_bytes)
+
+            # --- 3. 流式降噪 ---
+            writer_16k_denoised.write(await denoiser_16k.process_async(message))
+            writer_8k_denoised.write(await denoiser_8k.process_async(clean_bytes))
 
     except WebSocketDisconnect:
         print("客户端正常断开连接")
     except Exception as e:
         print(f"连接异常：{e}")
     finally:
-        print("数据接收完毕，开始处理并保存文件...")
-
-        if not raw_buffer:
-            print("未接收到任何数据，程序退出。")
-            return
-
-        try:
-            # --- 1. 处理并保存 16kHz 原始文件 ---
-            # 直接将缓冲区内容存为 16kHz PCM 文件
-            with open(PCM_FILE_16K, "wb") as f:
-                f.write(raw_buffer)
-            print(f"已保存 16kHz PCM 文件: {PCM_FILE_16K}")
-
-            # 将 16kHz PCM 数据存为 WAV 文件
-            with wave.open(WAV_FILE_16K, "wb") as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(SAMPLE_WIDTH)
-                wf.setframerate(16000)
-                wf.writeframes(raw_buffer)
-            print(f"已保存 16kHz WAV 文件: {WAV_FILE_16K}")
-
-            # --- 2. 处理并保存 8kHz 清理后文件 ---
-            # 使用 numpy 解析原始数据流
-            raw_samples = np.frombuffer(raw_buffer, dtype=np.int16)
-
-            # 提取不重复的采样点 (得到原始的8kHz数据)
-            clean_samples = raw_samples[::2]
-
-            # 将干净的数据转换回字节
-            clean_bytes = clean_samples.tobytes()
-
-            # 将清理后的字节存为 8kHz PCM 文件
-            with open(PCM_FILE_8K, "wb") as f:
-                f.write(clean_bytes)
-            print(f"已保存 8kHz PCM 文件: {PCM_FILE_8K}")
-
-            # 将 8kHz PCM 数据存为 WAV 文件
-            with wave.open(WAV_FILE_8K, "wb") as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(SAMPLE_WIDTH)
-                wf.setframerate(8000)
-                wf.writeframes(clean_bytes)
-            print(f"已保存 8kHz WAV 文件: {WAV_FILE_8K}")
-
-            # --- 3. 对 16kHz 音频进行简单降噪并保存 ---
-            print("正在对 16kHz 音频进行简单降噪处理...")
-            # 使用 noisereduce 库对 16kHz 音频进行降噪
-            denoised_16k_samples = nr.reduce_noise(y=raw_samples, sr=16000, prop_decrease=0.8)
-            denoised_16k_bytes = denoised_16k_samples.tobytes()
-            # 保存降噪后的 16kHz PCM 文件
-            with open("audio_16khz_denoised.pcm", "wb") as f:
-                f.write(denoised_16k_bytes)
-            print(f"已保存降噪后的 16kHz PCM 文件: audio_16khz_denoised.pcm")
-            # 保存降噪后的 16kHz WAV 文件
-            with wave.open(WAV_FILE_16K_DENOISED, "wb") as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(SAMPLE_WIDTH)
-                wf.setframerate(16000)
-                wf.writeframes(denoised_16k_bytes)
-            print(f"已保存降噪后的 16kHz WAV 文件: {WAV_FILE_16K_DENOISED}")
-
-            # --- 4. 对 8kHz 音频进行AI降噪并保存 ---
-            print("正在对 8kHz 音频进行降噪处理...")
-            # 调用降噪函数。参数 prop_decrease 控制降噪强度（0到1之间）
-            # 注意：clean_samples 是一个 numpy 数组，可以直接处理
-            denoised_samples = nr.reduce_noise(y=clean_samples, sr=8000, prop_decrease=0.8)
-
-            # 将降噪后的 numpy 数组转换回字节
-            denoised_bytes = denoised_samples.tobytes()
-
-            # 保存降噪后的 PCM 文件
-            with open(PCM_FILE_8K_DENOISED, "wb") as f:
-                f.write(denoised_bytes)
-            print(f"已保存降噪后的 8kHz PCM 文件: {PCM_FILE_8K_DENOISED}")
-
-            # 保存降噪后的 WAV 文件
-            with wave.open(WAV_FILE_8K_DENOISED, "wb") as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(SAMPLE_WIDTH)
-                wf.setframerate(8000)
-                wf.writeframes(denoised_bytes)
-            print(f"已保存降噪后的 8kHz WAV 文件: {WAV_FILE_8K_DENOISED}")
-
-
-        except Exception as e:
-            print(f"保存文件时出错：{e}")
+        for writer in (writer_16k, writer_8k, writer_16k_denoised, writer_8k_denoised):
+            writer.close()
 
 
 
@@ -213,43 +256,47 @@ async def websocket_send_audio(websocket: WebSocket):
         print("发送端：连接已关闭。")
 
 
-# @app.websocket("/ws")
-# async def websocket_endpoint(websocket: WebSocket):
-#     # 接受WebSocket连接（握手）
-#     await websocket.accept()
-#
-#     print("--------------WebSocket连接已建立--------------")
-#
-#     async with mcp_client.client:
-#         # 启动聊天处理器（目前每次启动都是新的开始，没有保存和加载用户上下文）
-#         await chat_tts_handler.start(system_role_path=config_file["config_paths"]["system_role_path"],
-#                                      websocket=websocket)
-#         print("对话窗口长度：", len(chat_tts_handler.history))
-#
-#         try:
-#             while True:
-#                 try:
-#                     record_audio = await vad.detect_voice_from_ws(websocket)
-#                     if record_audio:
-#                         print("检测到语音活动，开始处理...")
-#                         # 1.将音频保存成临时的wav文件
-#                         temp_audio_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-#                         write(temp_audio_file.name, vad.sample_rate, record_audio)
-#
-#                         # 2.传递给chat_tts_handler进行处理
-#                         await chat_tts_handler.interactive_with_audio_input(temp_audio_file.name)
-#
-#                         # 3.处理完毕后删除临时文件
-#                         if temp_audio_file.name:
-#                             print(f"删除临时音频文件: {temp_audio_file.name}")
-#                             os.remove(temp_audio_file.name)
-#                     else:
-#                         print("没有检测到语音活动，等待下一次输入...")
-#                 except WebSocketDisconnect as e:
-#                     print(f"客户端断开连接: {e.code}, 原因: {e.reason}")
-#                     break
-#         finally:
-#             # 确保在退出时停止聊天处理器
-#             await chat_tts_handler.stop()
-#
-#     print("----------------WebSocket连接已关闭----------------")
+# --- 端点三：语音对话（每个连接一个独立会话） ---
+@app.websocket("/ws_chat")
+async def websocket_chat_endpoint(websocket: WebSocket):
+    # 接受WebSocket连接（握手）
+    await websocket.accept()
+
+    # 协商音频编解码器（查询参数 codecs 或请求头 Audio-Codecs，如 "opus,adpcm,pcm8k"，按优先级排列）
+    #  设备给出了支持的编解码器时，先发送一条文本消息告知协商结果：{"type": "codec", "codec": ..., "sample_rate": ...}
+    codec_offer = websocket.query_params.get("codecs") or websocket.headers.get("audio-codecs")
+    codec = negotiate_codec(codec_offer, **codec_config)
+    if codec_offer:
+        print(f"🎧 音频编解码: {codec.name}（设备支持: {codec_offer}）")
+        await websocket.send_text(json.dumps(codec.describe()))
+
+    # 设备ID（查询参数 device_id 或请求头 Device-Id）：同一设备重新连接时恢复之前的会话
+    device_id = websocket.query_params.get("device_id") or websocket.headers.get("device-id")
+    try:
+        chat_tts_handler = await session_manager.open_session(websocket, device_id=device_id)
+    except SessionLimitError as e:
+        print(f"拒绝连接：{e}")
+        await websocket.close(code=1013, reason="server busy")
+        return
+
+    print(f"--------------WebSocket连接已建立（会话 {chat_tts_handler.session_id}）--------------")
+
+    # VAD（语音活动检测）和降噪内部带有状态，每个连接独立一个
+    vad = WebRTCVAD(**vad_config)
+    denoiser = StreamDenoiser(sample_rate=vad.sample_rate, **denoise_config) if denoise_enabled else None
+    # 全双工：接收（VAD）、对话、发送在不同的任务中进行，回复播放时继续接收音频，用户开始说话则打断回复
+    duplex_session = DuplexVoiceSession(chat_tts_handler, websocket, vad, denoiser=denoiser,
+                                        barge_in=barge_in_enabled, min_speech_ms=barge_in_min_speech_ms,
+                                        max_pending_utterances=pipeline_config.get("max_pending_utterances", 2),
+                                        downlink_queue_size=pipeline_config.get("downlink_queue_size", 64),
+                                        codec=codec)
+
+    try:
+        # 登记处理该连接的会话对象：同一设备的新连接接管会话时，由SessionManager停止它并关闭这个连接
+        if session_manager.attach(chat_tts_handler, websocket, duplex_session):
+            await duplex_session.run()
+    finally:
+        # 确保在退出时停止并注销会话
+        await session_manager.close_session(chat_tts_handler, websocket)
+
+    print(f"----------------WebSocket连接已关闭（会话 {chat_tts_handler.session_id}）----------------")